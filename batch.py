@@ -2,11 +2,12 @@
 
 
 import sys
-import os
-import pathlib
-import subprocess
 import argparse
 
+from typing import List, Tuple
+
+import snapscreen
+
 
 def parse_arguments() -> argparse.Namespace:
 
@@ -14,20 +15,6 @@ def parse_arguments() -> argparse.Namespace:
             description='Create automated crops from RetroArch screenshots'
     )
 
-    parser.add_argument(
-            '--screenshot',
-            metavar='"screenshot.py"',
-            default='screenshot.py',
-            help='path to the screenshot script utility',
-    )
-
-    parser.add_argument(
-            '--crop',
-            metavar='"crop.py"',
-            default='crop.py',
-            help='path to the crop script utility',
-    )
-
     parser.add_argument(
             '--gamelist',
             metavar='"gamelist.ini"',
@@ -66,66 +53,295 @@ def parse_arguments() -> argparse.Namespace:
             help='convert collages to lossless .webp format, keep the .png',
     )
 
-    args = parser.parse_args()
+    parser.add_argument(
+            '--streamcollage',
+            action='store_true',
+            help='build collages one row of tiles at a time with little '
+                 'memory, see crop.py --streamcollage',
+    )
 
-    return args
+    parser.add_argument(
+            '--recompress',
+            action='store_true',
+            help='write crops and collages with fast compression first and '
+                 'recompress them in the background, see crop.py '
+                 '--recompress',
+    )
+
+    parser.add_argument(
+            '--pipeline',
+            action='store_true',
+            help='crop each screenshot as soon as it is created and start the'
+                 ' next resolution while collages are still being made',
+    )
+
+    parser.add_argument(
+            '--async',
+            dest='orchestrate',
+            action='store_true',
+            help='run all stages on an asyncio event loop like --pipeline, '
+                 'with a limit of parallel jobs for each stage, Ctrl-C kills '
+                 'all running programs',
+    )
+
+    parser.add_argument(
+            '--capturejobs',
+            metavar='N',
+            default=1,
+            type=int,
+            help='number of retroarch processes at the same time with '
+                 '--async, default 1',
+    )
+
+    parser.add_argument(
+            '--cropjobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of crops at the same time with --async, defaults to '
+                 'the number of cpus',
+    )
+
+    parser.add_argument(
+            '--collagejobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of collages at the same time with --async, defaults '
+                 'to half the number of cpus',
+    )
+
+    parser.add_argument(
+            '--encodejobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of webp conversions at the same time with --async, '
+                 'defaults to the number of cpus',
+    )
+
+    parser.add_argument(
+            '--format',
+            default='png',
+            choices=snapscreen.SCREENSHOT_FORMATS,
+            help='file format of the screenshots, ppm is faster to crop, see '
+                 'screenshot.py --format',
+    )
 
+    parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help='hardlink duplicate screenshots, reuse their crops and merge '
+                 'them in the collage, see screenshot.py --dedup and crop.py '
+                 '--dedup',
+    )
+
+    parser.add_argument(
+            '--session',
+            action='store_true',
+            help='take all screenshots of a game with one retroarch process,'
+                 ' see screenshot.py --session',
+    )
 
-def path(
-        file: str) -> pathlib.Path:
+    parser.add_argument(
+            '--headless',
+            action='store_true',
+            help='run retroarch on a virtual X server (Xvfb) with software '
+                 'rendering instead of the desktop, see screenshot.py '
+                 '--headless',
+    )
 
-    expandedfile = os.path.expandvars(file)
-    path = pathlib.Path(expandedfile).expanduser().resolve()
+    parser.add_argument(
+            '--stage',
+            action='store_true',
+            help='run retroarch from copies of its inputs in memory and move '
+                 'the screenshots to disk in batches, see screenshot.py '
+                 '--stage',
+    )
 
-    return path
+    parser.add_argument(
+            '--plan',
+            metavar='"plan.db"',
+            default=None,
+            help='keep the expanded jobs of all resolutions in this file and'
+                 ' reuse them, see screenshot.py --plan',
+    )
 
+    parser.add_argument(
+            '--gallery',
+            action='store_true',
+            help='create a static html gallery of all resolutions in folder '
+                 '"gallery/" at the end, see gallery.py',
+    )
 
+    parser.add_argument(
+            '--trace',
+            metavar='"trace.jsonl"',
+            default=None,
+            help='write the timing of every program run and file wait of all '
+                 'stages as json lines to this file and print a summary per '
+                 'stage at the end',
+    )
+
+    parser.add_argument(
+            '--nojournal',
+            action='store_true',
+            help='do not keep track of finished jobs in '
+                 '".snapscreen-journal.jsonl", which lets an interrupted run '
+                 'skip them when started again',
+    )
+
+    parser.add_argument(
+            '--jobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of threads for cropping in --pipeline mode, defaults'
+                 ' to the number of cpus',
+    )
+
+    args = parser.parse_args()
+    if args.pipeline and args.orchestrate:
+        parser.error('--async does not work together with --pipeline')
+    if args.session and args.orchestrate:
+        parser.error('--async does not work together with --session')
+    if args.session and args.stage:
+        parser.error('--stage does not work together with --session')
+
+    return args
+
+
+# Run the capture and crop stages for every resolution in this process.  The
+# gamelist and shaderlist are read and checked only once for all of them.
 def main() -> int:
 
     args = parse_arguments()
 
-    screenshot_script = path(args.screenshot)
-    crop_script = path(args.crop)
-    if args.appendconfig:
-        appendconfig = [path(file) for file in args.appendconfig]
-    else:
-        appendconfig = [pathlib.Path('append.cfg')]
-
-    for resolution in args.resolution.split(','):
-
-        screenshots_dir = path('./screenshots').joinpath(resolution)
-        crops_dir = path('./crops').joinpath(resolution)
-
-        s_command = []
-        s_command.append(screenshot_script.as_posix())
-        for file in appendconfig:
-            s_command.append('--appendconfig')
-            s_command.append(file.as_posix())
-        s_command.append('--window')
-        s_command.append(resolution)
-        s_command.append('--gamelist')
-        s_command.append(args.gamelist)
-        s_command.append('--shaderlist')
-        s_command.append(args.shaderlist)
-        s_command.append('--outputdir')
-        s_command.append(screenshots_dir.as_posix())
-
-        c_command = []
-        c_command.append(crop_script.as_posix())
-        if args.webp:
-            c_command.append('--webp')
-        c_command.append('--gamelist')
-        c_command.append(args.gamelist)
-        c_command.append('--inputdir')
-        c_command.append(screenshots_dir.as_posix())
-        c_command.append('--outputdir')
-        c_command.append(crops_dir.as_posix())
-
-        screenshots_dir.mkdir(parents=True, exist_ok=True)
-        subprocess.run(s_command)
-
-        crops_dir.mkdir(parents=True, exist_ok=True)
-        subprocess.run(c_command)
+    trace = None
+    if args.trace:
+        trace = snapscreen.Tracer(snapscreen.path(args.trace))
+    journal = None
+    if not args.nojournal:
+        journal = snapscreen.RunJournal(
+                snapscreen.path(snapscreen.JOURNAL_FILE))
+    limits = None
+    capturejobs = 1
+    if args.orchestrate:
+        limits = snapscreen.build_stage_limits(args.capturejobs,
+                                               args.cropjobs,
+                                               args.collagejobs,
+                                               args.encodejobs)
+        capturejobs = limits['capture']
+    recompress = None
+    if args.recompress:
+        recompress = snapscreen.RecompressPool()
+    resolutions = args.resolution.split(',')
+    displays = None
+    if args.headless:
+        sizes = [snapscreen.parse_window_size(resolution)
+                 for resolution in resolutions]
+        screen = (max(width for width, _ in sizes),
+                  max(height for _, height in sizes))
+        displays = snapscreen.DisplayPool(capturejobs, screen)
+    staging = None
+    if args.stage:
+        staging = snapscreen.StagingArea()
+    plan = None
+    # Everything is closed also on errors and Ctrl-C, so no virtual X server,
+    # staged file in memory or half recompressed file is left behind and the
+    # trace is complete up to this point.  An interrupted run keeps its
+    # journal to continue with.
+    try:
+        if args.plan:
+            plan = snapscreen.JobPlan(snapscreen.path(args.plan))
+            games, shaders = plan.load(snapscreen.path(args.gamelist),
+                                       snapscreen.path(args.shaderlist))
+        else:
+            games = snapscreen.games_from_gamelist(
+                    snapscreen.path(args.gamelist))
+            shaders = snapscreen.shaders_from_shaderlist(
+                    snapscreen.path(args.shaderlist))
+
+        stages: List[Tuple[dict, dict]] = []
+        for resolution in resolutions:
+
+            screenshots_dir = snapscreen.path('./screenshots').joinpath(
+                    resolution)
+            crops_dir = snapscreen.path('./crops').joinpath(resolution)
+            screenshots_dir.mkdir(parents=True, exist_ok=True)
+            crops_dir.mkdir(parents=True, exist_ok=True)
+
+            capture_settings = snapscreen.build_capture_settings(
+                    games,
+                    shaders,
+                    appendconfig=args.appendconfig,
+                    outputdir=screenshots_dir.as_posix(),
+                    window=resolution,
+                    jobs=capturejobs,
+                    session=args.session,
+                    plan=plan,
+                    trace=trace,
+                    journal=journal,
+                    displays=displays,
+                    staging=staging,
+                    dedup=args.dedup,
+                    format=args.format)
+            crop_settings = snapscreen.build_crop_settings(
+                    games,
+                    inputdir=screenshots_dir.as_posix(),
+                    outputdir=crops_dir.as_posix(),
+                    webp=args.webp,
+                    streamcollage=args.streamcollage,
+                    plan=plan,
+                    trace=trace,
+                    journal=journal,
+                    dedup=args.dedup,
+                    recompress=recompress)
+            stages.append((capture_settings, crop_settings))
+
+        if args.orchestrate:
+            try:
+                snapscreen.run_orchestrator(stages, limits)
+            except KeyboardInterrupt:
+                print()
+                print('Interrupted, all running programs killed.')
+                return 130
+        elif args.pipeline:
+            snapscreen.run_pipeline(stages, args.jobs)
+        else:
+            for capture_settings, crop_settings in stages:
+                snapscreen.capture(capture_settings)
+                snapscreen.crop(crop_settings)
+
+        if recompress is not None:
+            print('Waiting for recompression ...')
+            print(str(recompress.close()) + ' file(s) recompressed.')
+        if args.gallery:
+            gallery_settings = snapscreen.build_gallery_settings(
+                    games,
+                    screenshotsdir='./screenshots',
+                    cropsdir='./crops',
+                    outputdir='./gallery',
+                    trace=trace)
+            snapscreen.gallery(gallery_settings)
+        if journal is not None:
+            journal.finish()
+    finally:
+        if recompress is not None:
+            recompress.close(True)
+        if journal is not None:
+            journal.close()
+        if displays is not None:
+            displays.close()
+        if staging is not None:
+            staging.close()
+        if plan is not None:
+            plan.close()
+        if trace is not None:
+            trace.close()
+
+    if trace is not None:
+        trace.print_summary()
 
     return 0
 
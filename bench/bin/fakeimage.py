@@ -0,0 +1,99 @@
+# Shared helpers of the fake image programs in this folder.  Images are
+# written as plain png files with the standard library only, so the fakes work
+# without Pillow or ImageMagick.
+
+import os
+import re
+import time
+import zlib
+import struct
+
+from typing import Tuple
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+
+
+# Sleep for the seconds set in the environment variable name, to simulate the
+# time the real program needs.
+def delay(
+        name: str) -> None:
+
+    time.sleep(float(os.environ.get(name, '0') or '0'))
+
+
+# Write an RGB image as png file.  Each row is the color shifted by the row
+# number, so the files are not trivially small.  The file is written under a
+# temporary name first and then renamed, just like a finished real image.
+def write_png(
+        file: str, size: Tuple[int, int], color: bytes) -> None:
+
+    def chunk(kind: bytes, data: bytes) -> bytes:
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data)))
+
+    width, height = size
+    compressor = zlib.compressobj(1)
+    data = []
+    for y in range(height):
+        pixel = bytes((value + y) & 255 for value in color)
+        data.append(compressor.compress(b'\0' + pixel * width))
+    data.append(compressor.flush())
+    with open(file + '.tmp', 'wb') as f:
+        f.write(PNG_SIGNATURE)
+        f.write(chunk(b'IHDR', struct.pack('>IIBBBBB', width, height,
+                                           8, 2, 0, 0, 0)))
+        f.write(chunk(b'IDAT', b''.join(data)))
+        f.write(chunk(b'IEND', b''))
+    os.replace(file + '.tmp', file)
+
+
+# Write an RGB image as binary ppm file in a single color, under a temporary
+# name first like write_png().
+def write_ppm(
+        file: str, size: Tuple[int, int], color: bytes) -> None:
+
+    width, height = size
+    with open(file + '.tmp', 'wb') as f:
+        f.write(b'P6\n%d %d\n255\n' % (width, height))
+        f.write(color * (width * height))
+    os.replace(file + '.tmp', file)
+
+
+# Read width and height from the header of a png file.
+def read_png_size(
+        file: str) -> Tuple[int, int]:
+
+    with open(file, 'rb') as f:
+        header = f.read(24)
+    if not header.startswith(PNG_SIGNATURE):
+        raise ValueError('not a png file: ' + file)
+
+    return struct.unpack('>II', header[16:24])
+
+
+# Read width and height from the header of a png or binary ppm file.
+def read_image_size(
+        file: str) -> Tuple[int, int]:
+
+    with open(file, 'rb') as f:
+        header = f.read(64)
+    if header.startswith(b'P6'):
+        values = header.split()
+        return int(values[1]), int(values[2])
+
+    return read_png_size(file)
+
+
+# Size of a crop with geometry "WxH+X+Y" out of an image of size, clipped to
+# the image like ImageMagick does.
+def crop_size(
+        size: Tuple[int, int], geometry: str) -> Tuple[int, int]:
+
+    match = re.match(r'^(\d+)x(\d+)[+](\d+)[+](\d+)$', geometry)
+    if not match:
+        raise ValueError('wrong geometry: ' + geometry)
+    width, height, x, y = (int(value) for value in match.groups())
+    width = max(1, min(width, size[0] - x))
+    height = max(1, min(height, size[1] - y))
+
+    return width, height
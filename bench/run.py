@@ -0,0 +1,450 @@
+#!/bin/env python3
+
+# Benchmark of screenshot.py, crop.py and batch.py from start to end.  A
+# matrix of fake games, shaders and resolutions is generated in a temporary
+# folder and the real scripts are run over it, with the fake programs in
+# "bench/bin" in place of RetroArch and ImageMagick.  Each stage is run cold
+# (no outputs yet) and warm (everything up to date).  The report lists the
+# jobs per second, wall time and peak memory of every stage and can be saved
+# as json, to compare the results of different commits.
+
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import platform
+import statistics
+import subprocess
+import tempfile
+import datetime
+
+from typing import Union, Dict, List, Tuple
+
+BENCHDIR = os.path.dirname(os.path.abspath(__file__))
+REPODIR = os.path.dirname(BENCHDIR)
+# Window sizes of the generated resolutions, the first R are used.
+RESOLUTIONS = ['320x240', '640x360', '800x600', '1280x720', '1920x1080']
+# Version of the json report layout.
+REPORT_VERSION = 1
+# Options in the meta of a report, which must be the same in a comparison.
+COMPARED_OPTIONS = ['repeat', 'jobs', 'backend', 'webp', 'pipeline',
+                    'orchestrate', 'plan', 'recompress', 'format', 'delay']
+
+
+def parse_arguments() -> argparse.Namespace:
+
+    parser = argparse.ArgumentParser(
+            description='Benchmark the snapscreen scripts with fake RetroArch'
+                        ' and ImageMagick programs'
+    )
+
+    parser.add_argument(
+            '--matrix',
+            metavar='NxMxR',
+            default=[],
+            action='append',
+            help='number of games, shaders and resolutions, can be used'
+                 ' multiple times, defaults to "10x10x2"',
+    )
+
+    parser.add_argument(
+            '--repeat',
+            metavar='3',
+            default=3,
+            type=int,
+            help='run every stage this many times and report the median',
+    )
+
+    parser.add_argument(
+            '--jobs',
+            metavar='4',
+            default=4,
+            type=int,
+            help='option --jobs of screenshot.py',
+    )
+
+    parser.add_argument(
+            '--backend',
+            choices=['auto', 'pillow', 'convert'],
+            default='auto',
+            help='option --backend of crop.py',
+    )
+
+    parser.add_argument(
+            '--webp',
+            action='store_true',
+            help='run crop.py and batch.py with option --webp',
+    )
+
+    parser.add_argument(
+            '--pipeline',
+            action='store_true',
+            help='run batch.py with option --pipeline',
+    )
+
+    parser.add_argument(
+            '--async',
+            dest='orchestrate',
+            action='store_true',
+            help='run batch.py with option --async',
+    )
+
+    parser.add_argument(
+            '--plan',
+            action='store_true',
+            help='run batch.py with option --plan, the plan file is made by '
+                 'the cold run and reused by the warm run',
+    )
+
+    parser.add_argument(
+            '--recompress',
+            action='store_true',
+            help='run crop.py and batch.py with option --recompress',
+    )
+
+    parser.add_argument(
+            '--format',
+            default='png',
+            choices=['png', 'ppm'],
+            help='run screenshot.py and batch.py with this option --format',
+    )
+
+    parser.add_argument(
+            '--delay',
+            metavar='0',
+            default=0.0,
+            type=float,
+            help='seconds the fake retroarch sleeps before each screenshot',
+    )
+
+    parser.add_argument(
+            '--output',
+            metavar='"results.json"',
+            default=None,
+            help='save the results in this json file',
+    )
+
+    parser.add_argument(
+            '--compare',
+            metavar='"results.json"',
+            default=None,
+            help='compare with the results of an earlier run',
+    )
+
+    parser.add_argument(
+            '--workdir',
+            metavar='"DIR"',
+            default=None,
+            help='generate the matrix in this folder and keep it, instead of '
+                 'a temporary folder',
+    )
+
+    args = parser.parse_args()
+    if args.pipeline and args.orchestrate:
+        parser.error('--async does not work together with --pipeline')
+
+    return args
+
+
+# Split a matrix string "NxMxR" into its three numbers.
+def parse_matrix(
+        matrix: str) -> Tuple[int, int, int]:
+
+    try:
+        games, shaders, resolutions = (int(value) for value in
+                                       matrix.split('x'))
+    except ValueError:
+        raise ValueError('--matrix needs the format "NxMxR": ' + matrix)
+    if min(games, shaders, resolutions) < 1:
+        raise ValueError('--matrix accepts only 1 or higher: ' + matrix)
+    if resolutions > len(RESOLUTIONS):
+        raise ValueError('--matrix accepts only up to '
+                         + str(len(RESOLUTIONS)) + ' resolutions: ' + matrix)
+
+    return games, shaders, resolutions
+
+
+# Create all files of the matrix in workdir: a home folder with retroarch.cfg
+# and shaders, a core, game ROMs, the gamelist.ini and shaderlist.txt.  Every
+# second game has an additional crop region and every third shader is in a
+# subfolder, so all code paths of the scripts are taken.
+def generate_matrix(
+        workdir: str, games: int, shaders: int) -> None:
+
+    home = os.path.join(workdir, 'home')
+    configdir = os.path.join(home, '.config', 'retroarch')
+    shaderdir = os.path.join(configdir, 'shaders', 'shaders_slang')
+    os.makedirs(os.path.join(shaderdir, 'sub'), exist_ok=True)
+    os.makedirs(os.path.join(workdir, 'roms'), exist_ok=True)
+    with open(os.path.join(configdir, 'retroarch.cfg'), 'w') as f:
+        f.write('video_driver = "gl"\n')
+    shutil.copyfile(os.path.join(REPODIR, 'append.cfg'),
+                    os.path.join(workdir, 'append.cfg'))
+    with open(os.path.join(workdir, 'core.so'), 'w') as f:
+        f.write('core\n')
+
+    with open(os.path.join(workdir, 'gamelist.ini'), 'w') as gamelist:
+        gamelist.write('[DEFAULT]\nsize = 160x120\npos = 16+16\n\n')
+        for number in range(games):
+            rom = os.path.join(workdir, 'roms', f'game{number}.smc')
+            with open(rom, 'w') as f:
+                f.write(f'game {number}\n')
+            gamelist.write(f'[Game {number}]\n')
+            gamelist.write(f'game = {rom}\n')
+            gamelist.write('core = ' + os.path.join(workdir, 'core.so')
+                           + '\n')
+            if number % 2:
+                gamelist.write('regions = hud:64x16+0+0\n')
+            gamelist.write('\n')
+
+    with open(os.path.join(workdir, 'shaderlist.txt'), 'w') as shaderlist:
+        for number in range(shaders):
+            folder = 'sub' if number % 3 == 2 else ''
+            preset = os.path.join(shaderdir, folder, f'shader{number}.slangp')
+            with open(preset, 'w') as f:
+                f.write('shaders = "1"\n')
+                f.write(f'shader0 = "shader{number}.slang"\n')
+            with open(os.path.join(shaderdir, folder,
+                                   f'shader{number}.slang'), 'w') as f:
+                f.write(f'// shader {number}\n')
+            shaderlist.write(preset + '\n')
+
+
+# Remove all outputs and caches of earlier runs, so the next run is cold.
+def clean_outputs(
+        workdir: str) -> None:
+
+    for name in ['screenshots', 'crops', 'cache']:
+        shutil.rmtree(os.path.join(workdir, name), ignore_errors=True)
+    if os.path.exists(os.path.join(workdir, 'plan.db')):
+        os.remove(os.path.join(workdir, 'plan.db'))
+
+
+# Run a command in workdir and measure it.  Returns the wall time in seconds
+# and the peak resident memory in kilobytes of the largest process, which is
+# the script itself or any program it started.
+def measure(
+        command: List[str], workdir: str,
+        env: Dict[str, str]) -> Tuple[float, int]:
+
+    start = time.perf_counter()
+    process = subprocess.Popen(command,
+                               cwd=workdir,
+                               env=env,
+                               stdout=subprocess.DEVNULL)
+    _, status, usage = os.wait4(process.pid, 0)
+    wall = time.perf_counter() - start
+    process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0:
+        raise RuntimeError('failed with exit code '
+                           + str(process.returncode) + ': '
+                           + ' '.join(command))
+
+    return wall, usage.ru_maxrss
+
+
+# Build the commands of all stages for one matrix, as pairs of stage name and
+# command.  Each stage is listed twice, first cold and then warm.  The session
+# stage drives the fake retroarch over its network commands, see
+# screenshot.py --session.
+def build_stages(
+        args: argparse.Namespace,
+        resolutions: List[str]) -> List[Tuple[str, List[str]]]:
+
+    screenshot: List[str] = []
+    screenshot.append(sys.executable)
+    screenshot.append(os.path.join(REPODIR, 'screenshot.py'))
+    screenshot.extend(['--outputdir', 'screenshots/single'])
+    screenshot.extend(['--window', resolutions[0]])
+    screenshot.extend(['--jobs', str(args.jobs)])
+    screenshot.extend(['--format', args.format])
+    screenshot.append('--quiet')
+
+    session: List[str] = []
+    session.append(sys.executable)
+    session.append(os.path.join(REPODIR, 'screenshot.py'))
+    session.extend(['--outputdir', 'screenshots/session'])
+    session.extend(['--window', resolutions[0]])
+    session.extend(['--jobs', str(args.jobs)])
+    session.extend(['--format', args.format])
+    session.append('--session')
+    session.append('--quiet')
+
+    crop: List[str] = []
+    crop.append(sys.executable)
+    crop.append(os.path.join(REPODIR, 'crop.py'))
+    crop.extend(['--inputdir', 'screenshots/single'])
+    crop.extend(['--outputdir', 'crops/single'])
+    crop.extend(['--backend', args.backend])
+    if args.webp:
+        crop.append('--webp')
+    if args.recompress:
+        crop.append('--recompress')
+    crop.append('--quiet')
+
+    batch: List[str] = []
+    batch.append(sys.executable)
+    batch.append(os.path.join(REPODIR, 'batch.py'))
+    batch.extend(['--resolution', ','.join(resolutions)])
+    batch.extend(['--format', args.format])
+    if args.webp:
+        batch.append('--webp')
+    if args.pipeline:
+        batch.append('--pipeline')
+    if args.orchestrate:
+        batch.append('--async')
+    if args.plan:
+        batch.extend(['--plan', 'plan.db'])
+    if args.recompress:
+        batch.append('--recompress')
+
+    return [('screenshot', screenshot),
+            ('screenshot warm', screenshot),
+            ('session', session),
+            ('session warm', session),
+            ('crop', crop),
+            ('crop warm', crop),
+            ('batch', batch),
+            ('batch warm', batch)]
+
+
+# Run all stages of a matrix repeat times and get one result per stage.  The
+# wall time is the median of all runs, the memory the highest of all runs.
+def run_matrix(
+        args: argparse.Namespace, workdir: str, matrix: str) -> List[dict]:
+
+    games, shaders, count = parse_matrix(matrix)
+    resolutions = RESOLUTIONS[:count]
+    generate_matrix(workdir, games, shaders)
+    env = dict(os.environ)
+    env['HOME'] = os.path.join(workdir, 'home')
+    env['XDG_CACHE_HOME'] = os.path.join(workdir, 'cache')
+    env['PATH'] = os.path.join(BENCHDIR, 'bin') + os.pathsep + env['PATH']
+    env['FAKE_RETROARCH_DELAY'] = str(args.delay)
+
+    stages = build_stages(args, resolutions)
+    walls: Dict[str, List[float]] = {name: [] for name, _ in stages}
+    memory: Dict[str, int] = {name: 0 for name, _ in stages}
+    for _ in range(args.repeat):
+        clean_outputs(workdir)
+        for name, command in stages:
+            wall, rss = measure(command, workdir, env)
+            walls[name].append(wall)
+            memory[name] = max(memory[name], rss)
+
+    results: List[dict] = []
+    for name, _ in stages:
+        jobs = games * shaders * (count if name.startswith('batch') else 1)
+        wall = statistics.median(walls[name])
+        results.append({'matrix': matrix,
+                        'stage': name,
+                        'jobs': jobs,
+                        'wall': round(wall, 4),
+                        'jobs_per_s': round(jobs / wall, 2),
+                        'peak_rss_kb': memory[name]})
+
+    return results
+
+
+# Describe the code and machine the benchmark ran on, so results of
+# different commits can be told apart.
+def build_meta(
+        args: argparse.Namespace) -> dict:
+
+    def git(*command: str) -> str:
+        result = subprocess.run(['git', '-C', REPODIR] + list(command),
+                                capture_output=True,
+                                text=True)
+        return result.stdout.strip()
+
+    meta = {}
+    meta['version'] = REPORT_VERSION
+    meta['date'] = datetime.datetime.now().isoformat(timespec='seconds')
+    meta['commit'] = git('rev-parse', 'HEAD')
+    meta['dirty'] = bool(git('status', '--porcelain', '--untracked-files=no'))
+    meta['python'] = platform.python_version()
+    meta['platform'] = platform.platform()
+    meta['cpus'] = os.cpu_count()
+    meta['repeat'] = args.repeat
+    meta['jobs'] = args.jobs
+    meta['backend'] = args.backend
+    meta['webp'] = args.webp
+    meta['pipeline'] = args.pipeline
+    meta['orchestrate'] = args.orchestrate
+    meta['plan'] = args.plan
+    meta['recompress'] = args.recompress
+    meta['format'] = args.format
+    meta['delay'] = args.delay
+
+    return meta
+
+
+# Print the results as table.  With an earlier report, the wall time of each
+# stage is compared to the same stage and matrix in there, with a warning for
+# every option that differs between both runs.  Reports without an option
+# count it as not given.
+def print_report(
+        report: dict, previous: Union[dict, None] = None) -> None:
+
+    before: Dict[Tuple[str, str], float] = {}
+    if previous is not None:
+        print('compared to ' + previous['meta']['commit'][:12])
+        for option in COMPARED_OPTIONS:
+            old = previous['meta'].get(option, False)
+            new = report['meta'].get(option, False)
+            if old != new:
+                print(f'warning: option {option} differs: {old} before,'
+                      f' {new} now')
+        for result in previous['results']:
+            before[(result['matrix'], result['stage'])] = result['wall']
+
+    print(f'{"matrix":<10} {"stage":<16} {"jobs":>7} {"wall s":>9}'
+          f' {"jobs/s":>9} {"peak MB":>8}' + ('  change' if before else ''))
+    for result in report['results']:
+        line = (f'{result["matrix"]:<10} {result["stage"]:<16}'
+                f' {result["jobs"]:>7} {result["wall"]:>9.3f}'
+                f' {result["jobs_per_s"]:>9.1f}'
+                f' {result["peak_rss_kb"] / 1024:>8.1f}')
+        old = before.get((result['matrix'], result['stage']))
+        if old:
+            line += f'  {(result["wall"] - old) / old:+.1%}'
+        print(line)
+
+
+def main() -> int:
+
+    args = parse_arguments()
+    if args.repeat < 1:
+        raise ValueError('--repeat accepts only 1 or higher: '
+                         + str(args.repeat))
+    matrices = args.matrix or ['10x10x2']
+    for matrix in matrices:
+        parse_matrix(matrix)
+    previous = None
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            previous = json.load(f)
+
+    report = {'meta': build_meta(args), 'results': []}
+    for matrix in matrices:
+        if args.workdir:
+            workdir = os.path.abspath(os.path.join(args.workdir, matrix))
+            os.makedirs(workdir, exist_ok=True)
+            report['results'].extend(run_matrix(args, workdir, matrix))
+            continue
+        with tempfile.TemporaryDirectory(prefix='snapscreen-bench-') as tmp:
+            report['results'].extend(run_matrix(args, tmp, matrix))
+
+    print_report(report, previous)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+            f.write('\n')
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
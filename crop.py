@@ -1,22 +1,20 @@
 #!/bin/env python3
 
 import sys
-import os
-import pathlib
-import subprocess
 import argparse
-import configparser
-import re
 
-from typing import Union, Dict, List, Tuple
+from typing import Union, List
+
+import snapscreen
 
 # Shorthands for types
-Pathlib = pathlib.Path
 Argparse = argparse.Namespace
-GamelistEntry = Dict[str, Dict[str, Union[str, int, Pathlib]]]
 
 
-def parse_arguments() -> Argparse:
+# Parse all options and arguments of the program and get an argparse object.
+# Without argv the commandline of the program is used.
+def parse_arguments(
+        argv: Union[List[str], None] = None) -> Argparse:
 
     parser = argparse.ArgumentParser(
             description='Create automated crops from RetroArch screenshots'
@@ -64,6 +62,14 @@ def parse_arguments() -> Argparse:
             help='default region of the starting position',
     )
 
+    parser.add_argument(
+            '--backend',
+            choices=['auto', 'pillow', 'convert'],
+            default='auto',
+            help='crop inside Python with "pillow" or run ImageMagick'
+                 ' "convert" for each file, "auto" uses pillow if installed',
+    )
+
     parser.add_argument(
             '--force',
             action='store_true',
@@ -77,306 +83,152 @@ def parse_arguments() -> Argparse:
     )
 
     parser.add_argument(
-            '--webp',
+            '--streamcollage',
             action='store_true',
-            help='convert collages to lossless .webp format, keep the .png',
+            help='build each collage one row of tiles at a time and stream it '
+                 'into the png file, so large grids need only the memory of '
+                 'one row, requires pillow',
     )
 
     parser.add_argument(
-            '--verbose',
+            '--webp',
             action='store_true',
-            help='print additional information whats going on',
+            help='convert collages to lossless .webp format, keep the .png',
     )
 
     parser.add_argument(
-            '--quiet',
+            '--webpcrops',
             action='store_true',
-            help='do not print anything to stdout',
+            help='with --webp convert the crops too, not only the collages',
     )
 
-    args = parser.parse_args()
-
-    return args
-
-
-# Expand and resolve all parts of the file path string and make it a fullpath
-# in pathlib format.
-def path(
-        file: str) -> Pathlib:
-
-    expandedfile = os.path.expandvars(file)
-    path = pathlib.Path(expandedfile).expanduser().resolve()
-
-    return path
-
-
-# Read gamelist in INI format and get a dictionary from all game sections and
-# their keys.  Also converts each key to correct type and does basic validation
-# of all keys.
-# Note: Not all keys are used by this program, such as "slot" and "frames".
-# These are just ignored, but maybe used by other applications.
-def games_from_gamelist(
-        file: Pathlib, args: Argparse) -> GamelistEntry:
-
-    config = configparser.ConfigParser()
-    config.read(file.as_posix())
-    games: GamelistEntry = {}
-    games = {title: dict(config.items(title)) for title in config.sections()}
-
-    size_format = re.compile(r'^[1-9]\d*x[1-9]\d*$')
-    pos_format = re.compile(r'^\d+[+]\d+$')
-
-    for title in games:
-        game = path(config.get(title, 'game'))
-        core = path(config.get(title, 'core'))
-        sep = config.get(title, 'sep', fallback=args.sep)
-        size = config.get(title, 'size', fallback=args.size)
-        pos = config.get(title, 'pos', fallback=args.pos)
-
-        if not game.exists():
-            raise FileNotFoundError(game.as_posix())
-        if not core.exists():
-            raise FileNotFoundError(core.as_posix())
-        if not len(sep) == 1:
-            raise ValueError(f'{title} sep accepts only 1 character: {sep}')
-        if not size_format.match(size):
-            raise ValueError(f'{title} size has wrong format: {size}')
-        if not pos_format.match(pos):
-            raise ValueError(f'{title} pos has wrong format: {pos}')
-
-        games[title]['game'] = game
-        games[title]['core'] = core
-        games[title]['sep'] = sep
-        games[title]['size'] = size
-        games[title]['pos'] = pos
-
-    return games
-
-
-# Reads in all screenshot files created previously for use as source to create
-# the crops.
-def collect_screenshot_files(
-        inputdir: Pathlib, title: str) -> List[Pathlib]:
-
-    gamedir = pathlib.Path(inputdir / title)
-    files = [file for file in gamedir.iterdir() if file.is_file()]
-
-    return files
-
-
-def collect_files(
-        inputdir: Pathlib, pattern: str = '*'):
+    parser.add_argument(
+            '--jobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of processes for webp conversion, defaults to the'
+                 ' number of cpus',
+    )
 
-    files = [f.as_posix() for f in inputdir.glob(pattern)]
+    parser.add_argument(
+            '--recompress',
+            action='store_true',
+            help='write crops and collages with fast compression first and '
+                 'recompress them at the best lossless ratio in the '
+                 'background, which also creates the webp files, an '
+                 'interrupted run recompresses the rest when started again',
+    )
 
-    return files
+    parser.add_argument(
+            '--recompressjobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of low priority processes for --recompress, '
+                 'defaults to half the number of cpus',
+    )
 
+    parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help='hardlink crops and webp files of duplicate screenshots '
+                 'instead of making them again and show them as a single tile '
+                 'in the collage, labeled with all of their names',
+    )
 
-# Reads all cropped files and create a sorted list, with the exeption of
-# nearest and bilinear named files.  Those are always at start of list.
-def collect_crop_files(
-        inputdir: Pathlib) -> List[Pathlib]:
+    parser.add_argument(
+            '--trace',
+            metavar='"trace.jsonl"',
+            default=None,
+            help='write the timing of every crop, collage and webp '
+                 'conversion as json lines to this file and print a summary '
+                 'per stage at the end',
+    )
 
-    first: List[Pathlib] = []
-    second: List[Pathlib] = []
-    files: List[Pathlib] = []
-    for file in inputdir.iterdir():
-        if not file.is_file() or not file.suffix == '.png':
-            continue
-        elif file.stem.startswith('nearest'):
-            first.append(file)
-        elif file.stem.startswith('bilinear'):
-            second.append(file)
-        else:
-            files.append(file)
-    files.sort()
+    parser.add_argument(
+            '--journal',
+            metavar='"journal.jsonl"',
+            default=None,
+            help='add every finished crop and collage to this file, so an '
+                 'interrupted run started again with the same file skips '
+                 'them without looking at the output folder, the file is '
+                 'deleted once the run is complete',
+    )
 
-    return first + second + files
+    parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='print additional information whats going on',
+    )
 
+    parser.add_argument(
+            '--quiet',
+            action='store_true',
+            help='do not print anything to stdout',
+    )
 
-# Create a dictionary of main settings for usage in the program.  The values
-# can have any type, so due to the complexity no type checking is done.
-def build_app_settings():
+    args = parser.parse_args(argv)
 
-    args = parse_arguments()
-    settings = {}
-    settings['gamelist'] = path(args.gamelist)
-    settings['games'] = games_from_gamelist(settings['gamelist'], args)
-    settings['inputdir'] = path(args.inputdir)
-    settings['outputdir'] = path(args.outputdir)
-    settings['sep'] = args.sep
-    settings['size'] = args.size
-    settings['pos'] = args.pos
-    settings['force'] = args.force
-    settings['nocollage'] = args.nocollage
-    settings['webp'] = args.webp
-    settings['verbose'] = args.verbose
-    settings['quiet'] = args.quiet
-
-    return settings
-
-
-# Combines both size and pos to geometry, which the convert command uses as a
-# single option.
-def build_geometry(
-        games: dict, title: str) -> str:
-
-    size = games[title]['size']
-    pos = games[title]['pos']
-    geometry = size + '+' + pos
-
-    return geometry
-
-
-# Builds up the convert command to crop a screenshot.  If the file already
-# exists, then an empty list is returned.
-def build_crop_command(
-        settings: GamelistEntry, outgamedir: Pathlib, infile: Pathlib,
-        geometry: str) -> Tuple[List[str], Pathlib]:
-
-    command: List[str] = []
-    outfile = pathlib.Path(outgamedir / infile.stem)
-    outfile = outfile.with_stem(infile.stem + '-crop' + geometry + '.png')
-    if not settings['force'] and outfile.exists():
-        return command, outfile
-    command.append('convert')
-    command.append(infile.as_posix())
-    command.append('-crop')
-    command.append(geometry)
-    command.append(outfile.as_posix())
-
-    return command, outfile
-
-
-# Base command for a game collage.  It will set the standard size for all
-# images and their frame size.  It includes the main program to create the
-# collage, so this should be the first command when merging with other command
-# sets.
-def build_collage_base_command(
-        settings: dict, title: str, outfile: Pathlib) -> List[str]:
-
-    command: List[str] = []
-    if not settings['force'] and outfile.exists():
-        return command
-    command.append('montage')
-    command.append('-frame')
-    command.append('8x8')
-    command.append('-geometry')
-    command.append(settings['games'][title]['size'])
-    command.append('-title')
-    command.append(title)
-
-    return command
-
-
-# Base command to convert images into lossless webp format.
-def build_towebp_base_command() -> List[str]:
-
-    command: List[str] = []
-    command.append('mogrify')
-    command.append('-quality')
-    command.append('100%')
-    command.append('-format')
-    command.append('webp')
-    command.append('-define')
-    command.append('webp:lossless=true')
-
-    return command
-
-
-# This will build the command set for a cropfile of a specific game.  It is
-# intended to be run in a loop of game directory.
-def build_collage_game_command(
-        infile: Pathlib, sep: str) -> List[str]:
-
-    label = infile.stem.partition('-crop')[0]
-    command: List[str] = []
-    command.append('-label')
-    if label.startswith('nearest') or label.startswith('bilinear'):
-        command.append(label)
-    else:
-        command.append(label.replace(sep, ' / '))
-    command.append(infile.as_posix())
-
-    return command
+    return args
 
 
 # The fun stuff.
 def main() -> int:
 
-    settings = build_app_settings()
-
-    created_crops = 0
-    created_collages = 0
-    for title in settings['games']:
-        if not settings['quiet']:
-            if settings['verbose']:
-                print()
-            print('Processing [' + title + '] ...')
-        geometry = build_geometry(settings['games'], title)
-        outgamedir = pathlib.Path(settings['outputdir'] / title)
-        outgamedir.mkdir(parents=True, exist_ok=True)
-        screenshots = collect_screenshot_files(settings['inputdir'], title)
-        sep = settings['games'][title]['sep']
-
-        # Crop
-        for infile in screenshots:
-            crop_command, crop_file = build_crop_command(settings,
-                                                         outgamedir,
-                                                         infile,
-                                                         geometry)
-            if not crop_command:
-                continue
-            elif not settings['quiet'] and settings['verbose']:
-                print(crop_command)
-                print()
-            subprocess.run(crop_command)
-            if crop_file.exists():
-                created_crops += 1
-
-        # Collage
-        if settings['nocollage']:
-            continue
-        collage_path = pathlib.Path(settings['outputdir'].as_posix()
-                                    + '/'
-                                    + title
-                                    + '-crop-collage.png')
-        base_command = build_collage_base_command(settings,
-                                                  title,
-                                                  collage_path)
-        if not base_command:
-            continue
-
-        crops = collect_crop_files(outgamedir)
-        game_command: List[str] = []
-        for infile in crops:
-            command = build_collage_game_command(infile, sep)
-            game_command.extend(command)
-
-        collage_command: List[str] = []
-        collage_command.extend(base_command)
-        collage_command.extend(game_command)
-        collage_command.append(collage_path.as_posix())
-        if not settings['quiet'] and settings['verbose']:
-            print(collage_command)
-            print()
-        subprocess.run(collage_command)
-        if collage_path.exists():
-            created_collages += 1
-
-    if settings['webp']:
-        if not settings['quiet']:
-            if settings['verbose']:
-                print()
-            print('Processing webp conversion for collages ...')
-        towebp_command = build_towebp_base_command()
-        pngfiles = collect_files(settings['outputdir'], '*.png')
-        subprocess.run(towebp_command + pngfiles)
-
-    if not settings['quiet']:
-        print()
-        print(str(created_crops) + " crop(s) created.")
-        print(str(created_collages) + " collage(s) created.")
+    args = parse_arguments()
+    defaults = {'sep': args.sep, 'size': args.size, 'pos': args.pos}
+    games = snapscreen.games_from_gamelist(snapscreen.path(args.gamelist),
+                                           defaults)
+    trace = None
+    if args.trace:
+        trace = snapscreen.Tracer(snapscreen.path(args.trace))
+    journal = None
+    if args.journal:
+        journal = snapscreen.RunJournal(snapscreen.path(args.journal))
+    recompress = None
+    if args.recompress:
+        recompress = snapscreen.RecompressPool(args.recompressjobs)
+    # Everything is closed also on errors and Ctrl-C, so no half
+    # recompressed file is left behind and the trace is complete up to this
+    # point.  An interrupted run keeps its journal to continue with.
+    try:
+        settings = snapscreen.build_crop_settings(
+                games,
+                inputdir=args.inputdir,
+                outputdir=args.outputdir,
+                backend=args.backend,
+                force=args.force,
+                nocollage=args.nocollage,
+                streamcollage=args.streamcollage,
+                webp=args.webp,
+                webpcrops=args.webpcrops,
+                jobs=args.jobs,
+                trace=trace,
+                journal=journal,
+                dedup=args.dedup,
+                recompress=recompress,
+                verbose=args.verbose,
+                quiet=args.quiet)
+        snapscreen.crop(settings)
+        if recompress is not None:
+            if not args.quiet:
+                print('Waiting for recompression ...')
+            recompressed = recompress.close()
+            if not args.quiet:
+                print(str(recompressed) + ' file(s) recompressed.')
+        if journal is not None:
+            journal.finish()
+    finally:
+        if recompress is not None:
+            recompress.close(True)
+        if journal is not None:
+            journal.close()
+        if trace is not None:
+            trace.close()
+
+    if trace is not None and not args.quiet:
+        trace.print_summary()
 
     return 0
 
@@ -0,0 +1,130 @@
+#!/bin/env python3
+
+import sys
+import argparse
+
+from typing import Union, List
+
+import snapscreen
+
+# Shorthands for types
+Argparse = argparse.Namespace
+
+
+# Parse all options and arguments of the program and get an argparse object.
+# Without argv the commandline of the program is used.
+def parse_arguments(
+        argv: Union[List[str], None] = None) -> Argparse:
+
+    parser = argparse.ArgumentParser(
+            description='Create a static html gallery of the screenshots, '
+                        'crops and collages of batch.py'
+    )
+
+    parser.add_argument(
+            '--gamelist',
+            metavar='"gamelist.ini"',
+            default='gamelist.ini',
+            help='path to list of game profile setting',
+    )
+
+    parser.add_argument(
+            '--screenshots',
+            metavar='"screenshots/"',
+            default='screenshots/',
+            help='folder of screenshots with a subfolder for each resolution',
+    )
+
+    parser.add_argument(
+            '--crops',
+            metavar='"crops/"',
+            default='crops/',
+            help='folder of crops and collages with a subfolder for each '
+                 'resolution',
+    )
+
+    parser.add_argument(
+            '--outputdir',
+            metavar='"gallery/"',
+            default='gallery/',
+            help='output folder for the html pages and thumbnails',
+    )
+
+    parser.add_argument(
+            '--backend',
+            choices=['auto', 'pillow', 'convert'],
+            default='auto',
+            help='create thumbnails inside Python with "pillow" or run '
+                 'ImageMagick "convert", "auto" uses pillow if installed',
+    )
+
+    parser.add_argument(
+            '--force',
+            action='store_true',
+            help='force creating and overwrite existing thumbnails',
+    )
+
+    parser.add_argument(
+            '--jobs',
+            metavar='N',
+            default=None,
+            type=int,
+            help='number of processes for the thumbnails, defaults to the'
+                 ' number of cpus',
+    )
+
+    parser.add_argument(
+            '--trace',
+            metavar='"trace.jsonl"',
+            default=None,
+            help='write the timing of every thumbnail as json lines to this '
+                 'file and print a summary at the end',
+    )
+
+    parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='print additional information whats going on',
+    )
+
+    parser.add_argument(
+            '--quiet',
+            action='store_true',
+            help='do not print anything to stdout',
+    )
+
+    args = parser.parse_args(argv)
+
+    return args
+
+
+# The fun stuff.
+def main() -> int:
+
+    args = parse_arguments()
+    games = snapscreen.games_from_gamelist(snapscreen.path(args.gamelist))
+    trace = None
+    if args.trace:
+        trace = snapscreen.Tracer(snapscreen.path(args.trace))
+    settings = snapscreen.build_gallery_settings(
+            games,
+            screenshotsdir=args.screenshots,
+            cropsdir=args.crops,
+            outputdir=args.outputdir,
+            backend=args.backend,
+            force=args.force,
+            jobs=args.jobs,
+            trace=trace,
+            verbose=args.verbose,
+            quiet=args.quiet)
+    snapscreen.gallery(settings)
+    if trace is not None:
+        trace.close()
+        if not args.quiet:
+            trace.print_summary()
+
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,27 +1,20 @@
 #!/bin/env python3
 
 import sys
-import time
-import atexit
-import os
-import subprocess
-import pathlib
-import tempfile
 import argparse
-import configparser
-# import shutil
-import re
 
-from typing import Union, Dict, List, Tuple
+from typing import Union, List
+
+import snapscreen
 
 # Shorthands for types
-Pathlib = pathlib.Path
 Argparse = argparse.Namespace
-GamelistEntry = Dict[str, Dict[str, Union[str, int, Pathlib]]]
 
 
 # Parse all options and arguments of the program and get an argparse object.
-def parse_arguments() -> Argparse:
+# Without argv the commandline of the program is used.
+def parse_arguments(
+        argv: Union[List[str], None] = None) -> Argparse:
 
     parser = argparse.ArgumentParser(
             description='Create automated screenshots with RetroArch using'
@@ -120,348 +113,206 @@ def parse_arguments() -> Argparse:
     )
 
     parser.add_argument(
-            '--force',
-            action='store_true',
-            help='force creating and overwrite existing files',
+            '--timeout',
+            metavar='60',
+            default='60',
+            type=float,
+            help='seconds to wait for a screenshot until retroarch is killed '
+                 'and the try counts as failed',
     )
 
     parser.add_argument(
-            '--verbose',
-            action='store_true',
-            help='print additional information whats going on',
+            '--jobs',
+            metavar='1',
+            default='1',
+            type=int,
+            help='number of retroarch processes to run in parallel, each with '
+                 'its own temporary config file',
     )
 
     parser.add_argument(
-            '--quiet',
+            '--headless',
             action='store_true',
-            help='do not print anything to stdout',
+            help='run retroarch on virtual X servers (Xvfb) with software '
+                 'rendering instead of the desktop, one for each of the '
+                 '--jobs, sized to --window',
     )
 
-    args = parser.parse_args()
-
-    return args
-
-
-# Expand and resolve all parts of the file path string and make it a fullpath
-# in pathlib format.
-def path(
-        file: str) -> Pathlib:
-
-    expandedfile = os.path.expandvars(file)
-    path = pathlib.Path(expandedfile).expanduser().resolve()
-
-    return path
-
-
-# Create the temporary file and register it to automatically deleted when
-# entire script ends, even on crash.  The content will be filled up by the
-# configuration files.
-def create_tempconfig(
-        settings) -> Pathlib:
-
-    namedtempfile = tempfile.NamedTemporaryFile(
-            prefix='tempconfig-',
-            suffix='.cfg',
-            delete=False,
+    parser.add_argument(
+            '--stage',
+            action='store_true',
+            help='copy the core, game and save states of each game into '
+                 'memory (/dev/shm) and let retroarch run from there, the '
+                 'screenshots are written there too and moved to --outputdir '
+                 'in batches, for slow disks such as network shares',
     )
-    tempconfig = pathlib.Path(namedtempfile.name)
-    atexit.register(tempconfig.unlink, missing_ok=True)
-
-    return tempconfig
-
-
-# These settings are intended to be included on top of the config file,
-# regardless of any settings or other user configuration files.  This is mainly
-# to ensure not to overwrite main RetroArch configuration settings on exit and
-# avoid user error.
-def build_forceconfig() -> list[str]:
-
-    config: list[str] = []
-    config.append('config_save_on_exit = "false"')
-
-    return config
-
 
-def build_statesdirconfig(statesdir: Pathlib) -> list[str]:
-
-    config: list[str] = []
-
-    path = statesdir.expanduser().resolve()
-    if path.exists():
-        config.append('savestate_directory = "' + path.as_posix() + '"')
+    parser.add_argument(
+            '--nocompileconfig',
+            action='store_true',
+            help='use a full temporary copy of all config files, instead of '
+                 'a cached config with only the winning entry of each key',
+    )
 
-    print("path: ", path.as_posix())
+    parser.add_argument(
+            '--session',
+            action='store_true',
+            help='start retroarch only once per game and remote control it '
+                 'over network commands to switch shaders and take the '
+                 'screenshots',
+    )
 
-    return config
+    parser.add_argument(
+            '--port',
+            metavar='55355',
+            default='55355',
+            type=int,
+            help='first udp port for network commands in --session mode, '
+                 'each of the --jobs uses the following port',
+    )
 
+    parser.add_argument(
+            '--plan',
+            metavar='"plan.db"',
+            default=None,
+            help='keep the expanded jobs in this file and reuse them, until '
+                 'the gamelist, shaderlist or any input file changes',
+    )
 
-def build_windowconfig(window_size) -> List[str]:
+    parser.add_argument(
+            '--trace',
+            metavar='"trace.jsonl"',
+            default=None,
+            help='write the timing of every retroarch run and screenshot '
+                 'wait as json lines to this file and print a summary per '
+                 'stage at the end',
+    )
 
-    config: List[str] = []
-    (width, height) = (None, None)
+    parser.add_argument(
+            '--journal',
+            metavar='"journal.jsonl"',
+            default=None,
+            help='add every finished screenshot to this file, so an '
+                 'interrupted run started again with the same file skips '
+                 'them without looking at the output folder, the file is '
+                 'deleted once the run is complete',
+    )
 
-    if window_size:
-        if window_size == "720p":
-            (width, height) = ("1280", "720")
-        elif window_size == "1080p":
-            (width, height) = ("1920", "1080")
-        elif (window_size == "1440p"):
-            (width, height) = ("2560", "1440")
-        elif (window_size == "2160p" or window_size == "4k"):
-            (width, height) = ("3840", "2160")
-        else:
-            match = re.search(r"(\d+)[+x](\d+)", window_size)
-            if match:
-                (width, height) = match.group(1, 2)
-            else:
-                raise ValueError('Try "1920+1080" format on option --window: '
-                                 + str(window_size))
-
-        config.append('video_fullscreen = "false"')
-        config.append('video_windowed_fullscreen = "false"')
-        config.append('video_window_show_decorations = "false"')
-        config.append('video_window_custom_size_enable = "false"')
-        config.append(f'video_window_auto_width_max = "{width}"')
-        config.append(f'video_window_auto_height_max = "{height}"')
-        config.append(f'video_windowed_position_width = "{width}"')
-        config.append(f'video_windowed_position_height = "{height}"')
-
-    return config
-
-
-# Fill the temporary file with retroarch.cfg and all append.cfg config files.
-# The order of appendfiles is important, because the first one has highest
-# priority, as the options appear on top in the file.  RetroArch only reads the
-# first found option and ignores anything after.
-#
-# tempfile: final output file to be used when making screenshots
-# basefile: original retroarch.cfg
-# appendfiles: list of append.cfg files with higher priority settings
-# forceconfig: list of strings with the highest priority settings
-def fill_tempconfig_content(
-        tempfile: Pathlib,
-        basefile: Pathlib,
-        appendfiles: List[Pathlib],
-        windowsize: str,
-        statesdir: Pathlib):
-
-    forceconfig: List[str] = build_forceconfig()
-    windowconfig: List[str] = build_windowconfig(windowsize)
-    statesdirconfig: List[str] = build_statesdirconfig(statesdir)
-    with open(tempfile, 'w') as outfile:
-        for line in forceconfig:
-            outfile.write(line + '\n')
-        for line in statesdirconfig:
-            outfile.write(line + '\n')
-        for line in windowconfig:
-            outfile.write(line + '\n')
-        for file in appendfiles:
-            for line in open(file, 'r'):
-                outfile.write(line)
-        for line in open(basefile, 'r'):
-            outfile.write(line)
+    parser.add_argument(
+            '--format',
+            default='png',
+            choices=snapscreen.SCREENSHOT_FORMATS,
+            help='file format of the screenshots: png as saved by retroarch, '
+                 'or uncompressed ppm as fast input for crop.py, which reads '
+                 'the regions straight from the file',
+    )
 
-    return 0
+    parser.add_argument(
+            '--dedup',
+            action='store_true',
+            help='replace screenshots with identical pixels of a game by '
+                 'hardlinks to the first one, so the crop stage processes '
+                 'them only once',
+    )
 
+    parser.add_argument(
+            '--force',
+            action='store_true',
+            help='force creating and overwrite existing files',
+    )
 
-# Read shaderlist file and get a list of paths for each line.
-def shaders_from_shaderlist(
-        file: Pathlib) -> List[Pathlib]:
-    lines: List[Pathlib] = []
-    with open(file.as_posix()) as f:
-        lines = [path(line.rstrip('\n')) for line in f]
-    for shader in lines:
-        if not shader.exists():
-            raise FileNotFoundError(shader.as_posix())
-
-    return lines
-
-
-# Read gamelist in INI format and get a dictionary from all game sections and
-# their keys.  Also converts each key to correct type and does basic validation
-# of all keys.
-# Note: Not all keys are used by this program, such as "size" and "pos".  These
-# are just ignored, but maybe used by other applications.
-def games_from_gamelist(
-        file: Pathlib, args: Argparse) -> GamelistEntry:
-
-    config = configparser.ConfigParser()
-    config.read(file.as_posix())
-    games: GamelistEntry = {}
-    games = {title: dict(config.items(title)) for title in config.sections()}
-
-    for title in games:
-        game = path(config.get(title, 'game'))
-        core = path(config.get(title, 'core'))
-        slot = config.getint(title, 'slot', fallback=args.slot)
-        frames = config.getint(title, 'frames', fallback=args.frames)
-        sep = config.get(title, 'sep', fallback=args.sep)
-
-        if not game.exists():
-            raise FileNotFoundError(game.as_posix())
-        if not core.exists():
-            raise FileNotFoundError(core.as_posix())
-        if slot not in range(1, 10):
-            raise ValueError(f'[{title}] slot accepts only 1-9: '
-                             + str(slot))
-        if frames not in range(0, 1000):
-            raise ValueError(f'[{title}] frames accepts only 0-999: '
-                             + str(frames))
-        if not len(sep) == 1:
-            raise ValueError(f'[{title}] sep accepts only 1 character: {sep}')
-
-        games[title]['game'] = game
-        games[title]['core'] = core
-        games[title]['slot'] = slot
-        games[title]['frames'] = frames
-        games[title]['sep'] = sep
-
-    return games
-
-
-# Create a dictionary of main settings for usage in the program.  The values
-# can have any type, so due to the complexity no type checking is done.
-def build_app_settings():
+    parser.add_argument(
+            '--verbose',
+            action='store_true',
+            help='print additional information whats going on',
+    )
 
-    args = parse_arguments()
-    settings = {}
-    settings['config'] = path(args.config)
-    if args.appendconfig:
-        settings['appendconfig'] = reversed([path(file) for
-                                             file in args.appendconfig])
-    else:
-        settings['appendconfig'] = ['append.cfg']
-    settings['gamelist'] = path(args.gamelist)
-    settings['games'] = games_from_gamelist(settings['gamelist'], args)
-    settings['shaderlist'] = path(args.shaderlist)
-    settings['shaders'] = shaders_from_shaderlist(settings['shaderlist'])
-    settings['shaderdir'] = path(args.shaderdir)
-    settings['outputdir'] = path(args.outputdir)
-    settings['statesdir'] = path(args.statesdir)
-    settings['window'] = args.window
-    settings['tries'] = args.tries
-    settings['force'] = args.force
-    settings['verbose'] = args.verbose
-    settings['quiet'] = args.quiet
-    settings['tempconfig'] = create_tempconfig(settings)
-
-    return settings
-
-
-# Build up the base command for RetroArch and whats the identical for all
-# following game related commands.  As this includes the retroarch executable
-# itself, this command needs to be merged at the beginning of main command.
-def build_base_command(
-        tempconfig: Pathlib) -> List[str]:
-
-    command: List[str] = []
-    command.append('retroarch')
-    command.append('--config')
-    command.append(tempconfig.as_posix())
-    command.append('--sram-mode')
-    command.append('noload-nosave')
-    command.append('--max-frames-ss')
-    command.append('--eof-exit')
-
-    return command
-
-
-# Build up the part of the command responsible for the game specific settings
-# from the gamelist.ini file.  As this includes the path to the game ROM
-# itself, this command needs to be merged at the end of main command.
-def build_game_command(
-        game: Dict[str, Union[str, int, Pathlib]]) -> List[str]:
-
-    command: List[str] = []
-    command.append('--max-frames')
-    command.append(str(game['frames']))
-    command.append('--entryslot')
-    command.append(str(game['slot']))
-    command.append('--libretro')
-    command.append(str(game['core']))
-    command.append(str(game['game']))
-
-    return command
-
-
-# Build up the command and file path to the new screenshot to create.
-def build_screenshot_command(
-        shaderfile, title, settings) -> Tuple[List[str], Pathlib]:
-
-    path = build_screenshot_path(shaderfile,
-                                 settings['shaderdir'],
-                                 settings['outputdir'],
-                                 title,
-                                 settings['games'][title]['sep'])
-    command: List[str] = []
-    command.append('--max-frames-ss-path')
-    command.append(path.as_posix())
-
-    return command, path
-
-
-# Format and name the file path to be used as the screenshot to save.
-def build_screenshot_path(
-        shaderfile: Pathlib, shaderdir: Pathlib, outputdir: Pathlib,
-        title: str, sep: str) -> Pathlib:
-
-    relative = shaderfile.relative_to(shaderdir)
-    renamed = relative.with_suffix('.png').as_posix().replace('/', sep)
-    path = pathlib.Path(
-            outputdir.as_posix()
-            + '/' + title
-            + '/' + renamed
+    parser.add_argument(
+            '--quiet',
+            action='store_true',
+            help='do not print anything to stdout',
     )
-    path.parent.mkdir(parents=True, exist_ok=True)
 
-    return path
+    args = parser.parse_args(argv)
+
+    return args
 
 
 # The fun stuff.
 def main() -> int:
 
-    settings = build_app_settings()
-    fill_tempconfig_content(settings['tempconfig'],
-                            settings['config'],
-                            settings['appendconfig'],
-                            settings['window'],
-                            settings['statesdir'])
-    base_command = build_base_command(settings['tempconfig'])
-
-    created_screenshots = 0
-    for title in settings['games']:
-        if not settings['quiet']:
-            if settings['verbose']:
-                print()
-            print('Processing [' + title + '] ...')
-        game_command = build_game_command(settings['games'][title])
-
-        for shaderfile in settings['shaders']:
-            screenshot_command, screenshot_file = build_screenshot_command(
-                    shaderfile, title, settings)
-            command: List[str] = []
-            command.extend(base_command)
-            command.append('--set-shader')
-            command.append(shaderfile.as_posix())
-            command.extend(screenshot_command)
-            command.extend(game_command)
-            if not settings['quiet'] and settings['verbose']:
-                print()
-                print(command)
-
-            for _ in range(settings['tries']):
-                if not settings['force'] and screenshot_file.exists():
-                    break
-                time.sleep(0.2)
-                subprocess.run(command)
-                time.sleep(0.2)
-                if screenshot_file.exists():
-                    created_screenshots += 1
-                    break
-
-    if not settings['quiet']:
-        print()
-        print(str(created_screenshots) + " screenshot(s) created.")
+    args = parse_arguments()
+    defaults = {'slot': args.slot, 'frames': args.frames, 'sep': args.sep}
+    trace = None
+    if args.trace:
+        trace = snapscreen.Tracer(snapscreen.path(args.trace))
+    journal = None
+    if args.journal:
+        journal = snapscreen.RunJournal(snapscreen.path(args.journal))
+    displays = None
+    if args.headless:
+        displays = snapscreen.DisplayPool(
+                args.jobs, snapscreen.parse_window_size(args.window))
+    staging = None
+    if args.stage:
+        staging = snapscreen.StagingArea()
+    plan = None
+    # Everything is closed also on errors and Ctrl-C, so no virtual X server
+    # or staged file in memory is left behind and the trace is complete up to
+    # this point.  An interrupted run keeps its journal to continue with.
+    try:
+        if args.plan:
+            plan = snapscreen.JobPlan(snapscreen.path(args.plan))
+            games, shaders = plan.load(snapscreen.path(args.gamelist),
+                                       snapscreen.path(args.shaderlist),
+                                       defaults)
+        else:
+            games = snapscreen.games_from_gamelist(
+                    snapscreen.path(args.gamelist), defaults)
+            shaders = snapscreen.shaders_from_shaderlist(
+                    snapscreen.path(args.shaderlist))
+        settings = snapscreen.build_capture_settings(
+                games,
+                shaders,
+                config=args.config,
+                appendconfig=args.appendconfig,
+                shaderdir=args.shaderdir,
+                outputdir=args.outputdir,
+                statesdir=args.statesdir,
+                window=args.window,
+                tries=args.tries,
+                timeout=args.timeout,
+                jobs=args.jobs,
+                compileconfig=not args.nocompileconfig,
+                session=args.session,
+                port=args.port,
+                plan=plan,
+                trace=trace,
+                journal=journal,
+                displays=displays,
+                staging=staging,
+                dedup=args.dedup,
+                format=args.format,
+                force=args.force,
+                verbose=args.verbose,
+                quiet=args.quiet)
+        snapscreen.capture(settings)
+        if journal is not None:
+            journal.finish()
+    finally:
+        if journal is not None:
+            journal.close()
+        if displays is not None:
+            displays.close()
+        if staging is not None:
+            staging.close()
+        if plan is not None:
+            plan.close()
+        if trace is not None:
+            trace.close()
+
+    if trace is not None and not args.quiet:
+        trace.print_summary()
 
     return 0
 
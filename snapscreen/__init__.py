@@ -0,0 +1,46 @@
+# snapscreen: automated screenshots of RetroArch games with a list of shaders,
+# plus crops and collages of them.  The scripts screenshot.py, crop.py,
+# gallery.py and batch.py are thin commandline wrappers around these
+# functions.
+
+from .common import path
+from .gamelist import (GAMELIST_DEFAULTS, games_from_gamelist,
+                       shaders_from_shaderlist)
+from .screenshots import build_capture_settings, capture
+from .crops import build_crop_settings, crop
+from .gallery import build_gallery_settings, gallery
+from .pipeline import run_pipeline
+from .orchestrator import build_stage_limits, run_orchestrator
+from .plan import JobPlan
+from .trace import Tracer
+from .journal import JOURNAL_FILE, RunJournal
+from .config import parse_window_size
+from .display import DisplayPool
+from .staging import StagingArea
+from .frames import SCREENSHOT_FORMATS
+from .recompress import RecompressPool
+
+__all__ = [
+    'path',
+    'GAMELIST_DEFAULTS',
+    'games_from_gamelist',
+    'shaders_from_shaderlist',
+    'build_capture_settings',
+    'capture',
+    'build_crop_settings',
+    'crop',
+    'build_gallery_settings',
+    'gallery',
+    'run_pipeline',
+    'build_stage_limits',
+    'run_orchestrator',
+    'JobPlan',
+    'Tracer',
+    'JOURNAL_FILE',
+    'RunJournal',
+    'parse_window_size',
+    'DisplayPool',
+    'StagingArea',
+    'SCREENSHOT_FORMATS',
+    'RecompressPool',
+]
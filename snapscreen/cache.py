@@ -0,0 +1,148 @@
+# Content hash based build cache, shared by all stages.
+
+import os
+import pathlib
+import threading
+import json
+
+from typing import Union, Dict
+
+from .common import Pathlib, hash_file
+from .journal import RunJournal
+
+# Name of the file in the output folder, which keeps track of the inputs used
+# to create each output file.
+CACHE_MANIFEST = '.snapscreen-cache.json'
+
+
+# Keeps track of the inputs each output file was created from, so only outputs
+# with changed inputs are created again.  For every output a key is saved,
+# which is a hash over all of its inputs.  The manifest is saved as a json file
+# in the output folder.  Checksums of input files are remembered together with
+# their size and modification time, so unchanged files are not read again on
+# the next run.  Existing outputs without a recorded key, such as the ones
+# from a time before the manifest, are created again.  With a journal, every
+# recorded output is also added to it, and outputs the journal has as finished
+# are accepted without looking at the file.  The pixel checksums of images are
+# kept by the checksum of their content for the dedup stage, see
+# find_pixel_digest().  Outputs written again at a better compression level
+# are marked with their key, see RecompressPool.
+class BuildCache:
+
+    def __init__(
+            self, outputdir: Pathlib,
+            journal: Union[RunJournal, None] = None):
+
+        self.outputdir = outputdir
+        self.journal = journal
+        self.file = pathlib.Path(outputdir / CACHE_MANIFEST)
+        self.lock = threading.Lock()
+        self.artifacts: Dict[str, str] = {}
+        self.files: Dict[str, list] = {}
+        self.pixels: Dict[str, str] = {}
+        self.compressed: Dict[str, str] = {}
+        try:
+            with open(self.file, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            self.artifacts = manifest.get('artifacts', {})
+            self.files = manifest.get('files', {})
+            self.pixels = manifest.get('pixels', {})
+            self.compressed = manifest.get('compressed', {})
+        except (FileNotFoundError, ValueError):
+            pass
+
+    # Checksum of a file, only read if it changed since the last time.
+    # Missing files get an empty checksum, so they are part of the key too.
+    def file_digest(
+            self, file: Pathlib) -> str:
+
+        try:
+            stat = file.stat()
+        except FileNotFoundError:
+            return ''
+        name = file.as_posix()
+        with self.lock:
+            known = self.files.get(name)
+        if known and known[0] == stat.st_size and known[1] == stat.st_mtime_ns:
+            return known[2]
+        digest = hash_file(file)
+        with self.lock:
+            self.files[name] = [stat.st_size, stat.st_mtime_ns, digest]
+
+        return digest
+
+    # True if the output exists and was created from inputs with this key.
+    def is_current(
+            self, outfile: Pathlib, key: str) -> bool:
+
+        name = outfile.relative_to(self.outputdir).as_posix()
+        if self.journal is not None and self.journal.is_done(outfile, key):
+            with self.lock:
+                self.artifacts[name] = key
+            return True
+        if not outfile.exists():
+            return False
+
+        return self.recorded_key(outfile) == key
+
+    # Get the key the output was created with, if it was recorded.
+    def recorded_key(
+            self, outfile: Pathlib) -> Union[str, None]:
+
+        name = outfile.relative_to(self.outputdir).as_posix()
+        with self.lock:
+            return self.artifacts.get(name)
+
+    # Remember the key of a newly created output.
+    def record(
+            self, outfile: Pathlib, key: str) -> None:
+
+        name = outfile.relative_to(self.outputdir).as_posix()
+        with self.lock:
+            self.artifacts[name] = key
+            self.compressed.pop(name, None)
+        if self.journal is not None:
+            self.journal.record(outfile, key)
+
+    # Forget an output, which was deleted.
+    def forget(
+            self, outfile: Pathlib) -> None:
+
+        name = outfile.relative_to(self.outputdir).as_posix()
+        with self.lock:
+            self.artifacts.pop(name, None)
+            self.compressed.pop(name, None)
+
+    # True if the output was recompressed after it was created with its
+    # current key.
+    def is_compressed(
+            self, outfile: Pathlib) -> bool:
+
+        name = outfile.relative_to(self.outputdir).as_posix()
+        with self.lock:
+            key = self.artifacts.get(name)
+            return key is not None and self.compressed.get(name) == key
+
+    # Remember that the output was recompressed.
+    def mark_compressed(
+            self, outfile: Pathlib) -> None:
+
+        name = outfile.relative_to(self.outputdir).as_posix()
+        with self.lock:
+            if name in self.artifacts:
+                self.compressed[name] = self.artifacts[name]
+
+    def save(self) -> None:
+
+        self.outputdir.mkdir(parents=True, exist_ok=True)
+        tempfile = self.file.with_name(self.file.name + '.tmp')
+        with self.lock:
+            manifest = {'artifacts': self.artifacts, 'files': self.files}
+            if self.pixels:
+                manifest['pixels'] = self.pixels
+            if self.compressed:
+                manifest['compressed'] = self.compressed
+            with open(tempfile, 'w', encoding='utf-8') as f:
+                json.dump(manifest, f, indent=0, sort_keys=True,
+                          ensure_ascii=False)
+        os.replace(tempfile, self.file)
@@ -0,0 +1,70 @@
+# Shared helpers and type shorthands of the snapscreen package.
+
+import os
+import pathlib
+import hashlib
+
+from typing import Union, Dict
+
+# Shorthands for types
+Pathlib = pathlib.Path
+GamelistEntry = Dict[str, Dict[str, Union[str, int, Pathlib]]]
+
+
+# Expand and resolve all parts of the file path string and make it a fullpath
+# in pathlib format.
+def path(
+        file: str) -> Pathlib:
+
+    expandedfile = os.path.expandvars(file)
+    path = pathlib.Path(expandedfile).expanduser().resolve()
+
+    return path
+
+
+# Get the sha256 checksum of a file content.
+def hash_file(
+        file: Pathlib) -> str:
+
+    digest = hashlib.sha256()
+    with open(file, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+
+    return digest.hexdigest()
+
+
+# Get the temporary name an output file is written under, until it is
+# complete and renamed to its final name with finish_partial().  It is hidden
+# and keeps the extension, so the programs writing it choose the right image
+# format.
+def partial_path(
+        file: Pathlib) -> Pathlib:
+
+    return file.with_name('.' + file.stem + '.partial' + file.suffix)
+
+
+# Rename the partial file of an output to its final name in one step, so a
+# half written file never shows up under the final name.  If ok is False, the
+# partial file is deleted instead.  Returns True if the output was renamed.
+def finish_partial(
+        file: Pathlib, ok: bool = True) -> bool:
+
+    partial = partial_path(file)
+    if not ok:
+        partial.unlink(missing_ok=True)
+        return False
+    try:
+        os.replace(partial, file)
+    except FileNotFoundError:
+        return False
+
+    return True
+
+
+# True for hidden files, such as partial outputs and the manifests in the
+# output folders, which are no input for any stage.
+def is_hidden(
+        file: Pathlib) -> bool:
+
+    return file.name.startswith('.')
@@ -0,0 +1,261 @@
+# Temporary RetroArch configuration files used for the screenshots.
+
+import os
+import atexit
+import pathlib
+import tempfile
+import shutil
+import re
+import queue
+import hashlib
+
+from typing import Union, Dict, List, Tuple
+
+from .common import Pathlib, path
+
+# A "key = value" line of a RetroArch configuration file.  Comments and
+# directives such as "#include" start with a hash character.
+CONFIG_LINE = re.compile(r'^\s*([^#\s=][^\s=]*)\s*=\s*(.*?)\s*$')
+
+
+# Create the temporary file and register it to automatically deleted when
+# entire script ends, even on crash.  The content will be filled up by the
+# configuration files.
+def create_tempconfig(
+        settings) -> Pathlib:
+
+    namedtempfile = tempfile.NamedTemporaryFile(
+            prefix='tempconfig-',
+            suffix='.cfg',
+            delete=False,
+    )
+    tempconfig = pathlib.Path(namedtempfile.name)
+    atexit.register(tempconfig.unlink, missing_ok=True)
+
+    return tempconfig
+
+
+# These settings are intended to be included on top of the config file,
+# regardless of any settings or other user configuration files.  This is mainly
+# to ensure not to overwrite main RetroArch configuration settings on exit and
+# avoid user error.
+def build_forceconfig() -> list[str]:
+
+    config: list[str] = []
+    config.append('config_save_on_exit = "false"')
+
+    return config
+
+
+def build_statesdirconfig(statesdir: Pathlib) -> list[str]:
+
+    config: list[str] = []
+
+    path = statesdir.expanduser().resolve()
+    if path.exists():
+        config.append('savestate_directory = "' + path.as_posix() + '"')
+
+    return config
+
+
+# Get width and height of the window size from option --window, which is
+# either a name like "1080p" or "4k", or a size like "1920+1080".  None if no
+# size is given.
+def parse_window_size(
+        window_size: Union[str, None]) -> Union[Tuple[int, int], None]:
+
+    if not window_size:
+        return None
+    if window_size == "720p":
+        return (1280, 720)
+    elif window_size == "1080p":
+        return (1920, 1080)
+    elif (window_size == "1440p"):
+        return (2560, 1440)
+    elif (window_size == "2160p" or window_size == "4k"):
+        return (3840, 2160)
+
+    match = re.search(r"(\d+)[+x](\d+)", window_size)
+    if not match:
+        raise ValueError('Try "1920+1080" format on option --window: '
+                         + str(window_size))
+
+    return (int(match.group(1)), int(match.group(2)))
+
+
+def build_windowconfig(window_size) -> List[str]:
+
+    config: List[str] = []
+    size = parse_window_size(window_size)
+
+    if size:
+        (width, height) = size
+        config.append('video_fullscreen = "false"')
+        config.append('video_windowed_fullscreen = "false"')
+        config.append('video_window_show_decorations = "false"')
+        config.append('video_window_custom_size_enable = "false"')
+        config.append(f'video_window_auto_width_max = "{width}"')
+        config.append(f'video_window_auto_height_max = "{height}"')
+        config.append(f'video_windowed_position_width = "{width}"')
+        config.append(f'video_windowed_position_height = "{height}"')
+
+    return config
+
+
+# Fill the temporary file with retroarch.cfg and all append.cfg config files.
+# The order of appendfiles is important, because the first one has highest
+# priority, as the options appear on top in the file.  RetroArch only reads the
+# first found option and ignores anything after.
+#
+# tempfile: final output file to be used when making screenshots
+# basefile: original retroarch.cfg
+# appendfiles: list of append.cfg files with higher priority settings
+# forceconfig: list of strings with the highest priority settings
+def fill_tempconfig_content(
+        tempfile: Pathlib,
+        basefile: Pathlib,
+        appendfiles: List[Pathlib],
+        windowsize: str,
+        statesdir: Pathlib):
+
+    forceconfig: List[str] = build_forceconfig()
+    windowconfig: List[str] = build_windowconfig(windowsize)
+    statesdirconfig: List[str] = build_statesdirconfig(statesdir)
+    with open(tempfile, 'w') as outfile:
+        for line in forceconfig:
+            outfile.write(line + '\n')
+        for line in statesdirconfig:
+            outfile.write(line + '\n')
+        for line in windowconfig:
+            outfile.write(line + '\n')
+        for file in appendfiles:
+            for line in open(file, 'r'):
+                outfile.write(line)
+        for line in open(basefile, 'r'):
+            outfile.write(line)
+
+    return 0
+
+
+# Merge all configuration layers into a minimal configuration, which only
+# contains the winning entry of every key.  The layers are read in the same
+# order as fill_tempconfig_content() writes them: force, statesdir, window,
+# appendfiles and then basefile.  As RetroArch only reads the first found
+# option, the first entry of a key wins and all following ones are dropped.
+# Directives such as "#include" are kept, everything else like comments and
+# empty lines is removed.
+def build_compiled_config(
+        basefile: Pathlib,
+        appendfiles: List[Pathlib],
+        windowsize: str,
+        statesdir: Pathlib) -> str:
+
+    lines: List[str] = []
+    lines.extend(build_forceconfig())
+    lines.extend(build_statesdirconfig(statesdir))
+    lines.extend(build_windowconfig(windowsize))
+    for file in list(appendfiles) + [basefile]:
+        with open(file, 'r') as f:
+            lines.extend(f.read().splitlines())
+
+    entries: Dict[str, str] = {}
+    directives: List[str] = []
+    for line in lines:
+        match = CONFIG_LINE.match(line)
+        if match:
+            entries.setdefault(match.group(1), match.group(2))
+        elif line.startswith('#include'):
+            directives.append(line.strip())
+
+    content = ''.join(key + ' = ' + value + '\n'
+                      for key, value in entries.items())
+    content += ''.join(line + '\n' for line in directives)
+
+    return content
+
+
+# Folder to keep compiled configuration files, so they are reused between
+# runs.
+def build_config_cachedir() -> Pathlib:
+
+    cachedir = path(os.environ.get('XDG_CACHE_HOME') or '~/.cache')
+    cachedir = pathlib.Path(cachedir / 'snapscreen')
+
+    return cachedir
+
+
+# Write the compiled configuration into the cache folder, named after the hash
+# of its content.  If the file already exists from an earlier run or another
+# process, then it is used as it is.  These files are never changed after
+# creation, so all RetroArch processes can share the same one.
+def write_compiled_config(
+        content: str) -> Pathlib:
+
+    digest = hashlib.sha256(content.encode()).hexdigest()
+    cachedir = build_config_cachedir()
+    config = pathlib.Path(cachedir / ('config-' + digest[:32] + '.cfg'))
+    if config.exists():
+        return config
+
+    cachedir.mkdir(parents=True, exist_ok=True)
+    namedtempfile = tempfile.NamedTemporaryFile(
+            mode='w',
+            dir=cachedir,
+            prefix='.config-',
+            suffix='.tmp',
+            delete=False,
+    )
+    with namedtempfile as f:
+        f.write(content)
+    os.replace(namedtempfile.name, config)
+
+    return config
+
+
+# Every parallel job needs its own temporary config file, so no two RetroArch
+# processes share one.  The content is identical, so only the first one is
+# filled up and then copied over to all others.  The returned queue is used by
+# the jobs to borrow and give back a tempconfig.  With a compiled
+# configuration all jobs share the same read only file from the cache.  With
+# a StagingArea, they share a compiled configuration in there instead, which
+# points to its statesdir.
+def fill_tempconfigs(
+        settings) -> queue.Queue:
+
+    tempconfigs: queue.Queue = queue.Queue()
+    if settings['staging'] is not None:
+        config = settings['staging'].write_config(build_compiled_config(
+                settings['config'],
+                settings['appendconfig'],
+                settings['window'],
+                settings['staging'].statesdir))
+        for _ in range(settings['jobs']):
+            tempconfigs.put(config)
+        return tempconfigs
+    if settings['compileconfig']:
+        config = write_compiled_config(settings['configcontent'])
+        for _ in range(settings['jobs']):
+            tempconfigs.put(config)
+        return tempconfigs
+
+    first = settings['tempconfigs'][0]
+    fill_tempconfig_content(first,
+                            settings['config'],
+                            settings['appendconfig'],
+                            settings['window'],
+                            settings['statesdir'])
+    for tempconfig in settings['tempconfigs']:
+        if tempconfig != first:
+            shutil.copyfile(first, tempconfig)
+        tempconfigs.put(tempconfig)
+
+    return tempconfigs
+
+
+# Delete the tempconfigs of settings right away, instead of waiting for the
+# end of the script, such as after a cancelled run.
+def remove_tempconfigs(
+        settings) -> None:
+
+    for tempconfig in settings['tempconfigs']:
+        tempconfig.unlink(missing_ok=True)
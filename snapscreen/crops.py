@@ -0,0 +1,1278 @@
+# Crop stage: cut regions out of the screenshots, lay them out in collages and
+# convert them to webp.
+
+import os
+import time
+import pathlib
+import tempfile
+import subprocess
+import re
+import math
+import hashlib
+import concurrent.futures
+
+from typing import Union, Dict, List, Tuple
+
+from .common import (Pathlib, GamelistEntry, path, partial_path,
+                     finish_partial, is_hidden)
+from .cache import BuildCache
+from .journal import RunJournal
+from .trace import Tracer, file_size
+from .frames import FrameFile
+from .pngstream import PngStream, Segment, write_png, decode_segment
+from .dedup import (DuplicateIndex, group_duplicates, split_linked_files,
+                    link_file, find_pixel_digest)
+from .recompress import FAST_COMPRESSION, RecompressPool
+from .layout import (Tile, build_tile_boxes, save_collage_layout,
+                     load_collage_layout, load_collage_strips,
+                     remove_collage_layout)
+
+# Pillow is optional and only needed for the builtin backend.  Without it, the
+# ImageMagick commands are used.
+try:
+    from PIL import Image, ImageDraw, ImageFont, features
+except ImportError:
+    Image = None
+
+# Layout of the builtin collage, similar to ImageMagick montage with options
+# "-frame 8x8" and "-title".
+FRAME_WIDTH = 8
+LABEL_FONT_SIZE = 14
+TITLE_FONT_SIZE = 28
+BACKGROUND_COLOR = (255, 255, 255)
+FRAME_COLOR = (189, 189, 189)
+FRAME_LIGHT_COLOR = (223, 223, 223)
+FRAME_SHADOW_COLOR = (125, 125, 125)
+TEXT_COLOR = (0, 0, 0)
+
+
+# Reads in all screenshot files created previously for use as source to create
+# the crops.  Hidden files, such as partial screenshots, are left out.
+def collect_screenshot_files(
+        inputdir: Pathlib, title: str) -> List[Pathlib]:
+
+    gamedir = pathlib.Path(inputdir / title)
+    files = [file for file in gamedir.iterdir()
+             if file.is_file() and not is_hidden(file)]
+
+    return files
+
+
+# Reads all cropped files and create a sorted list, with the exeption of
+# nearest and bilinear named files.  Those are always at start of list.
+def collect_crop_files(
+        inputdir: Pathlib) -> List[Pathlib]:
+
+    first: List[Pathlib] = []
+    second: List[Pathlib] = []
+    files: List[Pathlib] = []
+    for file in inputdir.iterdir():
+        if (not file.is_file() or not file.suffix == '.png'
+                or is_hidden(file)):
+            continue
+        elif file.stem.startswith('nearest'):
+            first.append(file)
+        elif file.stem.startswith('bilinear'):
+            second.append(file)
+        else:
+            files.append(file)
+    files.sort()
+
+    return first + second + files
+
+
+# Resolve the backend name to the one actually in use.
+def build_backend(
+        backend: str) -> str:
+
+    if backend == 'auto':
+        backend = 'convert' if Image is None else 'pillow'
+    elif backend == 'pillow' and Image is None:
+        raise ValueError('--backend pillow requires the Python module Pillow')
+
+    return backend
+
+
+# Combines both size and pos to geometry, which the convert command uses as a
+# single option.
+def build_geometry(
+        games: dict, title: str) -> str:
+
+    size = games[title]['size']
+    pos = games[title]['pos']
+    geometry = size + '+' + pos
+
+    return geometry
+
+
+# Get all regions to crop from each screenshot of a game by their name.  The
+# region from size and pos is always included with an empty name and its crops
+# are saved directly in the game folder.  Additional named regions from the
+# gamelist key "regions" are saved in a subfolder of the same name.
+def build_regions(
+        games: dict, title: str) -> Dict[str, str]:
+
+    regions: Dict[str, str] = {}
+    regions[''] = build_geometry(games, title)
+    regions.update(games[title]['regions'])
+
+    return regions
+
+
+# Format and name the file path of the crop to create from a screenshot.
+def build_crop_path(
+        outgamedir: Pathlib, infile: Pathlib, geometry: str) -> Pathlib:
+
+    outfile = pathlib.Path(outgamedir / infile.stem)
+    outfile = outfile.with_stem(infile.stem + '-crop' + geometry + '.png')
+
+    return outfile
+
+
+# Get the options for Pillow to save a png file at the zlib level
+# compression, or at its default level if None.
+def build_png_options(
+        compression: Union[int, None]) -> dict:
+
+    if compression is None:
+        return {}
+
+    return {'compress_level': compression}
+
+
+# Builds up the convert command to crop a screenshot into one or more crop
+# files, each given as a pair of output file and geometry.  The screenshot is
+# read only once, even if multiple crops are created.  The crops are written
+# at the zlib level compression, if given.
+def build_crop_command(
+        infile: Pathlib, crops: List[Tuple[Pathlib, str]],
+        compression: Union[int, None] = None) -> List[str]:
+
+    command: List[str] = []
+    command.append('convert')
+    command.append(infile.as_posix())
+    if compression is not None:
+        command.append('-define')
+        command.append('png:compression-level=' + str(compression))
+    if len(crops) == 1:
+        (outfile, geometry) = crops[0]
+        command.append('-crop')
+        command.append(geometry)
+        command.append(outfile.as_posix())
+        return command
+
+    for outfile, geometry in crops:
+        command.append('(')
+        command.append('+clone')
+        command.append('-crop')
+        command.append(geometry)
+        command.append('-write')
+        command.append(outfile.as_posix())
+        command.append('+delete')
+        command.append(')')
+    command.append('null:')
+
+    return command
+
+
+# Convert the geometry string "WxH+X+Y" into a box of left, upper, right and
+# lower pixel coordinates.  Like ImageMagick, the box is clipped to the image
+# size instead of padding the area outside.
+def geometry_to_box(
+        geometry: str, width: int, height: int) -> Tuple[int, int, int, int]:
+
+    match = re.match(r'^(\d+)x(\d+)\+(\d+)\+(\d+)$', geometry)
+    if not match:
+        raise ValueError('geometry has wrong format: ' + geometry)
+    (w, h, x, y) = (int(value) for value in match.group(1, 2, 3, 4))
+    box = (min(x, width), min(y, height), min(x + w, width), min(y + h, height))
+
+    return box
+
+
+# Crop a screenshot inside this process with Pillow into one or more crop
+# files, each given as a pair of output file and geometry.  The screenshot is
+# decoded only once and all crops are cut from the same image in memory.
+# If a buffers dictionary is given, the cropped images are kept in it by their
+# file path, so the collage can use them without reading the files again.
+# Each crop is saved under its partial name and renamed once complete, at
+# the zlib level compression if given.  Returns the number of created crops,
+# regions lying completely outside the screenshot are skipped.
+def crop_image(
+        infile: Pathlib, crops: List[Tuple[Pathlib, str]],
+        buffers: Union[dict, None] = None,
+        compression: Union[int, None] = None) -> int:
+
+    created = 0
+    with Image.open(infile) as image:
+        image.load()
+        for outfile, geometry in crops:
+            box = geometry_to_box(geometry, image.width, image.height)
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+            crop = image.crop(box)
+            crop.save(partial_path(outfile),
+                      **build_png_options(compression))
+            finish_partial(outfile)
+            if buffers is not None:
+                buffers[outfile] = crop
+            created += 1
+
+    return created
+
+
+# Crop a ppm screenshot from the capture stage into one or more crop files,
+# like crop_image().  The screenshot is mapped into memory and each region is
+# read straight from it, without decoding the whole image first.  The crops
+# are encoded with Pillow if installed, otherwise with zlib.
+def crop_frame(
+        infile: Pathlib, crops: List[Tuple[Pathlib, str]],
+        buffers: Union[dict, None] = None,
+        compression: Union[int, None] = None) -> int:
+
+    created = 0
+    with FrameFile(infile) as frame:
+        for outfile, geometry in crops:
+            box = geometry_to_box(geometry, frame.width, frame.height)
+            if box[0] >= box[2] or box[1] >= box[3]:
+                continue
+            if Image is None:
+                write_png(partial_path(outfile),
+                          box[2] - box[0],
+                          box[3] - box[1],
+                          frame.rows(box),
+                          compression)
+            else:
+                with frame.image(box) as crop:
+                    crop.save(partial_path(outfile),
+                              **build_png_options(compression))
+                    if buffers is not None:
+                        buffers[outfile] = crop.copy()
+            finish_partial(outfile)
+            created += 1
+
+    return created
+
+
+# Get the font to write labels and titles in the builtin collage.  Newer
+# Pillow versions can scale the builtin font, older ones have a fixed size.
+def load_font(
+        size: int):
+
+    try:
+        return ImageFont.load_default(size=size)
+    except TypeError:
+        return ImageFont.load_default()
+
+
+# Draw a raised frame with the given outer box, like montage does.
+def draw_frame(
+        draw, box: Tuple[int, int, int, int]) -> None:
+
+    (left, top, right, bottom) = box
+    draw.rectangle(box, fill=FRAME_COLOR)
+    for i in range(FRAME_WIDTH // 2):
+        draw.line([(left + i, bottom - i), (left + i, top + i),
+                   (right - i, top + i)], fill=FRAME_LIGHT_COLOR)
+        draw.line([(left + i, bottom - i), (right - i, bottom - i),
+                   (right - i, top + i)], fill=FRAME_SHADOW_COLOR)
+
+
+# Draw text horizontally centered between left and right at the top position.
+def draw_centered_text(
+        draw, text: str, font, left: int, right: int, top: int) -> None:
+
+    bbox = draw.textbbox((0, 0), text, font=font)
+    x = left + (right - left - (bbox[2] - bbox[0])) // 2 - bbox[0]
+    draw.text((x, top - bbox[1]), text, font=font, fill=TEXT_COLOR)
+
+
+# Get the layout of the builtin collage for count tiles of size, as
+# dictionary with the number of columns and rows and the width and height of
+# a tile and the title.
+def build_collage_layout(
+        size: str, count: int) -> Dict[str, int]:
+
+    (width, height) = (int(value) for value in size.split('x'))
+    columns = math.ceil(math.sqrt(count))
+    layout: Dict[str, int] = {}
+    layout['width'] = width
+    layout['height'] = height
+    layout['columns'] = columns
+    layout['rows'] = math.ceil(count / columns)
+    layout['tile_width'] = width + 2 * FRAME_WIDTH
+    layout['tile_height'] = height + LABEL_FONT_SIZE + 6 + 2 * FRAME_WIDTH
+    layout['title_height'] = TITLE_FONT_SIZE + 16
+
+    return layout
+
+
+# Draw a single tile of the builtin collage with its frame, the image of
+# file and the label below it, at left and top of the canvas.  The image is
+# taken from buffers if found there, otherwise read from disk.
+def draw_collage_tile(
+        canvas, draw, layout: Dict[str, int], file: Pathlib, label: str,
+        font, left: int, top: int, buffers: dict) -> None:
+
+    (width, height) = (layout['width'], layout['height'])
+    draw_frame(draw, (left, top,
+                      left + layout['tile_width'] - 1,
+                      top + layout['tile_height'] - 1))
+    image = buffers.get(file)
+    if image is None:
+        image = Image.open(file)
+    if image.width > width or image.height > height:
+        image = image.copy()
+        image.thumbnail((width, height))
+    canvas.paste(image.convert('RGB'),
+                 (left + FRAME_WIDTH + (width - image.width) // 2,
+                  top + FRAME_WIDTH + (height - image.height) // 2))
+    draw_centered_text(draw,
+                       label,
+                       font,
+                       left,
+                       left + layout['tile_width'],
+                       top + FRAME_WIDTH + height + 3)
+
+
+# Builtin replacement for the montage command.  All crops are laid out in a
+# grid as tiles of the given size, each with a frame and a label below the
+# image, and the title on top.  The order of the tiles is the order of the
+# files.  The canvas for the entire collage is allocated once and all tiles
+# are drawn into it directly.  Crops found in buffers are taken from memory
+# instead of being read from disk again.  Like the crops, the collage is
+# renamed from its partial name once complete.  Labels found in labels replace
+# the ones made from the file names.  The collage is saved at the zlib level
+# compression, if given.
+def create_collage(
+        title: str, size: str, files: List[Pathlib], sep: str,
+        outfile: Pathlib, buffers: Union[dict, None] = None,
+        labels: Union[Dict[Pathlib, str], None] = None,
+        compression: Union[int, None] = None) -> bool:
+
+    if not files:
+        return False
+    buffers = buffers or {}
+    labels = labels or {}
+    layout = build_collage_layout(size, len(files))
+    boxes = build_tile_boxes(layout, len(files))
+    labelfont = load_font(LABEL_FONT_SIZE)
+    titlefont = load_font(TITLE_FONT_SIZE)
+
+    canvas = Image.new('RGB',
+                       (layout['columns'] * layout['tile_width'],
+                        layout['title_height']
+                        + layout['rows'] * layout['tile_height']),
+                       BACKGROUND_COLOR)
+    draw = ImageDraw.Draw(canvas)
+    draw_centered_text(draw, title, titlefont, 0, canvas.width, 8)
+
+    for index, file in enumerate(files):
+        draw_collage_tile(canvas,
+                          draw,
+                          layout,
+                          file,
+                          labels.get(file) or build_collage_label(file, sep),
+                          labelfont,
+                          boxes[index][0],
+                          boxes[index][1],
+                          buffers)
+
+    canvas.save(partial_path(outfile), **build_png_options(compression))
+
+    return finish_partial(outfile)
+
+
+# Write the rows of pixels of a Pillow image into a PngStream.
+def stream_image(
+        png: PngStream, image) -> None:
+
+    data = image.tobytes()
+    stride = image.width * 3
+    for start in range(0, len(data), stride):
+        png.write_row(data[start:start + stride])
+
+
+# Like create_collage(), but the collage is put together one row of tiles at
+# a time and each finished row is streamed into the png file, so only a
+# single row of tiles and the tile being drawn are ever in memory, no matter
+# how large the grid is.  The tiles are always read from disk.  The result
+# looks the same as the one of create_collage().  Each row, and the title, is
+# a separate segment of the png data.  With previous, the layout sidecar of
+# the existing collage in outfile, rows with the same tiles as one of the old
+# collage are copied over in compressed form, and tiles found anywhere in the
+# old collage are copied from its decoded row.  Only the other tiles are read
+# and drawn again.  The keys of the crops, in the order of files, tell which
+# tiles are the same.  Returns the stream for the sidecar, see
+# save_collage_layout(), or None if no collage was created.  The stream has
+# the number of copied rows and tiles under "reused", which is not meant for
+# the sidecar.
+def create_streamed_collage(
+        title: str, size: str, files: List[Pathlib], sep: str,
+        outfile: Pathlib,
+        labels: Union[Dict[Pathlib, str], None] = None,
+        compression: Union[int, None] = None,
+        keys: Union[List[str], None] = None,
+        previous: Union[dict, None] = None) -> Union[dict, None]:
+
+    if not files:
+        return None
+    labels = labels or {}
+    keys = keys or [''] * len(files)
+    layout = build_collage_layout(size, len(files))
+    labelfont = load_font(LABEL_FONT_SIZE)
+    titlefont = load_font(TITLE_FONT_SIZE)
+    columns = layout['columns']
+    canvas_width = columns * layout['tile_width']
+    canvas_height = (layout['title_height']
+                     + layout['rows'] * layout['tile_height'])
+
+    rows: List[List[Tuple[str, str]]] = [[('', title)]]
+    for start in range(0, len(files), columns):
+        rows.append([(keys[index],
+                      labels.get(files[index])
+                      or build_collage_label(files[index], sep))
+                     for index in range(start,
+                                        min(start + columns, len(files)))])
+
+    olddata = b''
+    oldstrips: List[Segment] = []
+    if previous is not None:
+        (olddata, oldstrips) = (load_collage_strips(outfile,
+                                                    previous,
+                                                    columns)
+                                or (b'', []))
+    oldrows: Dict[tuple, Segment] = {}
+    oldtiles: Dict[Tuple[str, str], Tuple[int, int]] = {}
+    for number, segment in enumerate(oldstrips):
+        oldrows.setdefault(tuple(map(tuple, segment['tiles'])), segment)
+        if not number:
+            continue
+        for column, tile in enumerate(segment['tiles']):
+            oldtiles.setdefault(tuple(tile), (number, column))
+    decoded: Dict[int, object] = {}
+    reused = {'rows': 0, 'tiles': 0}
+
+    strips: List[Segment] = []
+    with PngStream(partial_path(outfile),
+                   canvas_width,
+                   canvas_height,
+                   compression) as png:
+        for number, tiles in enumerate(rows):
+            if tuple(tiles) in oldrows:
+                segment = png.copy_segment(olddata, oldrows[tuple(tiles)])
+                strips.append(dict(segment, tiles=tiles))
+                reused['rows'] += 1
+                continue
+            if not number:
+                strip = Image.new('RGB',
+                                  (canvas_width, layout['title_height']),
+                                  BACKGROUND_COLOR)
+                draw_centered_text(ImageDraw.Draw(strip), title, titlefont,
+                                   0, canvas_width, 8)
+                stream_image(png, strip)
+                strips.append(dict(png.end_segment(), tiles=tiles))
+                continue
+            strip = Image.new('RGB',
+                              (canvas_width, layout['tile_height']),
+                              BACKGROUND_COLOR)
+            draw = ImageDraw.Draw(strip)
+            for column, tile in enumerate(tiles):
+                left = column * layout['tile_width']
+                if tile in oldtiles:
+                    (oldnumber, oldcolumn) = oldtiles[tile]
+                    if oldnumber not in decoded:
+                        if len(decoded) > 1:
+                            del decoded[next(iter(decoded))]
+                        segment = oldstrips[oldnumber]
+                        decoded[oldnumber] = Image.frombytes(
+                                'RGB',
+                                (canvas_width, segment['rows']),
+                                decode_segment(olddata,
+                                               segment,
+                                               canvas_width))
+                    oldleft = oldcolumn * layout['tile_width']
+                    box = (oldleft,
+                           0,
+                           oldleft + layout['tile_width'],
+                           layout['tile_height'])
+                    strip.paste(decoded[oldnumber].crop(box), (left, 0))
+                    reused['tiles'] += 1
+                    continue
+                file = files[(number - 1) * columns + column]
+                draw_collage_tile(strip,
+                                  draw,
+                                  layout,
+                                  file,
+                                  tile[1],
+                                  labelfont,
+                                  left,
+                                  0,
+                                  {})
+            stream_image(png, strip)
+            strips.append(dict(png.end_segment(), tiles=tiles))
+
+    if not finish_partial(outfile):
+        return None
+
+    return {'columns': columns,
+            'length': png.length,
+            'adler': png.adler,
+            'strips': strips,
+            'reused': reused}
+
+
+# Base command for a game collage.  It will set the standard size for all
+# images and their frame size.  It includes the main program to create the
+# collage, so this should be the first command when merging with other command
+# sets.  The collage is written at the zlib level compression, if given.
+def build_collage_base_command(
+        title: str, size: str,
+        compression: Union[int, None] = None) -> List[str]:
+
+    command: List[str] = []
+    command.append('montage')
+    if compression is not None:
+        command.append('-define')
+        command.append('png:compression-level=' + str(compression))
+    command.append('-frame')
+    command.append('8x8')
+    command.append('-geometry')
+    command.append(size)
+    command.append('-title')
+    command.append(title)
+
+    return command
+
+
+# Base command to convert images into lossless webp format.  A higher method
+# from 0 to 6 compresses better and takes longer, the default is 4.
+def build_towebp_base_command(
+        method: Union[int, None] = None) -> List[str]:
+
+    command: List[str] = []
+    command.append('mogrify')
+    command.append('-quality')
+    command.append('100%')
+    command.append('-format')
+    command.append('webp')
+    command.append('-define')
+    command.append('webp:lossless=true')
+    if method is not None:
+        command.append('-define')
+        command.append('webp:method=' + str(method))
+
+    return command
+
+
+# Build the mogrify command to convert file into a lossless webp file in the
+# folder tempdir, as mogrify cannot choose the name of the output file.
+def build_towebp_command(
+        file: Pathlib, tempdir: str,
+        method: Union[int, None] = None) -> List[str]:
+
+    command: List[str] = []
+    command.extend(build_towebp_base_command(method))
+    command.append('-path')
+    command.append(tempdir)
+    command.append(file.as_posix())
+
+    return command
+
+
+# True if the webp files are written with Pillow, which must support webp.
+# Otherwise mogrify from ImageMagick writes them.
+def uses_pillow_webp(
+        backend: str) -> bool:
+
+    return backend == 'pillow' and features.check('webp')
+
+
+# Get all png files which need a webp version.  These are the collages and,
+# if requested, the crops in the game folders.  Only files without a webp file
+# or with a webp file older than the png are included, unless forced.
+def collect_webp_sources(
+        settings: dict) -> List[Pathlib]:
+
+    pattern = '**/*.png' if settings['webpcrops'] else '*.png'
+    files: List[Pathlib] = []
+    for file in settings['outputdir'].glob(pattern):
+        if is_hidden(file):
+            continue
+        if not settings['force']:
+            webpfile = file.with_suffix('.webp')
+            try:
+                if webpfile.stat().st_mtime >= file.stat().st_mtime:
+                    continue
+            except FileNotFoundError:
+                pass
+        files.append(file)
+    files.sort()
+
+    return files
+
+
+# Convert a single png file to lossless webp, saved next to it.  This runs in
+# a separate process of the webp stage.  Pillow is used if it supports webp,
+# otherwise mogrify from ImageMagick.  The webp file is written under another
+# name first and renamed once complete; mogrify, which cannot choose the
+# output name, writes it into a hidden temporary folder instead.  Returns a
+# trace event of the conversion with the stage name, start, end and fields,
+# as the Tracer of the main process cannot be reached from here.  Field "ok"
+# is True if the webp file exists afterwards.  The method of the encoder is
+# the one of build_towebp_base_command().
+def convert_to_webp(
+        file: Pathlib, backend: str,
+        method: Union[int, None] = None) -> Tuple[str, float, float, dict]:
+
+    webpfile = file.with_suffix('.webp')
+    start = time.time()
+    fields: dict = {'file': webpfile}
+    if uses_pillow_webp(backend):
+        stage = 'pillow webp'
+        options = {} if method is None else {'method': method}
+        with Image.open(file) as image:
+            image.save(partial_path(webpfile), 'WEBP', lossless=True,
+                       quality=100, **options)
+        finish_partial(webpfile)
+    else:
+        stage = 'mogrify'
+        with tempfile.TemporaryDirectory(dir=file.parent,
+                                         prefix='.webp-') as tempdir:
+            command = build_towebp_command(file, tempdir, method)
+            fields['exit'] = subprocess.run(command).returncode
+            if fields['exit'] == 0:
+                try:
+                    os.replace(os.path.join(tempdir, webpfile.name),
+                               webpfile)
+                except FileNotFoundError:
+                    pass
+    end = time.time()
+    fields['size'] = file_size(webpfile)
+    fields['ok'] = fields['size'] is not None
+
+    return stage, start, end, fields
+
+
+# The webp stage converts all outdated png files in parallel.  With dedup,
+# only one of hardlinked png files is converted and its webp file is linked
+# for the others.  Returns the number of created webp files.
+def create_webp_files(
+        settings: dict) -> int:
+
+    files = collect_webp_sources(settings)
+    if not files:
+        return 0
+    links: Dict[Pathlib, Pathlib] = {}
+    if settings['dedup'] is not None:
+        files, links = split_linked_files(files)
+    if not settings['quiet'] and settings['verbose']:
+        for file in files:
+            print(file.as_posix())
+        print()
+
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(settings['jobs'], len(files))) as executor:
+        results = executor.map(convert_to_webp,
+                               files,
+                               [settings['backend']] * len(files))
+        created = 0
+        for stage, start, end, fields in results:
+            settings['trace'].record(stage, start, end, **fields)
+            if fields['ok']:
+                created += 1
+    for file, original in links.items():
+        if link_file(original.with_suffix('.webp'), file.with_suffix('.webp')):
+            created += 1
+
+    return created
+
+
+# Queue up all png files of the output folder for the RecompressPool, which
+# are not yet recompressed, such as the ones left over by an interrupted run.
+# With webp, also the png files with a missing or outdated webp file.
+# Returns the number of files new in the queue.
+def queue_recompression(
+        settings: dict) -> int:
+
+    cache = settings['cache']
+    pool = settings['recompress']
+    with cache.lock:
+        names = sorted(cache.artifacts)
+    queued = 0
+    for name in names:
+        file = pathlib.Path(settings['outputdir'] / name)
+        if (file.suffix == '.png' and file.exists()
+                and not cache.is_compressed(file)):
+            queued += pool.submit(settings, file)
+    if settings['webp']:
+        for file in collect_webp_sources(settings):
+            queued += pool.submit(settings, file,
+                                  not cache.is_compressed(file))
+
+    return queued
+
+
+# Remember a new crop or collage in the cache and queue it up for
+# recompression, if enabled.
+def record_output(
+        settings: dict, outfile: Pathlib, key: str) -> None:
+
+    settings['cache'].record(outfile, key)
+    if settings['recompress'] is not None:
+        settings['recompress'].submit(settings, outfile)
+
+
+# Get the label shown below a crop in the collage.  It is the name of the
+# shader, with the subdirectory separators made readable.
+def build_collage_label(
+        infile: Pathlib, sep: str) -> str:
+
+    label = infile.stem.partition('-crop')[0]
+    if label.startswith('nearest') or label.startswith('bilinear'):
+        return label
+
+    return label.replace(sep, ' / ')
+
+
+# This will build the command set for a cropfile of a specific game.  It is
+# intended to be run in a loop of game directory.  The label is made from the
+# file name, unless one is given.
+def build_collage_game_command(
+        infile: Pathlib, sep: str,
+        label: Union[str, None] = None) -> List[str]:
+
+    command: List[str] = []
+    command.append('-label')
+    command.append(label or build_collage_label(infile, sep))
+    command.append(infile.as_posix())
+
+    return command
+
+
+# Build the cache key of a crop from the checksum of the screenshot and the
+# geometry of the region.
+def build_crop_key(
+        screenshotdigest: str, geometry: str) -> str:
+
+    inputs = 'screenshot=' + screenshotdigest + '\ngeometry=' + geometry
+    key = hashlib.sha256(inputs.encode()).hexdigest()
+
+    return key
+
+
+# Get the cache key of an existing crop, or the checksum of its content if
+# it has none.
+def find_crop_key(
+        cache: BuildCache, file: Pathlib) -> str:
+
+    return cache.recorded_key(file) or cache.file_digest(file)
+
+
+# Build the cache key of a collage from its title, tile size and the keys of
+# all crops in their order, so adding, removing or changing a crop creates
+# the collage again.  A collage with merged duplicates has another key.
+def build_collage_key(
+        cache: BuildCache, title: str, size: str,
+        files: List[Pathlib], dedup: bool = False) -> str:
+
+    inputs: List[str] = []
+    inputs.append('title=' + title)
+    inputs.append('size=' + size)
+    if dedup:
+        inputs.append('dedup=true')
+    for file in files:
+        name = file.relative_to(cache.outputdir).as_posix()
+        inputs.append(name + '=' + find_crop_key(cache, file))
+    key = hashlib.sha256('\n'.join(inputs).encode()).hexdigest()
+
+    return key
+
+
+# Format the file path of the collage for a region of a game.  The name of a
+# named region is added to the filename.
+def build_collage_path(
+        outputdir: Pathlib, title: str, region: str) -> Pathlib:
+
+    name = title + '-' + region if region else title
+    path = pathlib.Path(outputdir.as_posix()
+                        + '/'
+                        + name
+                        + '-crop-collage.png')
+
+    return path
+
+
+# Find the crops of a screenshot that need to be created, as list of crop
+# file and geometry, together with the cache key of every crop file.  With
+# dedup, the keys are built from the decoded pixels of the screenshot, see
+# find_pixel_digest(), and a crop with the same key as an earlier one, as it
+# happens for duplicate screenshots, is hardlinked to it instead and left
+# out.  So duplicates are found as soon as they are cropped, even before the
+# dedup stage of capture linked them and if their files differ.  Returns the
+# crops, the keys and the number of linked crops.
+def find_pending_crops(
+        settings: dict, title: str, infile: Pathlib
+        ) -> Tuple[List[Tuple[Pathlib, str]], Dict[Pathlib, str], int]:
+
+    cache = settings['cache']
+    outgamedir = pathlib.Path(settings['outputdir'] / title)
+    regions = build_regions(settings['games'], title)
+    if settings['dedup'] is not None:
+        digest = find_pixel_digest(cache, infile)
+    else:
+        digest = cache.file_digest(infile)
+    pending: List[Tuple[Pathlib, str]] = []
+    keys: Dict[Pathlib, str] = {}
+    for region, geometry in regions.items():
+        cropdir = pathlib.Path(outgamedir / region)
+        cropdir.mkdir(parents=True, exist_ok=True)
+        crop_file = build_crop_path(cropdir, infile, geometry)
+        keys[crop_file] = build_crop_key(digest, geometry)
+        if (settings['force']
+                or not cache.is_current(crop_file, keys[crop_file])):
+            pending.append((crop_file, geometry))
+        elif settings['dedup'] is not None:
+            settings['dedup'].add(keys[crop_file], crop_file)
+
+    linked = 0
+    if settings['dedup'] is not None:
+        for crop_file, geometry in list(pending):
+            original = settings['dedup'].find(keys[crop_file])
+            if original is not None and link_file(original, crop_file):
+                record_output(settings, crop_file, keys[crop_file])
+                pending.remove((crop_file, geometry))
+                linked += 1
+
+    return pending, keys, linked
+
+
+# True if the crops of infile are cut in this process, which is always the
+# case for ppm screenshots and for the pillow backend.  Otherwise convert
+# does it, see build_crop_command().
+def is_builtin_crop(
+        settings: dict, infile: Pathlib) -> bool:
+
+    return infile.suffix == '.ppm' or settings['backend'] == 'pillow'
+
+
+# Cut the pending crops out of infile in this process, with crop_frame() for
+# ppm screenshots or crop_image() otherwise, see is_builtin_crop().
+def cut_crops(
+        settings: dict, title: str, infile: Pathlib,
+        pending: List[Tuple[Pathlib, str]],
+        buffers: Union[dict, None] = None) -> None:
+
+    if not settings['quiet'] and settings['verbose']:
+        print(infile.as_posix() + ' -> '
+              + ', '.join(file.as_posix() for file, _ in pending))
+        print()
+    trace = settings['trace']
+    if infile.suffix == '.ppm':
+        with trace.span('frame crop', title=title, file=infile) as event:
+            crop_frame(infile, pending, buffers, settings['compression'])
+            event['size'] = sum(file_size(file) or 0 for file, _ in pending)
+    else:
+        with trace.span('pillow crop', title=title, file=infile) as event:
+            crop_image(infile, pending, buffers, settings['compression'])
+            event['size'] = sum(file_size(file) or 0 for file, _ in pending)
+
+
+# Remember the crops that were created in the cache and the dedup index.
+# Returns their number plus linked, the number of linked crops.
+def record_crops(
+        settings: dict, pending: List[Tuple[Pathlib, str]],
+        keys: Dict[Pathlib, str], linked: int = 0) -> int:
+
+    created = linked
+    for crop_file, _ in pending:
+        if crop_file.exists():
+            record_output(settings, crop_file, keys[crop_file])
+            if settings['dedup'] is not None:
+                settings['dedup'].add(keys[crop_file], crop_file)
+            created += 1
+
+    return created
+
+
+# Crop a single screenshot of a game into all of its regions.  Only crops
+# with changed inputs are created, see find_pending_crops().  Ppm screenshots
+# of the capture stage are always cut with crop_frame().  If a buffers
+# dictionary is given, the new crops are kept in it for the collage.  Returns
+# the number of created crops.
+def crop_screenshot(
+        settings: dict, title: str, infile: Pathlib,
+        buffers: Union[dict, None] = None) -> int:
+
+    pending, keys, linked = find_pending_crops(settings, title, infile)
+    if not pending:
+        return linked
+
+    if is_builtin_crop(settings, infile):
+        cut_crops(settings, title, infile, pending, buffers)
+    else:
+        crop_command = build_crop_command(
+                infile,
+                [(partial_path(file), geometry) for file, geometry in pending],
+                settings['compression'])
+        if not settings['quiet'] and settings['verbose']:
+            print(crop_command)
+            print()
+        with settings['trace'].span('convert',
+                                    title=title,
+                                    file=infile) as event:
+            event['exit'] = subprocess.run(crop_command).returncode
+            for file, _ in pending:
+                finish_partial(file, event['exit'] == 0)
+            event['size'] = sum(file_size(file) or 0 for file, _ in pending)
+
+    return record_crops(settings, pending, keys, linked)
+
+
+# Get the tiles of a builtin collage out of its crop files in their order,
+# as saved in its layout sidecar.
+def build_collage_tiles(
+        cache: BuildCache, size: str, files: List[Pathlib],
+        labels: Dict[Pathlib, str], sep: str) -> List[Tile]:
+
+    boxes = build_tile_boxes(build_collage_layout(size, len(files)),
+                             len(files))
+    tiles: List[Tile] = []
+    for file, box in zip(files, boxes):
+        tiles.append({
+            'file': file.relative_to(cache.outputdir).as_posix(),
+            'key': find_crop_key(cache, file),
+            'label': labels.get(file) or build_collage_label(file, sep),
+            'box': list(box),
+        })
+
+    return tiles
+
+
+# Find the collages of all regions of a game that need to be created, with
+# changed crops or without a collage yet.  Each is returned as dictionary of
+# the collage file ("path"), its "title", tile "size", the "crops" to show in
+# their order, extra "labels", cache "key" and if it is made by the
+# "builtin" collage, plus its "tiles" and the sidecar of the "previous"
+# collage to update, if any.  With dedup, crops with the same key are shown
+# as a single tile, labeled with the names of all of them.  A region without
+# any crop, such as of a game whose screenshots all failed, gets no collage.
+def find_pending_collages(
+        settings: dict, title: str) -> List[dict]:
+
+    cache = settings['cache']
+    outgamedir = pathlib.Path(settings['outputdir'] / title)
+    regions = build_regions(settings['games'], title)
+    sep = settings['games'][title]['sep']
+
+    collages: List[dict] = []
+    for region, geometry in regions.items():
+        collage_path = build_collage_path(settings['outputdir'],
+                                          title,
+                                          region)
+        collage_title = title + ' - ' + region if region else title
+        size = geometry.partition('+')[0]
+        cropdir = pathlib.Path(outgamedir / region)
+        cropdir.mkdir(parents=True, exist_ok=True)
+        crops = collect_crop_files(cropdir)
+        if not crops:
+            continue
+        collage_key = build_collage_key(cache,
+                                        collage_title,
+                                        size,
+                                        crops,
+                                        settings['dedup'] is not None)
+        if (not settings['force']
+                and cache.is_current(collage_path, collage_key)):
+            continue
+        labels: Dict[Pathlib, str] = {}
+        if settings['dedup'] is not None:
+            groups = group_duplicates(crops, [find_crop_key(cache, file)
+                                              for file in crops])
+            crops = [group[0] for group in groups]
+            labels = {group[0]: ', '.join(build_collage_label(file, sep)
+                                          for file in group)
+                      for group in groups if len(group) > 1}
+        builtin = settings['streamcollage'] or settings['backend'] == 'pillow'
+        tiles: List[Tile] = []
+        previous = None
+        if builtin:
+            tiles = build_collage_tiles(cache, size, crops, labels, sep)
+        if settings['streamcollage'] and not settings['force']:
+            previous = load_collage_layout(collage_path, collage_title, size)
+            if (previous is not None
+                    and not cache.is_current(collage_path, previous['key'])):
+                previous = None
+        collages.append({'path': collage_path,
+                         'title': collage_title,
+                         'size': size,
+                         'crops': crops,
+                         'labels': labels,
+                         'key': collage_key,
+                         'builtin': builtin,
+                         'tiles': tiles,
+                         'previous': previous})
+
+    return collages
+
+
+# Make a collage from find_pending_collages() in this process, streamed or
+# with Pillow.  Crops found in buffers are taken from memory.  Unless forced,
+# the streamed collage updates the previous collage, see
+# create_streamed_collage().  The trace event tells if anything of the
+# previous collage was actually reused.  Returns the stream of a streamed
+# collage.
+def make_builtin_collage(
+        settings: dict, title: str, collage: dict,
+        buffers: Union[dict, None] = None) -> Union[dict, None]:
+
+    sep = settings['games'][title]['sep']
+    if not settings['quiet'] and settings['verbose']:
+        print(collage['path'].as_posix())
+        print()
+    if settings['streamcollage']:
+        with settings['trace'].span('stream collage',
+                                    title=title,
+                                    file=collage['path']) as event:
+            stream = create_streamed_collage(
+                    collage['title'],
+                    collage['size'],
+                    collage['crops'],
+                    sep,
+                    collage['path'],
+                    collage['labels'],
+                    settings['compression'],
+                    [tile['key'] for tile in collage['tiles']],
+                    collage['previous'])
+            reused = {'rows': 0, 'tiles': 0}
+            if stream is not None:
+                reused = stream.pop('reused')
+            event['update'] = bool(reused['rows'] or reused['tiles'])
+            event['reused'] = reused
+            event['size'] = file_size(collage['path'])
+        return stream
+
+    with settings['trace'].span('pillow collage',
+                                title=title,
+                                file=collage['path']) as event:
+        create_collage(collage['title'],
+                       collage['size'],
+                       collage['crops'],
+                       sep,
+                       collage['path'],
+                       buffers,
+                       collage['labels'],
+                       settings['compression'])
+        event['size'] = file_size(collage['path'])
+
+    return None
+
+
+# Build the montage command of a collage from find_pending_collages(), which
+# writes it under its partial name.
+def build_montage_command(
+        settings: dict, title: str, collage: dict) -> List[str]:
+
+    sep = settings['games'][title]['sep']
+    game_command: List[str] = []
+    for infile in collage['crops']:
+        command = build_collage_game_command(infile,
+                                             sep,
+                                             collage['labels'].get(infile))
+        game_command.extend(command)
+
+    collage_command: List[str] = []
+    collage_command.extend(build_collage_base_command(
+            collage['title'],
+            collage['size'],
+            settings['compression']))
+    collage_command.extend(game_command)
+    collage_command.append(partial_path(collage['path']).as_posix())
+
+    return collage_command
+
+
+# Remember a collage in the cache, if it was created.  The builtin collages
+# save their layout in a sidecar, together with the stream of a streamed
+# collage.  Returns True if the collage was created.
+def record_collage(
+        settings: dict, collage: dict,
+        stream: Union[dict, None] = None) -> bool:
+
+    collage_path = collage['path']
+    if not collage_path.exists():
+        return False
+    record_output(settings, collage_path, collage['key'])
+    if collage['builtin']:
+        save_collage_layout(collage_path,
+                            collage['key'],
+                            collage['title'],
+                            collage['size'],
+                            collage['tiles'],
+                            stream)
+    else:
+        remove_collage_layout(collage_path)
+
+    return True
+
+
+# Create the collages for all regions of a game out of its crops.  Only
+# collages with changed crops are created, see find_pending_collages().
+# Crops found in buffers are taken from memory.  Returns the number of
+# created collages.
+def create_game_collages(
+        settings: dict, title: str,
+        buffers: Union[dict, None] = None) -> int:
+
+    created = 0
+    for collage in find_pending_collages(settings, title):
+        stream = None
+        if collage['builtin']:
+            stream = make_builtin_collage(settings, title, collage, buffers)
+        else:
+            collage_command = build_montage_command(settings, title, collage)
+            if not settings['quiet'] and settings['verbose']:
+                print(collage_command)
+                print()
+            with settings['trace'].span('montage',
+                                        title=title,
+                                        file=collage['path']) as event:
+                event['exit'] = subprocess.run(collage_command).returncode
+                finish_partial(collage['path'], event['exit'] == 0)
+                event['size'] = file_size(collage['path'])
+        if record_collage(settings, collage, stream):
+            created += 1
+
+    return created
+
+
+# Get an empty dictionary to keep crops in memory for the collage, or None if
+# the collage does not make use of it.  The streamed collage never does, as
+# it keeps its memory in use small.
+def build_buffers(
+        settings: dict) -> Union[dict, None]:
+
+    if (settings['nocollage'] or settings['streamcollage']
+            or settings['backend'] != 'pillow'):
+        return None
+
+    return {}
+
+
+# Create a dictionary of settings for crop().  The games are read once with
+# games_from_gamelist(), so they can be shared between multiple runs.  All
+# other arguments have the same meaning and defaults as the options of the
+# crop.py commandline.  The optional plan is an open JobPlan to take the list
+# of screenshots from, instead of looking into the input folder, trace a
+# Tracer to record the timing of each crop, collage and webp conversion and
+# journal a RunJournal to resume an interrupted run from.  With recompress, a
+# RecompressPool, crops and collages are written at a fast compression level
+# and recompressed by the pool in the background, which then also creates the
+# webp files.  With streamcollage, collages are made by
+# create_streamed_collage(), which needs Pillow whatever the backend.  The
+# values can have any type, so due to the complexity no type checking is
+# done.
+def build_crop_settings(
+        games: GamelistEntry,
+        inputdir: str = 'screenshots/',
+        outputdir: str = 'crops/',
+        backend: str = 'auto',
+        force: bool = False,
+        nocollage: bool = False,
+        streamcollage: bool = False,
+        webp: bool = False,
+        webpcrops: bool = False,
+        jobs: Union[int, None] = None,
+        plan=None,
+        trace: Union[Tracer, None] = None,
+        journal: Union[RunJournal, None] = None,
+        dedup: bool = False,
+        recompress: Union[RecompressPool, None] = None,
+        verbose: bool = False,
+        quiet: bool = False):
+
+    settings = {}
+    settings['games'] = games
+    settings['inputdir'] = path(inputdir)
+    settings['outputdir'] = path(outputdir)
+    settings['backend'] = build_backend(backend)
+    settings['force'] = force
+    settings['cache'] = BuildCache(settings['outputdir'], journal)
+    settings['nocollage'] = nocollage
+    if streamcollage and Image is None:
+        raise ValueError('--streamcollage requires the Python module Pillow')
+    settings['streamcollage'] = streamcollage
+    settings['webp'] = webp
+    settings['webpcrops'] = webpcrops
+    if jobs is not None and jobs < 1:
+        raise ValueError('--jobs accepts only 1 or higher: ' + str(jobs))
+    settings['jobs'] = jobs or os.cpu_count() or 1
+    settings['plan'] = plan
+    settings['trace'] = trace or Tracer()
+    settings['dedup'] = DuplicateIndex() if dedup else None
+    settings['recompress'] = recompress
+    settings['compression'] = None
+    if recompress is not None:
+        settings['compression'] = FAST_COMPRESSION
+    settings['verbose'] = verbose
+    settings['quiet'] = quiet
+
+    return settings
+
+
+# Create crops of all screenshots, collages of all games and the webp files,
+# as set up in settings from build_crop_settings().  Only missing or outdated
+# files are created.  With recompress, the webp files are left to the
+# RecompressPool instead.  Returns the number of created crops, collages and
+# webp files.
+def crop(
+        settings) -> Tuple[int, int, int]:
+
+    planned = None
+    if settings['plan'] is not None:
+        planned = settings['plan'].screenshot_files(settings['inputdir'])
+
+    created_crops = 0
+    created_collages = 0
+    for title in settings['games']:
+        if not settings['quiet']:
+            if settings['verbose']:
+                print()
+            print('Processing [' + title + '] ...')
+        buffers = build_buffers(settings)
+
+        # Crop
+        if planned is None:
+            screenshots = collect_screenshot_files(settings['inputdir'],
+                                                   title)
+        else:
+            screenshots = [file for file in planned.get(title, [])
+                           if file.exists()]
+        for infile in screenshots:
+            created_crops += crop_screenshot(settings, title, infile, buffers)
+
+        # Collage
+        if settings['nocollage']:
+            continue
+        created_collages += create_game_collages(settings, title, buffers)
+
+    settings['cache'].save()
+
+    created_webps = 0
+    if settings['recompress'] is not None:
+        queue_recompression(settings)
+    elif settings['webp']:
+        if not settings['quiet']:
+            if settings['verbose']:
+                print()
+            print('Processing webp conversion ...')
+        created_webps = create_webp_files(settings)
+
+    if not settings['quiet']:
+        print()
+        print(str(created_crops) + " crop(s) created.")
+        print(str(created_collages) + " collage(s) created.")
+        if settings['webp'] and settings['recompress'] is None:
+            print(str(created_webps) + " webp file(s) created.")
+
+    return (created_crops, created_collages, created_webps)
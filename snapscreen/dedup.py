@@ -0,0 +1,196 @@
+# Detection of duplicate images, which are then hardlinked to each other and
+# processed only once.
+
+import os
+import zlib
+import shutil
+import struct
+import hashlib
+import threading
+
+from typing import Union, Dict, List, Tuple
+
+from .common import Pathlib, partial_path, finish_partial, is_hidden
+from .cache import BuildCache
+from .pngstream import PNG_SIGNATURE
+
+# Pillow is optional.  Without it, png files are decoded with zlib.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+
+# Get the decompressed image data of a png file together with its header,
+# without Pillow.  This is still filtered per row, so identical pixels give
+# identical data only if the files were written by the same encoder, which is
+# the case for the screenshots of a single RetroArch.
+def read_png_data(
+        file: Pathlib) -> Tuple[bytes, bytes]:
+
+    header = b''
+    decompressor = zlib.decompressobj()
+    data: List[bytes] = []
+    with open(file, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError('not a png file: ' + file.as_posix())
+        while True:
+            length, kind = struct.unpack('>I4s', f.read(8))
+            chunk = f.read(length)
+            f.read(4)
+            if kind == b'IHDR':
+                header = chunk
+            elif kind == b'IDAT':
+                data.append(decompressor.decompress(chunk))
+            elif kind == b'IEND':
+                break
+    data.append(decompressor.flush())
+
+    return header, b''.join(data)
+
+
+# Get a checksum of the decoded pixels of an image, so files with the same
+# picture are found no matter how they were compressed.
+def hash_pixels(
+        file: Pathlib) -> str:
+
+    digest = hashlib.sha256()
+    if Image is not None:
+        with Image.open(file) as image:
+            digest.update(f'{image.mode} {image.width}x{image.height}'
+                          .encode())
+            digest.update(image.tobytes())
+    elif file.suffix == '.ppm':
+        digest.update(file.read_bytes())
+    else:
+        header, data = read_png_data(file)
+        digest.update(header)
+        digest.update(data)
+
+    return digest.hexdigest()
+
+
+# Pixel checksum of a file, remembered in the cache by the checksum of the
+# file content, so each file is decoded only once.
+def find_pixel_digest(
+        cache: BuildCache, file: Pathlib) -> str:
+
+    content = cache.file_digest(file)
+    with cache.lock:
+        known = cache.pixels.get(content)
+    if known:
+        return known
+    digest = hash_pixels(file)
+    with cache.lock:
+        cache.pixels[content] = digest
+
+    return digest
+
+
+# Replace target by a hardlink to source, in one step like any other output.
+# If the file system has no hardlinks, then source is copied instead.  A
+# target already linked to source is left alone.  Returns True on success.
+def link_file(
+        source: Pathlib, target: Pathlib) -> bool:
+
+    if same_file(source, target):
+        return True
+    partial = partial_path(target)
+    partial.unlink(missing_ok=True)
+    try:
+        os.link(source, partial)
+    except FileNotFoundError:
+        return False
+    except OSError:
+        shutil.copyfile(source, partial)
+
+    return finish_partial(target)
+
+
+# True if both files are the same file on disk, such as hardlinks.
+def same_file(
+        file: Pathlib, other: Pathlib) -> bool:
+
+    try:
+        return os.path.samefile(file, other)
+    except FileNotFoundError:
+        return False
+
+
+# The dedup stage of capture: find screenshots of a game with identical
+# pixels and replace each duplicate by a hardlink to the first one, in the
+# order of the shaderlist.  The files are replaced in one step, so a crop
+# running at the same time reads either version.  The crop stage recognizes
+# linked screenshots by their content and reuses their crops.  Returns the
+# number of linked screenshots.
+def deduplicate_screenshots(
+        settings, files: Dict[str, List[Pathlib]]) -> int:
+
+    linked = 0
+    for title, screenshots in files.items():
+        originals: Dict[str, Pathlib] = {}
+        for file in screenshots:
+            if is_hidden(file) or not file.exists():
+                continue
+            digest = find_pixel_digest(settings['cache'], file)
+            original = originals.setdefault(digest, file)
+            if original == file or same_file(original, file):
+                continue
+            if link_file(original, file):
+                linked += 1
+
+    return linked
+
+
+# Outputs of the crop stage by their cache key, to find out if a crop with
+# the same inputs was made before.  Crops of duplicate screenshots have the
+# same key, so they are hardlinked to the first one instead of being cropped
+# again.  Safe to use from multiple threads.
+class DuplicateIndex:
+
+    def __init__(self):
+
+        self.lock = threading.Lock()
+        self.files: Dict[str, Pathlib] = {}
+
+    # Get the first file known with key, or None.
+    def find(
+            self, key: str) -> Union[Pathlib, None]:
+
+        with self.lock:
+            return self.files.get(key)
+
+    # Remember file as output with key, unless there is one already.
+    def add(
+            self, key: str, file: Pathlib) -> None:
+
+        with self.lock:
+            self.files.setdefault(key, file)
+
+
+# Group files with the same key, each group in the order of the files and
+# the groups in the order of their first file.
+def group_duplicates(
+        files: List[Pathlib], keys: List[str]) -> List[List[Pathlib]]:
+
+    groups: Dict[str, List[Pathlib]] = {}
+    for file, key in zip(files, keys):
+        groups.setdefault(key, []).append(file)
+
+    return list(groups.values())
+
+
+# Split files into the ones to process and the hardlinks of those, given as
+# dictionary of each link and its first file.
+def split_linked_files(
+        files: List[Pathlib]) -> Tuple[List[Pathlib], Dict[Pathlib, Pathlib]]:
+
+    firsts: Dict[Tuple[int, int], Pathlib] = {}
+    links: Dict[Pathlib, Pathlib] = {}
+    for file in files:
+        stat = file.stat()
+        first = firsts.setdefault((stat.st_dev, stat.st_ino), file)
+        if first != file:
+            links[file] = first
+
+    return list(firsts.values()), links
@@ -0,0 +1,162 @@
+# Virtual X servers to run RetroArch headless, one per worker thread.
+
+import os
+import time
+import atexit
+import select
+import queue
+import subprocess
+import contextlib
+
+from typing import Union, Dict, List, Tuple, Iterator
+
+# Program of the virtual X server.
+XVFB = 'Xvfb'
+# Screen size of the virtual X servers if no window size is given, in which
+# case RetroArch runs fullscreen on it.
+DEFAULT_SCREEN = (1920, 1080)
+# Seconds to wait for a virtual X server to report its display number.
+START_TIMEOUT = 10.0
+# Environment for RetroArch on a virtual X server without GPU: OpenGL is
+# rendered on the cpu by Mesa.
+SOFTWARE_RENDERING = {
+    'LIBGL_ALWAYS_SOFTWARE': '1',
+    'GALLIUM_DRIVER': 'llvmpipe',
+}
+
+
+# Build the command to start a virtual X server with a single screen of size.
+# The server picks a free display number itself and writes it to the file
+# descriptor displayfd.
+def build_xvfb_command(
+        size: Tuple[int, int], displayfd: int) -> List[str]:
+
+    command: List[str] = []
+    command.append(XVFB)
+    command.append('-displayfd')
+    command.append(str(displayfd))
+    command.append('-screen')
+    command.append('0')
+    command.append(f'{size[0]}x{size[1]}x24')
+    command.append('-nolisten')
+    command.append('tcp')
+    command.append('-noreset')
+    command.append('+extension')
+    command.append('GLX')
+
+    return command
+
+
+# Start a virtual X server and wait until it is ready.  Returns the process
+# and the name of its display, like ":99".
+def start_xvfb(
+        size: Tuple[int, int]) -> Tuple[subprocess.Popen, str]:
+
+    readfd, writefd = os.pipe()
+    try:
+        process = subprocess.Popen(build_xvfb_command(size, writefd),
+                                   pass_fds=(writefd,),
+                                   stdout=subprocess.DEVNULL,
+                                   stderr=subprocess.DEVNULL)
+    finally:
+        os.close(writefd)
+    output = b''
+    deadline = time.monotonic() + START_TIMEOUT
+    try:
+        while not output.endswith(b'\n'):
+            remaining = deadline - time.monotonic()
+            ready, _, _ = select.select([readfd], [], [], max(0, remaining))
+            data = os.read(readfd, 64) if ready else b''
+            if not data:
+                process.kill()
+                process.wait()
+                raise RuntimeError(XVFB + ' did not start, exit code: '
+                                   + str(process.returncode))
+            output += data
+    finally:
+        os.close(readfd)
+
+    return process, ':' + output.decode().strip()
+
+
+# A fixed number of virtual X servers, started once and shared by the worker
+# threads of capture().  A worker takes a display out of the pool with
+# lease() for a RetroArch run or a whole session and puts it back afterwards,
+# so no two RetroArch instances ever share a screen and fight over focus or
+# fullscreen.  Each screen has the given size, which must be at least the
+# size of the RetroArch window.  All servers are stopped with close(), or at
+# the latest when the script ends.
+class DisplayPool:
+
+    def __init__(
+            self, count: int,
+            size: Union[Tuple[int, int], None] = None):
+
+        self.size = size or DEFAULT_SCREEN
+        self.processes: List[subprocess.Popen] = []
+        self.displays: queue.Queue = queue.Queue()
+        atexit.register(self.close)
+        try:
+            for _ in range(count):
+                process, display = start_xvfb(self.size)
+                self.processes.append(process)
+                self.displays.put(display)
+        except BaseException:
+            self.close()
+            raise
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    # Get the environment for a program to run on display.
+    def build_env(
+            self, display: str) -> Dict[str, str]:
+
+        env = dict(os.environ)
+        env.pop('WAYLAND_DISPLAY', None)
+        env['DISPLAY'] = display
+        env.update(SOFTWARE_RENDERING)
+
+        return env
+
+    # Take a display out of the pool for the with block, waiting if all are
+    # in use.  Yields the environment to start RetroArch with.
+    @contextlib.contextmanager
+    def lease(self) -> Iterator[Dict[str, str]]:
+
+        display = self.displays.get()
+        try:
+            yield self.build_env(display)
+        finally:
+            self.displays.put(display)
+
+    # Stop all virtual X servers.
+    def close(self) -> None:
+
+        for process in self.processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in self.processes:
+            try:
+                process.wait(timeout=START_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        self.processes = []
+
+
+# Get the environment for RetroArch in a with block: a display of the pool
+# if there is one, or None to inherit the environment of this process.
+def lease_display(
+        displays: Union[DisplayPool, None]
+        ) -> contextlib.AbstractContextManager:
+
+    if displays is None:
+        return contextlib.nullcontext()
+
+    return displays.lease()
@@ -0,0 +1,151 @@
+# Uncompressed ppm screenshots as fast intermediate format between the
+# capture and crop stage.
+
+import os
+import mmap
+import subprocess
+
+from typing import List, Tuple, Iterator
+
+from .common import Pathlib, partial_path, finish_partial
+
+# Pillow is optional.  Without it, ImageMagick converts the screenshots and
+# crops are encoded with write_png().
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# File formats of the screenshots: png as written by RetroArch, or ppm
+# converted from it.
+SCREENSHOT_FORMATS = ['png', 'ppm']
+# Number of bytes at the start of a ppm file, which are enough for any header
+# without long comments.
+HEADER_SIZE = 1024
+
+
+# Read width, height and the offset of the pixel data from the header of a
+# binary ppm file ("P6") with 8 bit per channel.  Comments in the header are
+# skipped.
+def parse_ppm_header(
+        data: bytes) -> Tuple[int, int, int]:
+
+    values: List[int] = []
+    offset = 2
+    if data[:2] != b'P6':
+        raise ValueError('not a binary ppm file')
+    while len(values) < 3:
+        while data[offset:offset + 1].isspace():
+            offset += 1
+        if data[offset:offset + 1] == b'#':
+            while data[offset:offset + 1] not in (b'\n', b''):
+                offset += 1
+            continue
+        start = offset
+        while data[offset:offset + 1].isdigit():
+            offset += 1
+        if start == offset:
+            raise ValueError('broken ppm header')
+        values.append(int(data[start:offset]))
+    if values[2] != 255:
+        raise ValueError('only 8 bit ppm files are supported')
+
+    return values[0], values[1], offset + 1
+
+
+# Convert a png file into a ppm file, with Pillow if installed or otherwise
+# with ImageMagick.  Returns True on success.
+def convert_png_to_ppm(
+        pngfile: Pathlib, ppmfile: Pathlib) -> bool:
+
+    if Image is not None:
+        with Image.open(pngfile) as image:
+            image.convert('RGB').save(ppmfile, 'PPM')
+        return True
+
+    command: List[str] = []
+    command.append('convert')
+    command.append(pngfile.as_posix())
+    command.append(ppmfile.as_posix())
+
+    return subprocess.run(command).returncode == 0
+
+
+# Move a finished png screenshot of RetroArch to outfile.  If outfile is a
+# ppm file, the screenshot is converted into it instead and the png deleted.
+# Either way outfile appears in one step.  Returns True on success.
+def store_screenshot(
+        pngfile: Pathlib, outfile: Pathlib) -> bool:
+
+    if outfile.suffix != '.ppm':
+        try:
+            os.replace(pngfile, outfile)
+        except FileNotFoundError:
+            return False
+        return True
+
+    try:
+        ok = convert_png_to_ppm(pngfile, partial_path(outfile))
+    finally:
+        pngfile.unlink(missing_ok=True)
+
+    return finish_partial(outfile, ok)
+
+
+# A ppm screenshot mapped into memory.  Regions are cut out as views into the
+# mapped file, so no pixel is copied or decoded until the crop is written.
+# Must be closed after all views and images of it are gone.
+class FrameFile:
+
+    def __init__(
+            self, file: Pathlib):
+
+        with open(file, 'rb') as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mmap)
+        try:
+            self.width, self.height, self.offset = parse_ppm_header(
+                    bytes(self.view[:HEADER_SIZE]))
+        except ValueError:
+            self.close()
+            raise
+        self.stride = self.width * 3
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    # Get the rows of the box of left, upper, right and lower coordinates as
+    # views into the file.
+    def rows(
+            self, box: Tuple[int, int, int, int]) -> Iterator[memoryview]:
+
+        (left, top, right, bottom) = box
+        for y in range(top, bottom):
+            start = self.offset + y * self.stride + left * 3
+            yield self.view[start:start + (right - left) * 3]
+
+    # Get the box as Pillow image, which reads its pixels straight from the
+    # file.  It must be closed before the FrameFile.
+    def image(
+            self, box: Tuple[int, int, int, int]):
+
+        (left, top, right, bottom) = box
+        start = self.offset + top * self.stride + left * 3
+
+        return Image.frombuffer('RGB',
+                                (right - left, bottom - top),
+                                self.view[start:],
+                                'raw',
+                                'RGB',
+                                self.stride,
+                                1)
+
+    def close(self) -> None:
+
+        self.view.release()
+        self.mmap.close()
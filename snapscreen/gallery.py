@@ -0,0 +1,597 @@
+# Gallery stage: a static html index of all screenshots, crops and collages by
+# game, shader and resolution, with a pyramid of thumbnails to browse them.
+
+import os
+import time
+import html
+import pathlib
+import hashlib
+import subprocess
+import urllib.parse
+import concurrent.futures
+
+from typing import Union, Dict, List, Tuple
+
+from .common import (Pathlib, GamelistEntry, path, partial_path,
+                     finish_partial, is_hidden)
+from .cache import BuildCache
+from .scheduler import write_failure_report
+from .trace import Tracer, file_size
+from .config import parse_window_size
+from .crops import (build_backend, build_regions, build_collage_path,
+                    build_collage_label, collect_crop_files,
+                    collect_screenshot_files)
+
+# Pillow is optional.  Without it, ImageMagick creates the thumbnails.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Widths of the levels of the thumbnail pyramid, smallest first.  Each level
+# is scaled down from the next larger one.  The pages show the thumbnails at
+# GALLERY_WIDTH pixels, the browser picks the level for the pixel density of
+# the screen, and the smallest one on narrow screens.
+THUMBNAIL_WIDTHS = [160, 320, 640]
+GALLERY_WIDTH = 320
+THUMBNAIL_QUALITY = 85
+# Folder in the gallery with one subfolder of thumbnails for each width.
+THUMBNAIL_FOLDER = 'thumbs'
+# Folder in the gallery with the page of each game.
+GAMES_FOLDER = 'games'
+# File extensions of images the browsers show.  Other images, such as ppm
+# screenshots, are linked to their largest thumbnail instead.
+WEB_FORMATS = ['.png', '.jpg', '.jpeg', '.webp', '.gif']
+
+PAGE_STYLE = '''
+body { background: #1b1b1b; color: #ddd; font-family: sans-serif; }
+a { color: #8cf; }
+table { border-collapse: collapse; }
+th, td { border: 1px solid #444; padding: 4px; vertical-align: top; }
+th { background: #2a2a2a; }
+td.missing { color: #666; text-align: center; }
+figure { display: inline-block; margin: 4px; }
+img { width: %dpx; aspect-ratio: 4 / 3; object-fit: contain;
+      background: #000; display: block; }
+@media (max-width: 700px) { img { width: %dpx; } }
+''' % (GALLERY_WIDTH, THUMBNAIL_WIDTHS[0])
+
+# An image of the gallery: its file and the name of its thumbnails.
+GalleryImage = Dict[str, Union[str, Pathlib]]
+# An image with outdated thumbnails: its file, the thumbnail files with their
+# width, the largest first, and the cache key of every thumbnail file.
+ThumbnailJob = Tuple[Pathlib, List[Tuple[Pathlib, int]], Dict[Pathlib, str]]
+
+
+# Get the resolution folders of the screenshot and crop folders, ordered by
+# their number of pixels.  Names which are no window size come last.
+def collect_resolutions(
+        folders: List[Pathlib]) -> List[str]:
+
+    names = set()
+    for folder in folders:
+        if folder.is_dir():
+            names.update(entry.name for entry in folder.iterdir()
+                         if entry.is_dir() and not is_hidden(entry))
+
+    def order(name: str) -> Tuple[int, int, str]:
+        try:
+            width, height = parse_window_size(name)
+        except ValueError:
+            return (1, 0, name)
+        return (0, width * height, name)
+
+    return sorted(names, key=order)
+
+
+# Get the name of the thumbnails of file, which is its path relative to the
+# root folder of its kind, so equally named files of screenshots and crops
+# do not clash.
+def build_thumbnail_name(
+        kind: str, root: Pathlib, file: Pathlib) -> str:
+
+    return kind + '/' + file.relative_to(root).as_posix() + '.jpg'
+
+
+# Get the file of the thumbnail with name at one width of the pyramid.
+def build_thumbnail_path(
+        outputdir: Pathlib, name: str, width: int) -> Pathlib:
+
+    return pathlib.Path(outputdir / THUMBNAIL_FOLDER / str(width) / name)
+
+
+def build_thumbnail_key(
+        sourcedigest: str, width: int) -> str:
+
+    inputs = ('source=' + sourcedigest
+              + '\nwidth=' + str(width)
+              + '\nquality=' + str(THUMBNAIL_QUALITY))
+    key = hashlib.sha256(inputs.encode()).hexdigest()
+
+    return key
+
+
+# Order the shaders of a game like collect_crop_files() does, with nearest
+# and bilinear first.
+def order_shaders(
+        stems: List[str]) -> List[str]:
+
+    def order(stem: str) -> Tuple[int, str]:
+        if stem.startswith('nearest'):
+            return (0, stem)
+        elif stem.startswith('bilinear'):
+            return (1, stem)
+        return (2, stem)
+
+    return sorted(set(stems), key=order)
+
+
+# Find all screenshots, crops and collages of a game in every resolution.
+# Returns a dict with the collages by their caption under "collages" and the
+# tables of the game page under "tables", each a dict of shader to a dict of
+# resolution to image.  The screenshots come first, then the crops of every
+# region.  The label of each shader is under "labels" and the image to show
+# for the game on the index page under "preview": the collage at the largest
+# resolution or otherwise any screenshot or crop.
+def collect_game_images(
+        settings: dict, title: str) -> dict:
+
+    sep = settings['games'][title]['sep']
+    regions = build_regions(settings['games'], title)
+    collages: Dict[str, GalleryImage] = {}
+    tables: Dict[str, Dict[str, Dict[str, GalleryImage]]] = {}
+    labels: Dict[str, str] = {}
+    preview: Union[GalleryImage, None] = None
+    tables['Screenshots'] = {}
+    for region in regions:
+        tables['Crops - ' + region if region else 'Crops'] = {}
+
+    def add(table: str, stem: str, resolution: str, kind: str,
+            root: Pathlib, file: Pathlib) -> None:
+        labels.setdefault(stem, build_collage_label(file, sep))
+        row = tables[table].setdefault(stem, {})
+        row[resolution] = {'file': file,
+                           'name': build_thumbnail_name(kind, root, file)}
+
+    for resolution in settings['resolutions']:
+        screenshotsdir = pathlib.Path(settings['screenshotsdir'] / resolution)
+        if pathlib.Path(screenshotsdir / title).is_dir():
+            for file in collect_screenshot_files(screenshotsdir, title):
+                add('Screenshots', file.stem, resolution, 'screenshots',
+                    settings['screenshotsdir'], file)
+        cropsdir = pathlib.Path(settings['cropsdir'] / resolution)
+        for region in regions:
+            table = 'Crops - ' + region if region else 'Crops'
+            cropdir = pathlib.Path(cropsdir / title / region)
+            if cropdir.is_dir():
+                for file in collect_crop_files(cropdir):
+                    add(table, file.stem.partition('-crop')[0], resolution,
+                        'crops', settings['cropsdir'], file)
+        for region in regions:
+            collage = build_collage_path(cropsdir, title, region)
+            if not collage.exists():
+                continue
+            image = {'file': collage,
+                     'name': build_thumbnail_name('crops',
+                                                  settings['cropsdir'],
+                                                  collage)}
+            collages[resolution + ' - ' + region if region
+                     else resolution] = image
+            if not region:
+                preview = image
+
+    for table in list(tables):
+        if not tables[table]:
+            del tables[table]
+        elif preview is None:
+            row = next(iter(tables[table].values()))
+            preview = next(iter(row.values()))
+
+    return {'collages': collages,
+            'tables': tables,
+            'labels': labels,
+            'preview': preview}
+
+
+# Find the images which need new thumbnails, because they are missing or
+# their image changed.
+def find_pending_thumbnails(
+        settings: dict, images: List[GalleryImage]) -> List[ThumbnailJob]:
+
+    cache = settings['cache']
+    pending: List[ThumbnailJob] = []
+    for image in images:
+        digest = cache.file_digest(image['file'])
+        targets: List[Tuple[Pathlib, int]] = []
+        keys: Dict[Pathlib, str] = {}
+        current = not settings['force']
+        for width in reversed(THUMBNAIL_WIDTHS):
+            file = build_thumbnail_path(settings['outputdir'],
+                                        image['name'],
+                                        width)
+            targets.append((file, width))
+            keys[file] = build_thumbnail_key(digest, width)
+            if current and not cache.is_current(file, keys[file]):
+                current = False
+        if not current:
+            pending.append((image['file'], targets, keys))
+
+    return pending
+
+
+# Build the commands to create the thumbnails with ImageMagick, each scaled
+# down from the one before, starting with the image file.  The thumbnails are
+# written under their partial name.
+def build_thumbnail_commands(
+        file: Pathlib,
+        targets: List[Tuple[Pathlib, int]]) -> List[List[str]]:
+
+    commands: List[List[str]] = []
+    source = file
+    for target, width in targets:
+        command: List[str] = []
+        command.append('convert')
+        command.append(source.as_posix())
+        command.append('-thumbnail')
+        command.append(str(width) + 'x' + str(width) + '>')
+        command.append('-quality')
+        command.append(str(THUMBNAIL_QUALITY))
+        command.append(partial_path(target).as_posix())
+        commands.append(command)
+        source = partial_path(target)
+
+    return commands
+
+
+# Create all thumbnails of an image file, the largest first.  Each one is
+# scaled down from the previous one, so the image file is decoded only once.
+# Runs in a worker process of create_thumbnails() and returns a trace event
+# like convert_to_webp().  Field "ok" is True if all thumbnails exist
+# afterwards.  An image which cannot be read, such as a broken or cut off
+# file, does not stop the others: its partial thumbnails are removed and
+# field "error" tells what went wrong.
+def make_thumbnails(
+        file: Pathlib, targets: List[Tuple[Pathlib, int]],
+        backend: str) -> Tuple[str, float, float, dict]:
+
+    start = time.time()
+    fields: dict = {'file': file}
+    for target, _ in targets:
+        target.parent.mkdir(parents=True, exist_ok=True)
+    if backend == 'pillow':
+        stage = 'pillow thumbnail'
+        try:
+            with Image.open(file) as original:
+                image = original.convert('RGB')
+            for target, width in targets:
+                image.thumbnail((width, width), reducing_gap=2.0)
+                image.save(partial_path(target), 'JPEG',
+                           quality=THUMBNAIL_QUALITY)
+        except (OSError, ValueError) as error:
+            fields['error'] = str(error)
+    else:
+        stage = 'convert thumbnail'
+        for command in build_thumbnail_commands(file, targets):
+            fields['exit'] = subprocess.run(command).returncode
+            if fields['exit'] != 0:
+                fields['error'] = 'convert exit ' + str(fields['exit'])
+                break
+    fields['ok'] = True
+    for target, _ in targets:
+        if not finish_partial(target, 'error' not in fields):
+            fields['ok'] = False
+    end = time.time()
+    fields['size'] = file_size(targets[0][0])
+
+    return stage, start, end, fields
+
+
+# Create the missing and outdated thumbnails of all images in parallel.
+# Images without thumbnails afterwards are added to the failures.  Returns
+# the number of images with new thumbnails.
+def create_thumbnails(
+        settings: dict, images: List[GalleryImage],
+        failures: List[dict]) -> int:
+
+    pending = find_pending_thumbnails(settings, images)
+    if not pending:
+        return 0
+    if not settings['quiet'] and settings['verbose']:
+        for file, _, _ in pending:
+            print(file.as_posix())
+        print()
+
+    created = 0
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(settings['jobs'], len(pending))) as executor:
+        results = executor.map(make_thumbnails,
+                               [file for file, _, _ in pending],
+                               [targets for _, targets, _ in pending],
+                               [settings['backend']] * len(pending))
+        for (_, _, keys), (stage, start, end, fields) in zip(pending,
+                                                              results):
+            settings['trace'].record(stage, start, end, **fields)
+            if fields['ok']:
+                for file, key in keys.items():
+                    settings['cache'].record(file, key)
+                created += 1
+            else:
+                failures.append({'file': fields['file'].as_posix(),
+                                 'kind': 'thumbnail',
+                                 'message': fields.get('error', '')})
+
+    return created
+
+
+# Delete the thumbnails in the gallery, which belong to none of the images,
+# as their image was deleted.  Empty folders are removed as well.  Returns
+# the number of deleted files.
+def remove_stale_thumbnails(
+        settings: dict, images: List[GalleryImage]) -> int:
+
+    folder = pathlib.Path(settings['outputdir'] / THUMBNAIL_FOLDER)
+    if not folder.is_dir():
+        return 0
+    wanted = set()
+    for image in images:
+        for width in THUMBNAIL_WIDTHS:
+            wanted.add(build_thumbnail_path(settings['outputdir'],
+                                            image['name'],
+                                            width))
+    removed = 0
+    for file in sorted(folder.rglob('*'), reverse=True):
+        if file.is_dir():
+            if not any(file.iterdir()):
+                file.rmdir()
+        elif file not in wanted:
+            file.unlink()
+            settings['cache'].forget(file)
+            removed += 1
+
+    return removed
+
+
+# Get the link to file from a page in folder, as relative url.
+def build_url(
+        file: Pathlib, folder: Pathlib) -> str:
+
+    return urllib.parse.quote(os.path.relpath(file, folder).replace(os.sep,
+                                                                    '/'))
+
+
+# Build the html of a thumbnail linked to its image, seen from a page in
+# folder.  An image the browser cannot show is linked to its largest
+# thumbnail.  The browser loads it only once it is scrolled into view.
+def build_thumbnail_html(
+        settings: dict, image: GalleryImage, folder: Pathlib,
+        label: str, link: Union[Pathlib, None] = None) -> str:
+
+    sources: List[str] = []
+    for width in THUMBNAIL_WIDTHS:
+        file = build_thumbnail_path(settings['outputdir'],
+                                    image['name'],
+                                    width)
+        sources.append(build_url(file, folder) + ' ' + str(width) + 'w')
+    src = build_url(build_thumbnail_path(settings['outputdir'],
+                                         image['name'],
+                                         GALLERY_WIDTH),
+                    folder)
+    sizes = ('(max-width: 700px) ' + str(THUMBNAIL_WIDTHS[0]) + 'px, '
+             + str(GALLERY_WIDTH) + 'px')
+    if link is None:
+        link = pathlib.Path(image['file'])
+        if link.suffix.lower() not in WEB_FORMATS:
+            link = build_thumbnail_path(settings['outputdir'],
+                                        image['name'],
+                                        THUMBNAIL_WIDTHS[-1])
+    href = build_url(link, folder)
+
+    return ('<a href="' + href + '"><img src="' + src + '" srcset="'
+            + ', '.join(sources) + '" sizes="' + sizes + '" alt="'
+            + html.escape(label) + '" title="' + html.escape(label)
+            + '" loading="lazy" decoding="async"></a>')
+
+
+# Build a complete html page with title and body.
+def build_page(
+        title: str, body: List[str]) -> str:
+
+    lines: List[str] = []
+    lines.append('<!DOCTYPE html>')
+    lines.append('<html>')
+    lines.append('<head>')
+    lines.append('<meta charset="utf-8">')
+    lines.append('<meta name="viewport" content="width=device-width">')
+    lines.append('<title>' + html.escape(title) + '</title>')
+    lines.append('<style>' + PAGE_STYLE + '</style>')
+    lines.append('</head>')
+    lines.append('<body>')
+    lines.extend(body)
+    lines.append('</body>')
+    lines.append('</html>')
+
+    return '\n'.join(lines) + '\n'
+
+
+# Get the file of the page of a game.
+def build_game_page_path(
+        outputdir: Pathlib, title: str) -> Pathlib:
+
+    return pathlib.Path(outputdir / GAMES_FOLDER / (title + '.html'))
+
+
+# Build the page of a game with the images found by collect_game_images():
+# its collages, followed by a table of shaders and resolutions for the
+# screenshots and for the crops of every region.
+def build_game_page(
+        settings: dict, title: str, images: dict) -> str:
+
+    folder = pathlib.Path(settings['outputdir'] / GAMES_FOLDER)
+    body: List[str] = []
+    body.append('<p><a href="' + build_url(settings['outputdir']
+                                           / 'index.html', folder)
+                + '">All games</a></p>')
+    body.append('<h1>' + html.escape(title) + '</h1>')
+    for caption, image in images['collages'].items():
+        body.append('<figure>'
+                    + build_thumbnail_html(settings, image, folder,
+                                           title + ' ' + caption)
+                    + '<figcaption>' + html.escape(caption)
+                    + '</figcaption></figure>')
+    for table, rows in images['tables'].items():
+        resolutions = [resolution for resolution in settings['resolutions']
+                       if any(resolution in row for row in rows.values())]
+        body.append('<h2>' + html.escape(table) + '</h2>')
+        body.append('<table>')
+        body.append('<tr><th>Shader</th>'
+                    + ''.join('<th>' + html.escape(resolution) + '</th>'
+                              for resolution in resolutions)
+                    + '</tr>')
+        for stem in order_shaders(list(rows)):
+            label = images['labels'][stem]
+            cells: List[str] = []
+            for resolution in resolutions:
+                image = rows[stem].get(resolution)
+                if image is None:
+                    cells.append('<td class="missing">-</td>')
+                    continue
+                cells.append('<td>'
+                             + build_thumbnail_html(settings, image, folder,
+                                                    label + ' '
+                                                    + resolution)
+                             + '</td>')
+            body.append('<tr><th>' + html.escape(label) + '</th>'
+                        + ''.join(cells) + '</tr>')
+        body.append('</table>')
+
+    return build_page(title, body)
+
+
+# Build the index page with every game, each shown with its preview image.
+def build_index_page(
+        settings: dict, games: Dict[str, dict]) -> str:
+
+    folder = settings['outputdir']
+    body: List[str] = []
+    body.append('<h1>snapscreen</h1>')
+    for title, images in games.items():
+        link = build_game_page_path(settings['outputdir'], title)
+        preview = images['preview']
+        caption = ('<figcaption><a href="' + build_url(link, folder) + '">'
+                   + html.escape(title) + '</a></figcaption>')
+        if preview is None:
+            body.append('<figure>' + caption + '</figure>')
+            continue
+        body.append('<figure>'
+                    + build_thumbnail_html(settings, preview, folder, title,
+                                           link)
+                    + caption + '</figure>')
+
+    return build_page('snapscreen', body)
+
+
+# Write a page, unless it already has this content.  Returns True if the
+# page was written.
+def write_page(
+        file: Pathlib, content: str) -> bool:
+
+    try:
+        with open(file, 'r', encoding='utf-8') as f:
+            if f.read() == content:
+                return False
+    except FileNotFoundError:
+        pass
+    file.parent.mkdir(parents=True, exist_ok=True)
+    with open(partial_path(file), 'w', encoding='utf-8') as f:
+        f.write(content)
+
+    return finish_partial(file)
+
+
+# Prepare the settings of the gallery stage.  The screenshot and crop folders
+# are the ones of batch.py with a subfolder for each resolution.
+def build_gallery_settings(
+        games: GamelistEntry,
+        screenshotsdir: str = 'screenshots/',
+        cropsdir: str = 'crops/',
+        outputdir: str = 'gallery/',
+        backend: str = 'auto',
+        force: bool = False,
+        jobs: Union[int, None] = None,
+        trace: Union[Tracer, None] = None,
+        verbose: bool = False,
+        quiet: bool = False):
+
+    settings = {}
+    settings['games'] = games
+    settings['screenshotsdir'] = path(screenshotsdir)
+    settings['cropsdir'] = path(cropsdir)
+    settings['outputdir'] = path(outputdir)
+    settings['resolutions'] = collect_resolutions([settings['screenshotsdir'],
+                                                   settings['cropsdir']])
+    settings['backend'] = build_backend(backend)
+    settings['force'] = force
+    settings['cache'] = BuildCache(settings['outputdir'])
+    if jobs is not None and jobs < 1:
+        raise ValueError('--jobs accepts only 1 or higher: ' + str(jobs))
+    settings['jobs'] = jobs or os.cpu_count() or 1
+    settings['trace'] = trace or Tracer()
+    settings['verbose'] = verbose
+    settings['quiet'] = quiet
+
+    return settings
+
+
+# Create the thumbnails and pages of the gallery, as set up in settings from
+# build_gallery_settings().  Only thumbnails of new or changed images are
+# created, thumbnails of deleted images are removed and only changed pages
+# are written.  Images without thumbnails are listed in the failure report of
+# the gallery folder.  Returns the number of images with new thumbnails and
+# the number of written pages.
+def gallery(
+        settings) -> Tuple[int, int]:
+
+    games: Dict[str, dict] = {}
+    for title in settings['games']:
+        images = collect_game_images(settings, title)
+        if images['collages'] or images['tables']:
+            games[title] = images
+
+    everything: List[GalleryImage] = []
+    for images in games.values():
+        everything.extend(images['collages'].values())
+        for rows in images['tables'].values():
+            for row in rows.values():
+                everything.extend(row.values())
+    if not settings['quiet']:
+        print('Processing gallery thumbnails ...')
+    failures: List[dict] = []
+    created_thumbnails = create_thumbnails(settings, everything, failures)
+    removed_thumbnails = remove_stale_thumbnails(settings, everything)
+    settings['cache'].save()
+    counts = {'thumbnail': len(failures)} if failures else {}
+    report = write_failure_report(settings['outputdir'],
+                                  {'failures': failures, 'counts': counts})
+
+    written_pages = 0
+    for title, images in games.items():
+        if write_page(build_game_page_path(settings['outputdir'], title),
+                      build_game_page(settings, title, images)):
+            written_pages += 1
+    if write_page(pathlib.Path(settings['outputdir'] / 'index.html'),
+                  build_index_page(settings, games)):
+        written_pages += 1
+
+    if not settings['quiet']:
+        print()
+        print(str(created_thumbnails) + " image(s) with new thumbnails.")
+        if removed_thumbnails:
+            print(str(removed_thumbnails) + " old thumbnail(s) removed.")
+        print(str(written_pages) + " page(s) written.")
+        if failures:
+            print(str(len(failures)) + ' image(s) failed, see '
+                  + report.as_posix())
+        print('Gallery: ' + pathlib.Path(settings['outputdir']
+                                         / 'index.html').as_posix())
+
+    return (created_thumbnails, written_pages)
@@ -0,0 +1,108 @@
+# Shared model of the gamelist and shaderlist files.  Both files are read and
+# validated once and the result is used by all stages.
+
+import configparser
+import re
+
+from typing import Dict, List, Union
+
+from .common import Pathlib, GamelistEntry, path
+
+# Default values of optional gamelist keys, if neither the game section nor
+# the [DEFAULT] section set them.
+GAMELIST_DEFAULTS: Dict[str, Union[str, int]] = {
+    'slot': 1,
+    'frames': 5,
+    'sep': '／',
+    'size': '480x480',
+    'pos': '0+0',
+}
+
+
+# Read shaderlist file and get a list of paths for each line.
+def shaders_from_shaderlist(
+        file: Pathlib) -> List[Pathlib]:
+    lines: List[Pathlib] = []
+    with open(file.as_posix()) as f:
+        lines = [path(line.rstrip('\n')) for line in f]
+    for shader in lines:
+        if not shader.exists():
+            raise FileNotFoundError(shader.as_posix())
+
+    return lines
+
+
+# Read gamelist in INI format and get a dictionary from all game sections and
+# their keys.  Also converts each key to correct type and does basic validation
+# of all keys, so every path is checked only once.  The defaults dictionary
+# overrides the GAMELIST_DEFAULTS for keys missing in the gamelist.
+# The optional key "regions" is a comma separated list of additional named
+# crop regions in the format "name:WxH+X+Y".
+# Note: Not all keys are used by every stage, such as "slot" and "frames" for
+# crops or "size" and "pos" for screenshots.
+def games_from_gamelist(
+        file: Pathlib,
+        defaults: Union[Dict[str, Union[str, int]], None] = None
+        ) -> GamelistEntry:
+
+    fallback = dict(GAMELIST_DEFAULTS)
+    fallback.update(defaults or {})
+    config = configparser.ConfigParser()
+    config.read(file.as_posix())
+    games: GamelistEntry = {}
+    games = {title: dict(config.items(title)) for title in config.sections()}
+
+    size_format = re.compile(r'^[1-9]\d*x[1-9]\d*$')
+    pos_format = re.compile(r'^\d+[+]\d+$')
+    region_format = re.compile(r'^([\w-]+):([1-9]\d*x[1-9]\d*[+]\d+[+]\d+)$')
+
+    for title in games:
+        game = path(config.get(title, 'game'))
+        core = path(config.get(title, 'core'))
+        slot = config.getint(title, 'slot', fallback=fallback['slot'])
+        frames = config.getint(title, 'frames', fallback=fallback['frames'])
+        sep = config.get(title, 'sep', fallback=fallback['sep'])
+        size = config.get(title, 'size', fallback=fallback['size'])
+        pos = config.get(title, 'pos', fallback=fallback['pos'])
+        regions: Dict[str, str] = {}
+        for region in config.get(title, 'regions', fallback='').split(','):
+            region = region.strip()
+            if not region:
+                continue
+            match = region_format.match(region)
+            if not match:
+                raise ValueError(f'[{title}] regions has wrong format: '
+                                 + region)
+            (name, geometry) = match.group(1, 2)
+            if name in regions:
+                raise ValueError(f'[{title}] regions has duplicate name: '
+                                 + name)
+            regions[name] = geometry
+
+        if not game.exists():
+            raise FileNotFoundError(game.as_posix())
+        if not core.exists():
+            raise FileNotFoundError(core.as_posix())
+        if slot not in range(1, 10):
+            raise ValueError(f'[{title}] slot accepts only 1-9: '
+                             + str(slot))
+        if frames not in range(0, 1000):
+            raise ValueError(f'[{title}] frames accepts only 0-999: '
+                             + str(frames))
+        if not len(sep) == 1:
+            raise ValueError(f'[{title}] sep accepts only 1 character: {sep}')
+        if not size_format.match(size):
+            raise ValueError(f'[{title}] size has wrong format: {size}')
+        if not pos_format.match(pos):
+            raise ValueError(f'[{title}] pos has wrong format: {pos}')
+
+        games[title]['game'] = game
+        games[title]['core'] = core
+        games[title]['slot'] = slot
+        games[title]['frames'] = frames
+        games[title]['sep'] = sep
+        games[title]['size'] = size
+        games[title]['pos'] = pos
+        games[title]['regions'] = regions
+
+    return games
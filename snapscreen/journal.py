@@ -0,0 +1,85 @@
+# Journal of the finished jobs of a run, so an interrupted run can be resumed
+# without looking at every output again.
+
+import os
+import json
+import threading
+
+from typing import Dict
+
+from .common import Pathlib
+
+# Name of the journal of batch.py in the current folder.
+JOURNAL_FILE = '.snapscreen-journal.jsonl'
+
+
+# Append only list of the outputs a run has finished, each with the cache key
+# of its inputs, one json line per output.  Every line is flushed to disk with
+# fsync before the job counts as done, so after a crash or kill the journal
+# names exactly the outputs that are complete.  A restarted run with the same
+# journal accepts these outputs without checking the file, as long as the key
+# still matches.  A line cut off by the crash is ignored.  Once the whole run
+# is done, finish() deletes the journal, so the next run checks all outputs
+# as usual.  Safe to use from multiple threads.
+class RunJournal:
+
+    def __init__(
+            self, file: Pathlib):
+
+        self.file = file
+        self.lock = threading.Lock()
+        self.done: Dict[str, str] = {}
+        try:
+            with open(file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        entry = json.loads(line)
+                        self.done[entry['file']] = entry['key']
+                    except (ValueError, KeyError, TypeError):
+                        continue
+        except FileNotFoundError:
+            pass
+        file.parent.mkdir(parents=True, exist_ok=True)
+        self.output = open(file, 'a', encoding='utf-8')
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    # True if the output was finished with this key by the run of the journal.
+    def is_done(
+            self, outfile: Pathlib, key: str) -> bool:
+
+        with self.lock:
+            return self.done.get(outfile.as_posix()) == key
+
+    # Add a finished output and make sure it is on disk before returning.
+    def record(
+            self, outfile: Pathlib, key: str) -> None:
+
+        line = json.dumps({'file': outfile.as_posix(), 'key': key},
+                          ensure_ascii=False)
+        with self.lock:
+            self.done[outfile.as_posix()] = key
+            if self.output is None:
+                return
+            self.output.write(line + '\n')
+            self.output.flush()
+            os.fsync(self.output.fileno())
+
+    def close(self) -> None:
+
+        with self.lock:
+            if self.output is not None:
+                self.output.close()
+                self.output = None
+
+    # Close and delete the journal after the run is complete.
+    def finish(self) -> None:
+
+        self.close()
+        self.file.unlink(missing_ok=True)
@@ -0,0 +1,118 @@
+# Layout sidecars of the builtin collages, which allow to update a collage
+# tile by tile instead of building it again.
+
+import os
+import json
+import struct
+
+from typing import Union, Dict, List, Tuple
+
+from .common import Pathlib
+from .pngstream import Segment, read_zlib_data
+
+# Extension of the sidecar, which is saved as hidden file next to the
+# collage.
+LAYOUT_SUFFIX = '.layout.json'
+# Version of the sidecar format, sidecars of other versions are ignored.
+LAYOUT_VERSION = 1
+
+# A tile of a collage: its crop file, the cache key of the crop, the label
+# and the box of left, upper, right and lower pixel coordinates.
+Tile = Dict[str, Union[str, List[int]]]
+
+
+# Get the file path of the layout sidecar of a collage.
+def build_layout_path(
+        collage: Pathlib) -> Pathlib:
+
+    return collage.with_name('.' + collage.stem + LAYOUT_SUFFIX)
+
+
+# Get the box of every tile of a collage in their order, as laid out by
+# build_collage_layout().
+def build_tile_boxes(
+        layout: Dict[str, int], count: int) -> List[Tuple[int, int, int, int]]:
+
+    boxes: List[Tuple[int, int, int, int]] = []
+    for index in range(count):
+        left = (index % layout['columns']) * layout['tile_width']
+        top = (layout['title_height']
+               + (index // layout['columns']) * layout['tile_height'])
+        boxes.append((left,
+                      top,
+                      left + layout['tile_width'],
+                      top + layout['tile_height']))
+
+    return boxes
+
+
+# Save the sidecar of a collage, which was created with the cache key from
+# the title, tile size and tiles.  A streamed collage also saves its stream,
+# as returned by create_streamed_collage(): the number of columns, the length
+# and adler32 checksum of its zlib data and its strips, each a Segment of one
+# row of tiles with the key and label of every tile.
+def save_collage_layout(
+        collage: Pathlib, key: str, title: str, size: str,
+        tiles: List[Tile], stream: Union[dict, None] = None) -> None:
+
+    file = build_layout_path(collage)
+    tempfile = file.with_name(file.name + '.tmp')
+    sidecar = {'version': LAYOUT_VERSION,
+               'key': key,
+               'title': title,
+               'size': size,
+               'tiles': tiles}
+    if stream is not None:
+        sidecar['stream'] = stream
+    with open(tempfile, 'w', encoding='utf-8') as f:
+        json.dump(sidecar, f, ensure_ascii=False)
+    os.replace(tempfile, file)
+
+
+# Read the sidecar of a collage, if it describes a collage with the same
+# title and tile size.  Returns None if there is no usable sidecar.
+def load_collage_layout(
+        collage: Pathlib, title: str, size: str) -> Union[dict, None]:
+
+    try:
+        with open(build_layout_path(collage), 'r', encoding='utf-8') as f:
+            sidecar = json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (not isinstance(sidecar, dict)
+            or sidecar.get('version') != LAYOUT_VERSION
+            or sidecar.get('title') != title
+            or sidecar.get('size') != size):
+        return None
+
+    return sidecar
+
+
+# Read the zlib data of a streamed collage together with the strips from its
+# sidecar, if the collage has the given number of columns.  Returns None if
+# there are no strips or the file is not the one the sidecar was saved for,
+# for example because it was recompressed since.
+def load_collage_strips(
+        collage: Pathlib, sidecar: dict,
+        columns: int) -> Union[Tuple[bytes, List[Segment]], None]:
+
+    stream = sidecar.get('stream')
+    if not isinstance(stream, dict) or stream.get('columns') != columns:
+        return None
+    try:
+        data = read_zlib_data(collage)
+    except (FileNotFoundError, ValueError):
+        return None
+    if (len(data) != stream['length']
+            or data[-4:] != struct.pack('>I', stream['adler'])):
+        return None
+
+    return data, stream['strips']
+
+
+# Remove the sidecar of a collage, which was not made by the builtin
+# collage.
+def remove_collage_layout(
+        collage: Pathlib) -> None:
+
+    build_layout_path(collage).unlink(missing_ok=True)
@@ -0,0 +1,523 @@
+# Asyncio orchestrator, which runs the capture, crop, collage and encode
+# stages at the same time, each with its own limit of parallel work.
+
+import os
+import time
+import asyncio
+import tempfile
+
+from typing import Union, Dict, List, Set, Tuple, Callable, Coroutine
+
+from .common import Pathlib, finish_partial, partial_path
+from .config import fill_tempconfigs, remove_tempconfigs
+from .crops import (find_pending_crops, is_builtin_crop, cut_crops,
+                    record_crops, build_crop_command, find_pending_collages,
+                    make_builtin_collage, build_montage_command,
+                    record_collage, build_buffers, collect_webp_sources,
+                    convert_to_webp, uses_pillow_webp, build_towebp_command,
+                    queue_recompression)
+from .dedup import split_linked_files, link_file
+from .display import lease_display
+from .scheduler import CREATED, RetryScheduler
+from .screenshots import (build_screenshot_command, build_retroarch_path,
+                          build_retroarch_command, check_screenshot_job,
+                          build_screenshot_outcome, build_job_report,
+                          take_screenshot_jobs, finish_failure_report,
+                          dedup_capture, stage_screenshot_job,
+                          record_screenshot, flush_staged_screenshots,
+                          release_staged_games, ScreenshotJob)
+from .frames import store_screenshot
+from .trace import file_size
+from .watcher import ScreenshotWatcher
+
+# The stages with a limit of their own: RetroArch runs, crops, collages and
+# webp files.
+STAGES = ['capture', 'crop', 'collage', 'encode']
+
+
+# Create a dictionary of the number of jobs each stage of the Orchestrator
+# may run at the same time.  Only one RetroArch runs by default, as it needs
+# the graphics card.  Crops and webp files default to the number of cpus and
+# collages, which each keep a whole image in memory, to half of them.
+def build_stage_limits(
+        capture: int = 1,
+        crop: Union[int, None] = None,
+        collage: Union[int, None] = None,
+        encode: Union[int, None] = None) -> Dict[str, int]:
+
+    cpus = os.cpu_count() or 1
+    limits = {'capture': capture,
+              'crop': crop or cpus,
+              'collage': collage or max(1, cpus // 2),
+              'encode': encode or cpus}
+    for stage, limit in limits.items():
+        if limit < 1:
+            raise ValueError('--' + stage + 'jobs accepts only 1 or higher: '
+                             + str(limit))
+
+    return limits
+
+
+# Runs the stages of snapscreen on an asyncio event loop, instead of a thread
+# for each blocking program run.  Every external program is started with
+# asyncio.create_subprocess_exec() and the work done in this process, such
+# as Pillow crops and collages, runs in threads with asyncio.to_thread().
+# Each stage has a semaphore, so RetroArch, the crops, the collages and the
+# webp files never take more than their limit from build_stage_limits(),
+# while all of them go on at the same time.  If the run is cancelled, such as
+# with Ctrl-C, all tasks are cancelled, every running program is killed and
+# its partial output removed.  The tempconfigs of the capture settings are
+# deleted either way.
+class Orchestrator:
+
+    def __init__(
+            self, limits: Union[Dict[str, int], None] = None):
+
+        self.limits = limits or build_stage_limits()
+        self.semaphores: Dict[str, asyncio.Semaphore] = {}
+        self.processes: Set[asyncio.subprocess.Process] = set()
+        self.tasks: Set[asyncio.Task] = set()
+
+    # Start coroutine as task, which is kept until it is done, so it can be
+    # cancelled with all others.
+    def spawn(
+            self, coroutine: Coroutine) -> asyncio.Task:
+
+        task = asyncio.create_task(coroutine)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+        return task
+
+    async def start_process(
+            self, command: List[str],
+            env: Union[Dict[str, str], None] = None
+            ) -> asyncio.subprocess.Process:
+
+        process = await asyncio.create_subprocess_exec(*command, env=env)
+        self.processes.add(process)
+
+        return process
+
+    # Kill the process, if it still runs, and wait for its end.
+    async def stop_process(
+            self, process: asyncio.subprocess.Process) -> None:
+
+        try:
+            if process.returncode is None:
+                process.kill()
+            await process.wait()
+        finally:
+            self.processes.discard(process)
+
+    # Run a program until it quits and get its exit code.  It is killed if
+    # the task is cancelled.
+    async def run_command(
+            self, command: List[str]) -> int:
+
+        process = await self.start_process(command)
+        try:
+            return await process.wait()
+        finally:
+            await self.stop_process(process)
+
+    # The async version of run_screenshot_job(), which shares a tempconfig
+    # from the queue tempconfigs.
+    async def run_screenshot_job(
+            self, title: str, shaderfile: Pathlib, key: str, attempt: int,
+            settings, tempconfigs: asyncio.Queue
+            ) -> Tuple[str, Union[int, None], str]:
+
+        if (attempt == 1 and shaderfile == settings['shaders'][0]
+                and not settings['quiet']):
+            if settings['verbose']:
+                print()
+            print('Processing [' + title + '] ...')
+
+        screenshot_command, screenshot_file = build_screenshot_command(
+                shaderfile, title, settings)
+        skipped = await asyncio.to_thread(check_screenshot_job, title,
+                                          shaderfile, key, screenshot_file,
+                                          settings)
+        if skipped is not None:
+            return skipped
+
+        async with self.semaphores['capture']:
+            game, screenshot_command, stored_file = await asyncio.to_thread(
+                    stage_screenshot_job, title, screenshot_command,
+                    screenshot_file, settings)
+            tempconfig = await tempconfigs.get()
+            pngfile = build_retroarch_path(stored_file)
+            try:
+                command = build_retroarch_command(tempconfig,
+                                                  shaderfile,
+                                                  screenshot_command,
+                                                  game)
+                if not settings['quiet'] and settings['verbose']:
+                    print()
+                    print(command)
+
+                pngfile.unlink(missing_ok=True)
+                with (lease_display(settings['displays']) as env,
+                      ScreenshotWatcher(pngfile) as watcher):
+                    start = time.time()
+                    process = await self.start_process(command, env)
+                    try:
+                        created = await watcher.wait_async(
+                                process, settings['timeout'])
+                    finally:
+                        await self.stop_process(process)
+                    if created:
+                        created = await asyncio.to_thread(store_screenshot,
+                                                          pngfile,
+                                                          stored_file)
+                    settings['trace'].record('retroarch',
+                                             start,
+                                             time.time(),
+                                             title=title,
+                                             file=screenshot_file,
+                                             attempt=attempt,
+                                             exit=process.returncode,
+                                             size=file_size(stored_file))
+                    if watcher.written_at is not None:
+                        settings['trace'].record('screenshot wait',
+                                                 start,
+                                                 watcher.written_at,
+                                                 title=title,
+                                                 file=screenshot_file,
+                                                 attempt=attempt)
+            finally:
+                pngfile.unlink(missing_ok=True)
+                tempconfigs.put_nowait(tempconfig)
+
+        if created:
+            await asyncio.to_thread(record_screenshot, settings, stored_file,
+                                    screenshot_file, key)
+
+        return build_screenshot_outcome(created, watcher.killed,
+                                        process.returncode)
+
+    # The async version of capture() without session mode.  Jobs are handed
+    # out by the RetryScheduler to twice as many tasks as the capture stage
+    # may run at once, the others wait for its semaphore.  The scheduler is
+    # asked in a thread, as new jobs hash their input files for the cache
+    # keys or come from the sqlite connection of a JobPlan, so the crops,
+    # collages and webp files of the loop go on meanwhile.
+    async def capture(
+            self, settings,
+            listener: Union[Callable[[dict], None], None] = None) -> int:
+
+        tempconfigs: asyncio.Queue = asyncio.Queue()
+        filled = fill_tempconfigs(settings)
+        while not filled.empty():
+            tempconfigs.put_nowait(filled.get())
+        report = build_job_report(settings, listener)
+        scheduler = RetryScheduler(take_screenshot_jobs(settings),
+                                   settings['games'],
+                                   settings['tries'])
+
+        created_screenshots = 0
+        finished_jobs: List[ScreenshotJob] = []
+        running: Dict[asyncio.Task, Tuple[ScreenshotJob, int]] = {}
+        try:
+            while True:
+                while len(running) < self.limits['capture'] * 2:
+                    item, skipped = await asyncio.to_thread(scheduler.take)
+                    if report is not None:
+                        for title, shaderfile, _ in skipped:
+                            report(title, shaderfile)
+                    if item is None:
+                        break
+                    (title, shaderfile, key), attempt = item
+                    task = self.spawn(self.run_screenshot_job(title,
+                                                              shaderfile,
+                                                              key,
+                                                              attempt,
+                                                              settings,
+                                                              tempconfigs))
+                    running[task] = item
+                wait = scheduler.wait_time()
+                if not running:
+                    if wait is None:
+                        break
+                    await asyncio.sleep(wait)
+                    continue
+                finished, _ = await asyncio.wait(
+                        running,
+                        timeout=wait or None,
+                        return_when=asyncio.FIRST_COMPLETED)
+                for task in finished:
+                    job, attempt = running.pop(task)
+                    outcome, exitcode, message = task.result()
+                    if outcome == CREATED:
+                        created_screenshots += 1
+                    if scheduler.finish(job, attempt, outcome, exitcode,
+                                        message):
+                        finished_jobs.append(job)
+                await asyncio.to_thread(release_staged_games, settings,
+                                        scheduler)
+                if await asyncio.to_thread(flush_staged_screenshots,
+                                           settings,
+                                           not running):
+                    if report is not None:
+                        for title, shaderfile, _ in finished_jobs:
+                            report(title, shaderfile)
+                    finished_jobs = []
+        finally:
+            for task in running:
+                task.cancel()
+            await asyncio.gather(*running, return_exceptions=True)
+            await asyncio.to_thread(release_staged_games, settings,
+                                    scheduler, True)
+            await asyncio.to_thread(flush_staged_screenshots, settings, True)
+            await asyncio.to_thread(settings['cache'].save)
+            await asyncio.to_thread(finish_failure_report, settings,
+                                    scheduler)
+
+        if not settings['quiet']:
+            print()
+            print(str(created_screenshots) + " screenshot(s) created.")
+        if settings['dedup']:
+            await asyncio.to_thread(dedup_capture, settings)
+
+        return created_screenshots
+
+    # The async version of crop_screenshot().  Convert runs as a program of
+    # its own, all other crops in a thread.
+    async def crop_screenshot(
+            self, settings: dict, title: str, infile: Pathlib,
+            buffers: Union[dict, None] = None) -> int:
+
+        async with self.semaphores['crop']:
+            pending, keys, linked = await asyncio.to_thread(
+                    find_pending_crops, settings, title, infile)
+            if not pending:
+                return linked
+
+            if is_builtin_crop(settings, infile):
+                await asyncio.to_thread(cut_crops, settings, title, infile,
+                                        pending, buffers)
+            else:
+                crop_command = build_crop_command(
+                        infile,
+                        [(partial_path(file), geometry)
+                         for file, geometry in pending],
+                        settings['compression'])
+                if not settings['quiet'] and settings['verbose']:
+                    print(crop_command)
+                    print()
+                with settings['trace'].span('convert',
+                                            title=title,
+                                            file=infile) as event:
+                    event['exit'] = None
+                    try:
+                        event['exit'] = await self.run_command(crop_command)
+                    finally:
+                        for file, _ in pending:
+                            finish_partial(file, event['exit'] == 0)
+                    event['size'] = sum(file_size(file) or 0
+                                        for file, _ in pending)
+
+            return await asyncio.to_thread(record_crops, settings, pending,
+                                           keys, linked)
+
+    # The async version of create_game_collages(), which first waits for the
+    # tasks of all crops of the game.  The crops kept in memory for the game
+    # are released afterwards.
+    async def create_game_collages(
+            self, settings: dict, title: str, crops: List[asyncio.Task],
+            buffers: Dict[str, dict]) -> int:
+
+        await asyncio.gather(*crops)
+        collages = await asyncio.to_thread(find_pending_collages,
+                                           settings,
+                                           title)
+        created = 0
+        for collage in collages:
+            stream = None
+            async with self.semaphores['collage']:
+                if collage['builtin']:
+                    stream = await asyncio.to_thread(make_builtin_collage,
+                                                     settings,
+                                                     title,
+                                                     collage,
+                                                     buffers.get(title))
+                else:
+                    collage_command = build_montage_command(settings,
+                                                            title,
+                                                            collage)
+                    if not settings['quiet'] and settings['verbose']:
+                        print(collage_command)
+                        print()
+                    with settings['trace'].span('montage',
+                                                title=title,
+                                                file=collage['path']) as event:
+                        event['exit'] = None
+                        try:
+                            event['exit'] = await self.run_command(
+                                    collage_command)
+                        finally:
+                            finish_partial(collage['path'],
+                                           event['exit'] == 0)
+                        event['size'] = file_size(collage['path'])
+            if await asyncio.to_thread(record_collage, settings, collage,
+                                       stream):
+                created += 1
+        buffers.pop(title, None)
+
+        return created
+
+    # The async version of convert_to_webp(), with mogrify as a program of
+    # its own.  Returns a trace event of the conversion.
+    async def convert_to_webp(
+            self, settings: dict,
+            file: Pathlib) -> Tuple[str, float, float, dict]:
+
+        async with self.semaphores['encode']:
+            if uses_pillow_webp(settings['backend']):
+                return await asyncio.to_thread(convert_to_webp,
+                                               file,
+                                               settings['backend'])
+
+            webpfile = file.with_suffix('.webp')
+            start = time.time()
+            fields: dict = {'file': webpfile}
+            with tempfile.TemporaryDirectory(dir=file.parent,
+                                             prefix='.webp-') as tempdir:
+                fields['exit'] = await self.run_command(
+                        build_towebp_command(file, tempdir))
+                if fields['exit'] == 0:
+                    try:
+                        os.replace(os.path.join(tempdir, webpfile.name),
+                                   webpfile)
+                    except FileNotFoundError:
+                        pass
+            fields['size'] = file_size(webpfile)
+            fields['ok'] = fields['size'] is not None
+
+            return 'mogrify', start, time.time(), fields
+
+    # The async version of create_webp_files().
+    async def create_webp_files(
+            self, settings: dict) -> int:
+
+        files = await asyncio.to_thread(collect_webp_sources, settings)
+        links: Dict[Pathlib, Pathlib] = {}
+        if settings['dedup'] is not None:
+            files, links = split_linked_files(files)
+        if not settings['quiet'] and settings['verbose']:
+            for file in files:
+                print(file.as_posix())
+            print()
+
+        results = await asyncio.gather(*[self.convert_to_webp(settings, file)
+                                         for file in files])
+        created = 0
+        for stage, start, end, fields in results:
+            settings['trace'].record(stage, start, end, **fields)
+            if fields['ok']:
+                created += 1
+        for file, original in links.items():
+            if link_file(original.with_suffix('.webp'),
+                         file.with_suffix('.webp')):
+                created += 1
+
+        return created
+
+    # Finish the work of a resolution after all of its crops and collages are
+    # done, see finish_stage() of the pipeline.
+    async def finish_stage(
+            self, settings: dict, tasks: List[asyncio.Task]) -> None:
+
+        await asyncio.gather(*tasks)
+        await asyncio.to_thread(settings['cache'].save)
+        if settings['recompress'] is not None:
+            await asyncio.to_thread(queue_recompression, settings)
+        elif settings['webp']:
+            await self.create_webp_files(settings)
+
+    # Listener for the events of capture(), see handle_capture_event() of the
+    # pipeline.  It runs on the event loop, so the new tasks start right
+    # away.
+    def handle_capture_event(
+            self, settings: dict, crops: Dict[str, List[asyncio.Task]],
+            buffers: Dict[str, dict], tasks: List[asyncio.Task],
+            event: dict) -> None:
+
+        title = event['title']
+        if title not in settings['games']:
+            return
+        elif event['event'] == 'screenshot':
+            if title not in buffers:
+                buffers[title] = build_buffers(settings)
+            task = self.spawn(self.crop_screenshot(settings,
+                                                   title,
+                                                   event['file'],
+                                                   buffers[title]))
+            crops.setdefault(title, []).append(task)
+            tasks.append(task)
+        elif event['event'] == 'game' and not settings['nocollage']:
+            tasks.append(self.spawn(self.create_game_collages(
+                    settings,
+                    title,
+                    crops.pop(title, []),
+                    buffers)))
+
+    # Cancel all tasks still running and wait for them, then kill any
+    # program left over.
+    async def cancel(self) -> None:
+
+        tasks = list(self.tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        for process in list(self.processes):
+            if process.returncode is None:
+                process.kill()
+
+    # Run the stages of each pair of settings in the order of the pipeline,
+    # see run_pipeline(): the screenshots of a resolution are cropped as soon
+    # as they are created and the next resolution starts capturing while the
+    # previous one is still cropped.
+    async def run(
+            self, stages: List[Tuple[dict, dict]]) -> None:
+
+        self.semaphores = {stage: asyncio.Semaphore(self.limits[stage])
+                           for stage in STAGES}
+        finished: List[asyncio.Task] = []
+        try:
+            for capture_settings, crop_settings in stages:
+                crops: Dict[str, List[asyncio.Task]] = {}
+                buffers: Dict[str, dict] = {}
+                tasks: List[asyncio.Task] = []
+
+                await self.capture(
+                        capture_settings,
+                        lambda event: self.handle_capture_event(crop_settings,
+                                                                crops,
+                                                                buffers,
+                                                                tasks,
+                                                                event))
+                finished.append(self.spawn(self.finish_stage(crop_settings,
+                                                             tasks)))
+            await asyncio.gather(*finished)
+        finally:
+            await self.cancel()
+            for capture_settings, _ in stages:
+                remove_tempconfigs(capture_settings)
+
+
+# Run the capture and crop stages of each pair of settings from
+# build_capture_settings() and build_crop_settings() with the Orchestrator,
+# each stage limited to its number of jobs from build_stage_limits().  The
+# session mode of capture is not supported.  On Ctrl-C all programs are
+# killed before KeyboardInterrupt is raised.
+def run_orchestrator(
+        stages: List[Tuple[dict, dict]],
+        limits: Union[Dict[str, int], None] = None) -> None:
+
+    for capture_settings, _ in stages:
+        if capture_settings['session']:
+            raise ValueError('--session is not supported with --async')
+
+    asyncio.run(Orchestrator(limits).run(stages))
@@ -0,0 +1,99 @@
+# Streaming pipeline, which overlaps the capture stage with the crop stage.
+
+import concurrent.futures
+
+from typing import Union, Dict, List, Tuple
+
+from .crops import (crop_screenshot, create_game_collages, build_buffers,
+                    create_webp_files, queue_recompression)
+from .screenshots import capture
+
+
+# Create the collages of a game, after all of its crops are done.  The crops
+# kept in memory for the game are released afterwards.
+def create_collages_after(
+        settings: dict, title: str,
+        crops: List[concurrent.futures.Future],
+        buffers: Dict[str, dict]) -> int:
+
+    concurrent.futures.wait(crops)
+    created = create_game_collages(settings, title, buffers.get(title))
+    buffers.pop(title, None)
+
+    return created
+
+
+# Finish the work of a resolution after all of its crops and collages are
+# done: save the cache manifest and convert to webp, if requested.  With
+# recompression, the webp files are left to the RecompressPool.
+def finish_stage(
+        settings: dict, futures: List[concurrent.futures.Future]) -> None:
+
+    concurrent.futures.wait(futures)
+    settings['cache'].save()
+    if settings['recompress'] is not None:
+        queue_recompression(settings)
+    elif settings['webp']:
+        create_webp_files(settings)
+
+
+# Listener for the events of capture().  Each screenshot is cropped as soon
+# as it is reported and the collages of a game are made after its last
+# screenshot is done.
+def handle_capture_event(
+        settings: dict, executor: concurrent.futures.Executor,
+        crops: Dict[str, List[concurrent.futures.Future]],
+        buffers: Dict[str, dict], futures: List[concurrent.futures.Future],
+        event: dict) -> None:
+
+    title = event['title']
+    if title not in settings['games']:
+        return
+    elif event['event'] == 'screenshot':
+        if title not in buffers:
+            buffers[title] = build_buffers(settings)
+        future = executor.submit(crop_screenshot,
+                                 settings,
+                                 title,
+                                 event['file'],
+                                 buffers[title])
+        crops.setdefault(title, []).append(future)
+        futures.append(future)
+    elif event['event'] == 'game' and not settings['nocollage']:
+        futures.append(executor.submit(create_collages_after,
+                                       settings,
+                                       title,
+                                       crops.pop(title, []),
+                                       buffers))
+
+
+# Run the capture and crop stages of each pair of settings from
+# build_capture_settings() and build_crop_settings().  Instead of waiting for
+# all screenshots, each one is cropped in a thread right after it is created.
+# The next pair starts capturing as soon as the previous capture is done, while
+# its crops and collages are still in work.  The number of threads for the
+# crop work defaults to the number of cpus.
+def run_pipeline(
+        stages: List[Tuple[dict, dict]],
+        jobs: Union[int, None] = None) -> None:
+
+    finished: List[concurrent.futures.Future] = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+        for capture_settings, crop_settings in stages:
+            crops: Dict[str, List[concurrent.futures.Future]] = {}
+            buffers: Dict[str, dict] = {}
+            futures: List[concurrent.futures.Future] = []
+
+            capture(capture_settings,
+                    lambda event: handle_capture_event(crop_settings,
+                                                       executor,
+                                                       crops,
+                                                       buffers,
+                                                       futures,
+                                                       event))
+            finished.append(executor.submit(finish_stage,
+                                            crop_settings,
+                                            futures))
+
+        for future in finished:
+            future.result()
@@ -0,0 +1,313 @@
+# Compiled job plan: the game and shader matrix expanded once into a table on
+# disk, so following runs neither read the gamelist and shaderlist again nor
+# hash any unchanged input to build the cache keys.
+
+import json
+import pathlib
+import sqlite3
+import hashlib
+import threading
+
+from typing import Union, Dict, List, Tuple, Iterator
+
+from .common import Pathlib, GamelistEntry
+from .gamelist import games_from_gamelist, shaders_from_shaderlist
+from .screenshots import (ScreenshotJob, iterate_screenshot_jobs,
+                          build_screenshot_path, collect_shader_files)
+from .watcher import file_signature
+
+# Version of the table layout.  A plan with any other version is started
+# over.
+PLAN_VERSION = '1'
+# Number of rows read from the table at once, while jobs are streamed.
+FETCH_SIZE = 1024
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS games (
+    position INTEGER PRIMARY KEY,
+    title TEXT NOT NULL,
+    entry TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS shaders (
+    position INTEGER PRIMARY KEY,
+    file TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS files (
+    file TEXT PRIMARY KEY,
+    signature TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS stages (
+    stage TEXT PRIMARY KEY,
+    outputdir TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    stage TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    shader TEXT NOT NULL,
+    output TEXT NOT NULL,
+    key TEXT NOT NULL,
+    PRIMARY KEY (stage, position)
+) WITHOUT ROWID;
+'''
+
+
+# Identify a capture stage by everything besides the input files that its
+# jobs depend on: the folders, the window size, the screenshot format, the
+# compiled config and the names of the available save states.
+def build_stage_fingerprint(
+        settings, statefiles: List[Pathlib]) -> str:
+
+    inputs: List[str] = []
+    inputs.append('outputdir=' + settings['outputdir'].as_posix())
+    inputs.append('shaderdir=' + settings['shaderdir'].as_posix())
+    inputs.append('window=' + str(settings['window']))
+    inputs.append('format=' + settings['format'])
+    inputs.append('config=' + settings['configcontent'])
+    for file in sorted(statefiles):
+        inputs.append('state=' + file.as_posix())
+    fingerprint = hashlib.sha256('\n'.join(inputs).encode()).hexdigest()
+
+    return fingerprint
+
+
+# All input files the cache keys of a capture stage are built from.  If any
+# of them changes, the jobs of the plan are outdated.
+def collect_input_files(
+        settings, statefiles: List[Pathlib]) -> List[Pathlib]:
+
+    files: List[Pathlib] = list(statefiles)
+    for game in settings['games'].values():
+        files.append(game['core'])
+        files.append(game['game'])
+    for shaderfile in settings['shaders']:
+        files.extend(collect_shader_files(shaderfile))
+
+    return files
+
+
+# The job table on disk in sqlite format.  It holds the checked entries of the
+# gamelist and shaderlist and the screenshot jobs of every capture stage, each
+# with its output path and cache key.  The gamelist and shaderlist are only
+# read again after their modification time changed, and the jobs are only
+# expanded again after any of their input files changed.  Otherwise jobs are
+# streamed right out of the table, without touching the files they are made
+# of.  The connection is shared by all threads, one at a time, so the jobs can
+# be taken in a worker thread, such as by the Orchestrator.
+class JobPlan:
+
+    def __init__(
+            self, planfile: Pathlib):
+
+        self.planfile = planfile
+        planfile.parent.mkdir(parents=True, exist_ok=True)
+        self.db = sqlite3.connect(planfile.as_posix(),
+                                  check_same_thread=False)
+        self.lock = threading.RLock()
+        self.db.executescript(SCHEMA)
+        if self.get_meta('version') != PLAN_VERSION:
+            self.clear('meta', 'games', 'shaders', 'files', 'stages', 'jobs')
+            self.set_meta('version', PLAN_VERSION)
+        self.db.commit()
+        self.checked = False
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    def close(self) -> None:
+
+        with self.lock:
+            self.db.close()
+
+    def get_meta(
+            self, name: str) -> Union[str, None]:
+
+        row = self.db.execute('SELECT value FROM meta WHERE name = ?',
+                              (name,)).fetchone()
+
+        return row[0] if row else None
+
+    def set_meta(
+            self, name: str, value: str) -> None:
+
+        self.db.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                        (name, value))
+
+    def clear(
+            self, *tables: str) -> None:
+
+        for table in tables:
+            self.db.execute('DELETE FROM ' + table)
+
+    # Get the games and shaders, as games_from_gamelist() and
+    # shaders_from_shaderlist() would.  Both files are only read if their
+    # size or modification time changed since the plan was made, otherwise
+    # the entries come from the table.  These are checked for missing games,
+    # cores and shaders as well, which read the files again to raise their
+    # error.
+    def load(
+            self, gamelist: Pathlib, shaderlist: Pathlib,
+            defaults: Union[Dict[str, Union[str, int]], None] = None
+            ) -> Tuple[GamelistEntry, List[Pathlib]]:
+
+        sources = json.dumps([gamelist.as_posix(),
+                              file_signature(gamelist),
+                              shaderlist.as_posix(),
+                              file_signature(shaderlist),
+                              defaults or {}], ensure_ascii=False)
+        if self.get_meta('sources') == sources:
+            games: GamelistEntry = {}
+            for title, entry in self.db.execute(
+                    'SELECT title, entry FROM games ORDER BY position'):
+                games[title] = json.loads(entry)
+                games[title]['game'] = pathlib.Path(games[title]['game'])
+                games[title]['core'] = pathlib.Path(games[title]['core'])
+            shaders = [pathlib.Path(file) for file, in self.db.execute(
+                    'SELECT file FROM shaders ORDER BY position')]
+            files = list(shaders)
+            for game in games.values():
+                files.extend([game['game'], game['core']])
+            if all(file.exists() for file in files):
+                return games, shaders
+
+        games = games_from_gamelist(gamelist, defaults)
+        shaders = shaders_from_shaderlist(shaderlist)
+        with self.db:
+            self.clear('games', 'shaders', 'files', 'stages', 'jobs')
+            self.db.executemany(
+                    'INSERT INTO games VALUES (?, ?, ?)',
+                    ((position, title, json.dumps(entry, ensure_ascii=False,
+                                                  default=str))
+                     for position, (title, entry) in enumerate(games.items())))
+            self.db.executemany(
+                    'INSERT INTO shaders VALUES (?, ?)',
+                    ((position, file.as_posix())
+                     for position, file in enumerate(shaders)))
+            self.set_meta('sources', sources)
+        self.checked = True
+
+        return games, shaders
+
+    # Drop all jobs if any of their input files changed since they were
+    # expanded.  Each file is looked at only once per plan.
+    def check_files(self) -> None:
+
+        if self.checked:
+            return
+        self.checked = True
+        for file, signature in self.db.execute(
+                'SELECT file, signature FROM files').fetchall():
+            current = json.dumps(file_signature(pathlib.Path(file)))
+            if current != signature:
+                with self.db:
+                    self.clear('files', 'stages', 'jobs')
+                return
+
+    # Expand the jobs of a capture stage into the table, while they are
+    # yielded one by one.  The rows are written in batches, so the first job
+    # is ready as soon as its key is built, no matter how large the matrix
+    # is.  Only once the last job is written, the stage is marked as
+    # complete, so a run stopped halfway expands it again.  Jobs of an
+    # earlier stage with the same output folder are replaced.  The lock must
+    # not be held.
+    def expand(
+            self, settings, stage: str,
+            statefiles: List[Pathlib]) -> Iterator[ScreenshotJob]:
+
+        # Taken before any key is built, so a file changed meanwhile makes
+        # the jobs outdated on the next run.
+        signatures = [(file.as_posix(), json.dumps(file_signature(file)))
+                      for file in set(collect_input_files(settings,
+                                                          statefiles))]
+        outputdir = settings['outputdir'].as_posix()
+        with self.lock, self.db:
+            self.db.execute('DELETE FROM jobs WHERE stage = ? OR stage IN'
+                            ' (SELECT stage FROM stages WHERE outputdir = ?)',
+                            (stage, outputdir))
+            self.db.execute('DELETE FROM stages WHERE outputdir = ?',
+                            (outputdir,))
+
+        rows: List[Tuple[str, int, str, str, str, str]] = []
+        for position, job in enumerate(iterate_screenshot_jobs(settings)):
+            title, shaderfile, key = job
+            output = build_screenshot_path(shaderfile,
+                                           settings['shaderdir'],
+                                           settings['outputdir'],
+                                           title,
+                                           settings['games'][title]['sep'],
+                                           '.' + settings['format'])
+            rows.append((stage, position, title, shaderfile.as_posix(),
+                         output.as_posix(), key))
+            if len(rows) >= FETCH_SIZE:
+                with self.lock, self.db:
+                    self.db.executemany(
+                            'INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                            rows)
+                rows = []
+            yield job
+
+        with self.lock, self.db:
+            self.db.executemany('INSERT INTO jobs VALUES (?, ?, ?, ?, ?, ?)',
+                                rows)
+            self.db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?)',
+                                signatures)
+            self.db.execute('INSERT INTO stages VALUES (?, ?)',
+                            (stage, outputdir))
+
+    # Stream the screenshot jobs of capture settings, in the same order and
+    # format as iterate_screenshot_jobs().  If the plan does not have them
+    # yet, they are expanded while they are streamed.  Otherwise rows are
+    # fetched in small batches, so the first job is ready at once either way.
+    def screenshot_jobs(
+            self, settings) -> Iterator[ScreenshotJob]:
+
+        statefiles = list(settings['statesdir'].rglob('*.entry'))
+        stage = build_stage_fingerprint(settings, statefiles)
+        with self.lock:
+            self.check_files()
+            row = self.db.execute('SELECT 1 FROM stages WHERE stage = ?',
+                                  (stage,)).fetchone()
+            if row is not None:
+                cursor = self.db.execute('SELECT title, shader, key FROM jobs'
+                                         ' WHERE stage = ? ORDER BY position',
+                                         (stage,))
+        if row is None:
+            yield from self.expand(settings, stage, statefiles)
+            return
+
+        while True:
+            with self.lock:
+                rows = cursor.fetchmany(FETCH_SIZE)
+            if not rows:
+                break
+            for title, shader, key in rows:
+                yield title, pathlib.Path(shader), key
+
+    # Get the screenshot files of the last capture stage with outputdir as
+    # output folder, grouped by title.  None if the plan has no such stage.
+    def screenshot_files(
+            self, outputdir: Pathlib) -> Union[Dict[str, List[Pathlib]], None]:
+
+        with self.lock:
+            row = self.db.execute('SELECT stage FROM stages'
+                                  ' WHERE outputdir = ?',
+                                  (outputdir.as_posix(),)).fetchone()
+            if row is None:
+                return None
+            rows = self.db.execute('SELECT title, output FROM jobs'
+                                   ' WHERE stage = ? ORDER BY position',
+                                   row).fetchall()
+        files: Dict[str, List[Pathlib]] = {}
+        for title, output in rows:
+            files.setdefault(title, []).append(pathlib.Path(output))
+
+        return files
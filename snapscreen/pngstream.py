@@ -0,0 +1,267 @@
+# Png encoder with the standard library, which writes the image row by row
+# without keeping it in memory.  The image data can be split into segments,
+# which are compressed independently of each other, so a segment can later
+# be copied into another file without decoding and encoding it again.
+
+import zlib
+import struct
+
+from typing import Union, Dict, List, Iterator
+
+from .common import Pathlib
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+# Default zlib level of png files written here, the same as Pillow uses.
+PNG_COMPRESSION = 6
+# Compressed bytes collected before they are written as a chunk of the file.
+CHUNK_SIZE = 256 * 1024
+# Modulus of the adler32 checksum at the end of the zlib data.
+ADLER_BASE = 65521
+# Last block of a raw deflate stream, empty and with fixed codes.
+FINAL_BLOCK = b'\x03\x00'
+
+# A segment of the image data: offset and length of its compressed bytes in
+# the zlib data of the file, plus the adler32 checksum, the size and the
+# number of rows of its uncompressed data.
+Segment = Dict[str, int]
+
+
+# Build a png chunk of kind with its length and checksum.
+def build_chunk(
+        kind: bytes, data: bytes) -> bytes:
+
+    return (struct.pack('>I', len(data)) + kind + data
+            + struct.pack('>I', zlib.crc32(kind + data)))
+
+
+# Build the two byte header of zlib data compressed at level.
+def build_zlib_header(
+        level: int) -> bytes:
+
+    cmf = 0x78
+    if level < 2:
+        flevel = 0
+    elif level < 6:
+        flevel = 1
+    elif level == 6:
+        flevel = 2
+    else:
+        flevel = 3
+    flg = flevel << 6
+    flg += (31 - (cmf * 256 + flg) % 31) % 31
+
+    return bytes([cmf, flg])
+
+
+# Get the adler32 checksum of two blocks of data one after the other, out of
+# the checksums of both and the length of the second block.  This is the
+# adler32_combine() of zlib, which Python does not provide.
+def combine_adler32(
+        first: int, second: int, length: int) -> int:
+
+    remainder = length % ADLER_BASE
+    sum1 = first & 0xffff
+    sum2 = (remainder * sum1) % ADLER_BASE
+    sum1 += (second & 0xffff) + ADLER_BASE - 1
+    sum2 += (first >> 16) + (second >> 16) + ADLER_BASE - remainder
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum1 >= ADLER_BASE:
+        sum1 -= ADLER_BASE
+    if sum2 >= ADLER_BASE * 2:
+        sum2 -= ADLER_BASE * 2
+    if sum2 >= ADLER_BASE:
+        sum2 -= ADLER_BASE
+
+    return sum1 | (sum2 << 16)
+
+
+# Read the zlib data of a png file, which is spread over its IDAT chunks.
+def read_zlib_data(
+        file: Pathlib) -> bytes:
+
+    data: List[bytes] = []
+    with open(file, 'rb') as f:
+        if f.read(8) != PNG_SIGNATURE:
+            raise ValueError('not a png file: ' + file.as_posix())
+        while True:
+            header = f.read(8)
+            if len(header) < 8:
+                break
+            length, kind = struct.unpack('>I4s', header)
+            chunk = f.read(length)
+            f.read(4)
+            if kind == b'IDAT':
+                data.append(chunk)
+            elif kind == b'IEND':
+                break
+
+    return b''.join(data)
+
+
+# Decompress a segment out of the zlib data of a file written by PngStream.
+# Returns the pixels of its rows, without the filter byte of each row.
+def decode_segment(
+        data: bytes, segment: Segment, width: int) -> bytes:
+
+    start = segment['offset']
+    raw = zlib.decompressobj(-zlib.MAX_WBITS).decompress(
+            data[start:start + segment['length']])
+    stride = width * 3 + 1
+
+    return b''.join(raw[row + 1:row + stride]
+                    for row in range(0, len(raw), stride))
+
+
+# A png file of 8 bit RGB pixels, which is written while the rows are added
+# with write_row() from top to bottom.  The compressed data goes to the file
+# in chunks as soon as enough is collected, so the memory in use does not
+# grow with the size of the image.  Every row is stored without filter, which
+# compresses a little worse than the encoders of Pillow or ImageMagick, but
+# needs no per pixel work.  The zlib level defaults to PNG_COMPRESSION.
+# Rows can be grouped into segments with end_segment(), which starts the
+# compression anew, and copy_segment() adds a segment of another file in
+# compressed form.  The file is complete after close(), which fails if rows
+# are missing.  Afterwards, length and adler are the size and checksum of
+# the zlib data of the file.
+class PngStream:
+
+    def __init__(
+            self, file: Pathlib, width: int, height: int,
+            compression: Union[int, None] = None):
+
+        if compression is None:
+            compression = PNG_COMPRESSION
+        self.width = width
+        self.height = height
+        self.level = compression
+        self.rows = 0
+        self.adler = 1
+        self.length = 0
+        self.compressor = None
+        self.segment: Segment = {}
+        self.data: List[bytes] = []
+        self.size = 0
+        self.output = open(file, 'wb')
+        self.output.write(PNG_SIGNATURE)
+        self.output.write(build_chunk(b'IHDR',
+                                      struct.pack('>IIBBBBB', width, height,
+                                                  8, 2, 0, 0, 0)))
+        self.add_data(build_zlib_header(compression))
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        if exc[0] is None:
+            self.close()
+        else:
+            self.output.close()
+
+    # Write the collected data as chunk, if there is enough of it or if all
+    # is requested.
+    def flush(
+            self, all: bool = False) -> None:
+
+        if self.size < CHUNK_SIZE and not (all and self.size):
+            return
+        self.output.write(build_chunk(b'IDAT', b''.join(self.data)))
+        self.data = []
+        self.size = 0
+
+    def add_data(
+            self, data: bytes) -> None:
+
+        if data:
+            self.data.append(data)
+            self.size += len(data)
+            self.length += len(data)
+            self.flush()
+
+    # Add the next row of width RGB pixels.
+    def write_row(
+            self, row: bytes) -> None:
+
+        if len(row) != self.width * 3:
+            raise ValueError('row has wrong length: ' + str(len(row)))
+        if self.rows >= self.height:
+            raise ValueError('more rows than the image height')
+        if self.compressor is None:
+            self.compressor = zlib.compressobj(self.level,
+                                               zlib.DEFLATED,
+                                               -zlib.MAX_WBITS)
+            self.segment = {'offset': self.length,
+                            'length': 0,
+                            'adler': 1,
+                            'size': 0,
+                            'rows': 0}
+        for data in (b'\0', row):
+            self.segment['adler'] = zlib.adler32(data, self.segment['adler'])
+            self.adler = zlib.adler32(data, self.adler)
+            self.add_data(self.compressor.compress(data))
+        self.segment['size'] += len(row) + 1
+        self.segment['rows'] += 1
+        self.rows += 1
+
+    # Finish the segment of the rows written since the last one.  Returns the
+    # segment, or None if there were no rows.
+    def end_segment(self) -> Union[Segment, None]:
+
+        if self.compressor is None:
+            return None
+        self.add_data(self.compressor.flush(zlib.Z_FULL_FLUSH))
+        self.compressor = None
+        self.segment['length'] = self.length - self.segment['offset']
+
+        return self.segment
+
+    # Add a segment out of the zlib data of another file written by
+    # PngStream, which has rows of the same width.  Returns the segment as it
+    # is in this file.
+    def copy_segment(
+            self, data: bytes, segment: Segment) -> Segment:
+
+        self.end_segment()
+        if self.rows + segment['rows'] > self.height:
+            raise ValueError('more rows than the image height')
+        if segment['size'] != segment['rows'] * (self.width * 3 + 1):
+            raise ValueError('segment has wrong row length')
+        start = segment['offset']
+        copy = dict(segment)
+        copy['offset'] = self.length
+        self.add_data(data[start:start + segment['length']])
+        self.adler = combine_adler32(self.adler,
+                                     segment['adler'],
+                                     segment['size'])
+        self.rows += segment['rows']
+
+        return copy
+
+    def close(self) -> None:
+
+        if self.output.closed:
+            return
+        try:
+            if self.rows != self.height:
+                raise ValueError('image has ' + str(self.rows) + ' of '
+                                 + str(self.height) + ' rows')
+            self.end_segment()
+            self.add_data(FINAL_BLOCK)
+            self.add_data(struct.pack('>I', self.adler))
+            self.flush(all=True)
+            self.output.write(build_chunk(b'IEND', b''))
+        finally:
+            self.output.close()
+
+
+# Write rows of 8 bit RGB pixels as png file, see PngStream.
+def write_png(
+        file: Pathlib, width: int, height: int,
+        rows: Iterator[bytes],
+        compression: Union[int, None] = None) -> None:
+
+    with PngStream(file, width, height, compression) as png:
+        for row in rows:
+            png.write_row(row)
@@ -0,0 +1,281 @@
+# Background recompression of the crops and collages, which are first written
+# with a fast encoder setting.
+
+import os
+import time
+import signal
+import threading
+import subprocess
+import concurrent.futures
+
+from typing import Union, Dict, List, Set, Tuple
+
+from .common import Pathlib, partial_path, finish_partial
+from .trace import file_size
+from .dedup import link_file
+
+# Pillow is optional.  Without it, ImageMagick recompresses the png files.
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# Zlib level of png files written by the crop stage, when they are
+# recompressed later on.  Level 1 is several times faster than the default.
+FAST_COMPRESSION = 1
+# Zlib level of the recompressed png files.
+BEST_COMPRESSION = 9
+# Effort of the lossless webp encoder for recompressed images, from 0 to 6.
+WEBP_METHOD = 6
+# Priority of the background processes, so they use only the cpu time the
+# crop stage leaves over.
+NICENESS = 10
+
+# An event for the Tracer of the main process: stage, start, end and fields.
+TraceEvent = Tuple[str, float, float, dict]
+
+
+# Builds up the convert command to write a png file again at the best
+# compression level, without changing any pixel.
+def build_recompress_command(
+        infile: Pathlib, outfile: Pathlib) -> List[str]:
+
+    command: List[str] = []
+    command.append('convert')
+    command.append(infile.as_posix())
+    command.append('-define')
+    command.append('png:compression-level=' + str(BEST_COMPRESSION))
+    command.append('-define')
+    command.append('png:compression-filter=5')
+    command.append(outfile.as_posix())
+
+    return command
+
+
+# Write a png file again at the best compression level, with Pillow if
+# installed or otherwise with ImageMagick.  The new file replaces the old one
+# only if it is smaller.  Returns a trace event of the recompression, field
+# "ok" is False if it failed.
+def recompress_png(
+        file: Pathlib) -> TraceEvent:
+
+    partial = partial_path(file)
+    start = time.time()
+    fields: dict = {'file': file, 'before': file_size(file)}
+    if Image is not None:
+        stage = 'pillow optimize'
+        with Image.open(file) as image:
+            image.save(partial, 'PNG', optimize=True,
+                       compress_level=BEST_COMPRESSION)
+        fields['ok'] = True
+    else:
+        stage = 'convert optimize'
+        command = build_recompress_command(file, partial)
+        fields['exit'] = subprocess.run(command).returncode
+        fields['ok'] = fields['exit'] == 0
+    size = file_size(partial)
+    smaller = (fields['ok'] and size is not None
+               and size < (fields['before'] or 0))
+    finish_partial(file, smaller)
+    fields['size'] = file_size(file)
+
+    return stage, start, time.time(), fields
+
+
+# Recompress a png file of the crop stage and create its webp file at the
+# best ratio, if webp is True.  Without compress, only the webp file is
+# created.  This runs in a separate process of the RecompressPool.  Returns
+# the trace events and True if all steps succeeded.
+def recompress_file(
+        file: Pathlib, backend: str, compress: bool,
+        webp: bool) -> Tuple[List[TraceEvent], bool]:
+
+    # Imported here, as the crop stage itself uses the RecompressPool.
+    from .crops import convert_to_webp
+
+    events: List[TraceEvent] = []
+    if compress:
+        events.append(recompress_png(file))
+    if webp:
+        events.append(convert_to_webp(file, backend, WEBP_METHOD))
+
+    return events, all(event[3]['ok'] for event in events)
+
+
+# Lowers the priority of a worker process of the pool.  Ctrl-C is left to the
+# main process, which stops the pool with close(), so no worker quits in the
+# middle of a file.
+def lower_priority() -> None:
+
+    os.nice(NICENESS)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Get the identity of a file on disk, which all of its hardlinks share.  A
+# rewritten file gets a new one, even if the inode number is reused.
+def file_identity(
+        file: Pathlib) -> Tuple[int, int, int, int]:
+
+    stat = file.stat()
+
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+# Recompresses the crops and collages in the background, while the crop
+# stage goes on writing new files with the fast compression level.  The
+# processes run at a lower priority and their number is limited to a share of
+# the cpus, half of them by default.  Files are added with submit() right
+# after they are created.  Once recompressed, a file is marked as such in the
+# build cache of its settings, so an interrupted run starts again only with
+# the files not done yet, see queue_recompression().  Hardlinked duplicates
+# are recompressed once and linked again afterwards.  With webp, the webp
+# file is created from the recompressed png in the same step.  The pool must
+# be closed with close(), which waits for all files and saves the caches, or
+# after an error or Ctrl-C drops the files not started yet.  Safe to use from
+# multiple threads.
+class RecompressPool:
+
+    def __init__(
+            self, jobs: Union[int, None] = None):
+
+        if jobs is not None and jobs < 1:
+            raise ValueError('--recompressjobs accepts only 1 or higher: '
+                             + str(jobs))
+        self.jobs = jobs or max(1, (os.cpu_count() or 1) // 2)
+        self.lock = threading.Lock()
+        self.executor: Union[concurrent.futures.Executor, None] = None
+        self.queued: Dict[Tuple[int, int, int, int], List[Pathlib]] = {}
+        self.done: Dict[Tuple[int, int, int, int], Pathlib] = {}
+        self.pending: Dict[Pathlib, Tuple[int, int, int, int]] = {}
+        self.settings: Dict[int, dict] = {}
+        self.futures: Set[concurrent.futures.Future] = set()
+        self.count = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    # True if a webp file of the png file is wanted, as set in settings from
+    # build_crop_settings().
+    def wants_webp(
+            self, settings: dict, file: Pathlib) -> bool:
+
+        if not settings['webp']:
+            return False
+
+        return settings['webpcrops'] or file.parent == settings['outputdir']
+
+    # Add a png file of the crop stage with settings from
+    # build_crop_settings().  A hardlink of a file already queued is only
+    # linked again afterwards, and a hardlink of a file already recompressed
+    # is marked as done at once.  Without compress, only the webp file is
+    # created.  Returns True if the file is new in the queue.
+    def submit(
+            self, settings: dict, file: Pathlib,
+            compress: bool = True) -> bool:
+
+        try:
+            identity = file_identity(file)
+        except FileNotFoundError:
+            return False
+        with self.lock:
+            if file in self.pending:
+                return False
+            if identity in self.queued:
+                self.queued[identity].append(file)
+                self.pending[file] = identity
+                return False
+            if identity in self.done:
+                if self.wants_webp(settings, file):
+                    link_file(self.done[identity].with_suffix('.webp'),
+                              file.with_suffix('.webp'))
+                settings['cache'].mark_compressed(file)
+                return False
+            self.queued[identity] = [file]
+            self.pending[file] = identity
+            self.settings[id(settings)] = settings
+            if self.executor is None:
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                        max_workers=self.jobs,
+                        initializer=lower_priority)
+            future = self.executor.submit(recompress_file,
+                                          file,
+                                          settings['backend'],
+                                          compress,
+                                          self.wants_webp(settings, file))
+            self.futures.add(future)
+        future.add_done_callback(
+                lambda future: self.finish(settings, identity, future))
+
+        return True
+
+    # Called once a file is recompressed: record the trace events, link the
+    # duplicates again and mark all of them as done in the cache.
+    def finish(
+            self, settings: dict, identity: Tuple[int, int, int, int],
+            future: concurrent.futures.Future) -> None:
+
+        with self.lock:
+            self.futures.discard(future)
+        if future.cancelled():
+            with self.lock:
+                for file in self.queued.pop(identity):
+                    self.pending.pop(file, None)
+            return
+        try:
+            events, ok = future.result()
+        except Exception as error:
+            events = [('recompress', time.time(), time.time(),
+                       {'ok': False, 'error': str(error)})]
+            ok = False
+        with self.lock:
+            files = self.queued.pop(identity)
+            for file in files:
+                self.pending.pop(file, None)
+            if ok:
+                try:
+                    self.done[file_identity(files[0])] = files[0]
+                except FileNotFoundError:
+                    ok = False
+        for stage, start, end, fields in events:
+            fields.setdefault('file', files[0])
+            settings['trace'].record(stage, start, end, **fields)
+        if not ok:
+            return
+        for file in files[1:]:
+            link_file(files[0], file)
+            if self.wants_webp(settings, file):
+                link_file(files[0].with_suffix('.webp'),
+                          file.with_suffix('.webp'))
+        for file in files:
+            settings['cache'].mark_compressed(file)
+        with self.lock:
+            self.count += len(files)
+
+    # Wait for all files, stop the processes and save the caches of all
+    # settings.  With cancel, files not started yet are dropped and only the
+    # ones in work are finished, so the next run recompresses the rest.  The
+    # files are waited for before the pool is shut down, so a close()
+    # interrupted by Ctrl-C can still be followed by one with cancel.
+    # Returns the number of recompressed files.
+    def close(
+            self, cancel: bool = False) -> int:
+
+        with self.lock:
+            executor = self.executor
+            futures = list(self.futures)
+        if executor is not None:
+            if not cancel:
+                concurrent.futures.wait(futures)
+            executor.shutdown(wait=True, cancel_futures=cancel)
+        with self.lock:
+            self.executor = None
+        for settings in self.settings.values():
+            settings['cache'].save()
+        self.settings = {}
+
+        return self.count
@@ -0,0 +1,332 @@
+# Retry scheduling of failed screenshot jobs and the failure report of a run.
+
+import os
+import json
+import time
+import heapq
+import tempfile
+import itertools
+import threading
+import collections
+
+from typing import Union, Dict, List, Tuple, Iterator
+
+from .common import Pathlib
+
+# Outcomes of a single screenshot attempt.  The first two are successes, all
+# others are failures.
+CREATED = 'created'
+CURRENT = 'current'
+CRASH = 'crash'
+TIMEOUT = 'timeout'
+NO_OUTPUT = 'no output'
+MISSING_INPUT = 'missing input'
+# Outcome of jobs never attempted, because their game or core is bad.
+SKIPPED = 'skipped'
+SUCCESSES = (CREATED, CURRENT)
+
+# Seconds to wait before the first retry of a job, doubled for each further
+# retry up to BACKOFF_MAX.
+BACKOFF_BASE = 1.0
+BACKOFF_MAX = 30.0
+# Number of different shaders of a game given up for good after failing the
+# same way in a row, before the game is marked as bad.  And the number of bad games of a core, before
+# the core is marked as bad.
+BAD_GAME_FAILURES = 3
+BAD_CORE_GAMES = 2
+# Name of the failure report in the output folder.
+FAILURE_REPORT = '.snapscreen-failures.json'
+
+# A job of the scheduler: title, shaderfile and cache key, see
+# iterate_screenshot_jobs().
+Job = Tuple[str, Pathlib, str]
+
+
+# Seconds to wait before the next try, after attempt failed.
+def backoff_delay(
+        attempt: int) -> float:
+
+    return min(BACKOFF_BASE * 2 ** (attempt - 1), BACKOFF_MAX)
+
+
+# Find the first input of a game and shader combination that does not exist.
+# Returns a message like "core: path" for the report, or None if all exist.
+def find_missing_input(
+        game, shaderfile: Pathlib) -> Union[str, None]:
+
+    for kind in ['core', 'game']:
+        if not game[kind].exists():
+            return kind + ': ' + game[kind].as_posix()
+    if not shaderfile.exists():
+        return 'shader: ' + shaderfile.as_posix()
+
+    return None
+
+
+# Hands out screenshot jobs to the workers of capture() and decides what
+# happens after each attempt.  New jobs are taken from jobs in their order.
+# A failed job is tried again after a delay growing with each attempt, until
+# all tries are used up.  Retries wait in a heap by the time they are ready,
+# so a retry with a short delay is not held up by an earlier one with a long
+# delay.  Games whose jobs are all finished for good are reported by
+# finished_titles(), as the jobs come game by game.  If several shaders
+# of a game are given up the same way in a row, the game is marked as bad and
+# its remaining jobs are skipped.  The same happens to a core with multiple bad
+# games.  All failures are collected for the report.  Safe to use from
+# multiple threads.
+class RetryScheduler:
+
+    def __init__(
+            self, jobs: Iterator[Job], games, tries: int):
+
+        self.jobs = jobs
+        self.games = games
+        self.tries = tries
+        self.lock = threading.Lock()
+        self.jobslock = threading.Lock()
+        self.retries: List[Tuple[float, int, Job, int]] = []
+        self.sequence = itertools.count()
+        self.exhausted = False
+        self.title: Union[str, None] = None
+        self.open: Dict[str, int] = {}
+        self.done: List[str] = []
+        self.attempts: Dict[Tuple[str, Pathlib], List[dict]] = {}
+        self.streaks: Dict[str, Tuple[str, set]] = {}
+        self.bad_games: Dict[str, str] = {}
+        self.bad_cores: Dict[str, str] = {}
+        self.failures: List[dict] = []
+
+    # The reason a game or its core is bad, or None if both are fine.
+    def bad_reason(
+            self, title: str) -> Union[str, None]:
+
+        core = self.games[title]['core'].as_posix()
+        if core in self.bad_cores:
+            return 'core is bad: ' + self.bad_cores[core]
+        if title in self.bad_games:
+            return 'game is bad: ' + self.bad_games[title]
+
+        return None
+
+    # Get the next job to run as tuple of job and number of the attempt.  Jobs
+    # of bad games are not handed out, but returned in the list of skipped
+    # jobs.  The job is None if nothing is ready right now, see wait_time().
+    # New jobs are pulled from jobs outside of the lock, as that may hash
+    # input files, so finish() is not held up by it.
+    def take(self) -> Tuple[Union[Tuple[Job, int], None], List[Job]]:
+
+        skipped: List[Job] = []
+        while not self.exhausted:
+            with self.jobslock:
+                job = next(self.jobs, None)
+            with self.lock:
+                if job is None or job[0] != self.title:
+                    self.close_title()
+                if job is None:
+                    self.exhausted = True
+                    continue
+                self.title = job[0]
+                if self.skip(job):
+                    skipped.append(job)
+                else:
+                    self.open[job[0]] = self.open.get(job[0], 0) + 1
+                    return (job, 1), skipped
+        with self.lock:
+            while self.retries and self.retries[0][0] <= time.monotonic():
+                _, _, job, attempt = heapq.heappop(self.retries)
+                if self.skip(job):
+                    self.close_job(job)
+                    skipped.append(job)
+                else:
+                    return (job, attempt), skipped
+
+        return None, skipped
+
+    # The jobs of the current game are all taken, it is finished once none of
+    # them is open anymore.  The lock must be held.
+    def close_title(self) -> None:
+
+        if self.title is not None and not self.open.get(self.title):
+            self.done.append(self.title)
+        self.title = None
+
+    # A job is finished for good.  Its game is finished with its last open
+    # job, unless more jobs of it are yet to come.  Jobs not handed out by
+    # take(), such as those of the session mode, are not tracked.  The lock
+    # must be held.
+    def close_job(
+            self, job: Job) -> None:
+
+        title = job[0]
+        if not self.open.get(title):
+            return
+        self.open[title] -= 1
+        if not self.open[title] and title != self.title:
+            self.done.append(title)
+
+    # Get the games finished since the last call, whose jobs are all taken
+    # and finished for good.
+    def finished_titles(self) -> List[str]:
+
+        with self.lock:
+            done = self.done
+            self.done = []
+
+        return done
+
+    # Seconds until the next retry is ready, or None if there are no jobs
+    # left at all.
+    def wait_time(self) -> Union[float, None]:
+
+        with self.lock:
+            if not self.exhausted:
+                return 0.0
+            if not self.retries:
+                return None
+            return max(0.0, self.retries[0][0] - time.monotonic())
+
+    # Add the job to the report as skipped, if its game is bad.
+    def skip(
+            self, job: Job) -> bool:
+
+        reason = self.bad_reason(job[0])
+        if reason is None:
+            return False
+        self.add_failure(job, SKIPPED, reason)
+
+        return True
+
+    def add_failure(
+            self, job: Job, kind: str, message: str = '') -> None:
+
+        title, shaderfile, _ = job
+        self.failures.append({
+            'title': title,
+            'shader': shaderfile.as_posix(),
+            'core': self.games[title]['core'].as_posix(),
+            'kind': kind,
+            'message': message,
+            'attempts': self.attempts.get((title, shaderfile), []),
+        })
+
+    # Keep track of failures of a game, to find out if it is bad.  Only jobs
+    # given up for good count, so attempts of a slow game running at the same
+    # time do not take it down before any retry.  And only failures of
+    # different shaders count, so a single broken shader preset does not
+    # either.  Skipped jobs and missing inputs say nothing about the game.
+    # Then a bad game counts for its core.
+    def count_failure(
+            self, title: str, shaderfile: Pathlib, kind: str) -> None:
+
+        if kind in (SKIPPED, MISSING_INPUT):
+            return
+        streak = self.streaks.get(title)
+        if streak is None or streak[0] != kind:
+            streak = (kind, set())
+            self.streaks[title] = streak
+        streak[1].add(shaderfile)
+        if len(streak[1]) < BAD_GAME_FAILURES or title in self.bad_games:
+            return
+        self.bad_games[title] = kind
+        core = self.games[title]['core']
+        games = [other for other in self.bad_games
+                 if self.bad_games[other] == kind
+                 and self.games[other]['core'] == core]
+        if len(games) >= BAD_CORE_GAMES:
+            self.bad_cores[core.as_posix()] = kind
+
+    # Remember a failed attempt of a job for the report.  A missing core or
+    # game, as named by the message "core: path" of find_missing_input(), is
+    # marked as bad at once.  The lock must be held.
+    def count_attempt(
+            self, job: Job, attempt: int, outcome: str,
+            exitcode: Union[int, None], message: str) -> None:
+
+        title, shaderfile, _ = job
+        self.attempts.setdefault((title, shaderfile), []).append(
+                {'attempt': attempt, 'kind': outcome, 'exit': exitcode})
+        if outcome != MISSING_INPUT:
+            return
+        if message.startswith('core:'):
+            self.bad_cores[self.games[title]['core'].as_posix()] = outcome
+        elif message.startswith('game:'):
+            self.bad_games[title] = outcome
+
+    # Handle the outcome of an attempt of a job.  Returns True if the job is
+    # finished, either with success or for good, or False if it is queued up
+    # to be tried again.  The exit code of RetroArch is kept for the report.
+    # A missing input is never tried again.
+    def finish(
+            self, job: Job, attempt: int, outcome: str,
+            exitcode: Union[int, None] = None, message: str = '') -> bool:
+
+        title = job[0]
+        with self.lock:
+            if outcome == CREATED:
+                self.streaks.pop(title, None)
+            if outcome in SUCCESSES:
+                self.close_job(job)
+                return True
+            self.count_attempt(job, attempt, outcome, exitcode, message)
+            if (outcome == MISSING_INPUT or attempt >= self.tries
+                    or self.bad_reason(title) is not None):
+                self.add_failure(job, outcome, message)
+                self.count_failure(title, job[1], outcome)
+                self.close_job(job)
+                return True
+            ready = time.monotonic() + backoff_delay(attempt)
+            heapq.heappush(self.retries,
+                           (ready, next(self.sequence), job, attempt + 1))
+
+        return False
+
+    # Record a failed attempt of a job without queueing it up again, for
+    # callers with their own retries such as the session mode.
+    def fail_attempt(
+            self, job: Job, attempt: int, outcome: str,
+            exitcode: Union[int, None] = None, message: str = '') -> None:
+
+        with self.lock:
+            self.count_attempt(job, attempt, outcome, exitcode, message)
+
+    # Add a job to the report, which is given up for good.
+    def give_up(
+            self, job: Job, outcome: str, message: str = '') -> None:
+
+        with self.lock:
+            self.add_failure(job, outcome, message)
+            self.count_failure(job[0], job[1], outcome)
+
+    # Get the report of all failures of the run.
+    def report(self) -> dict:
+
+        with self.lock:
+            counts = collections.Counter(entry['kind']
+                                         for entry in self.failures)
+            return {'failures': list(self.failures),
+                    'counts': dict(counts),
+                    'bad_games': dict(self.bad_games),
+                    'bad_cores': dict(self.bad_cores)}
+
+
+# Save the failure report as json file in the output folder.  An empty report
+# is saved as well, so the file always belongs to the last run.
+def write_failure_report(
+        outputdir: Pathlib, report: dict) -> Pathlib:
+
+    outputdir.mkdir(parents=True, exist_ok=True)
+    file = outputdir / FAILURE_REPORT
+    namedtempfile = tempfile.NamedTemporaryFile(
+            mode='w',
+            dir=outputdir,
+            prefix='.failures-',
+            suffix='.tmp',
+            encoding='utf-8',
+            delete=False,
+    )
+    with namedtempfile as f:
+        json.dump(report, f, ensure_ascii=False, indent=2, default=str)
+        f.write('\n')
+    os.replace(namedtempfile.name, file)
+
+    return file
@@ -0,0 +1,856 @@
+# Capture stage: run RetroArch for every game and shader combination and save
+# a screenshot of each.
+
+import time
+import pathlib
+import subprocess
+import threading
+import queue
+import hashlib
+import re
+import concurrent.futures
+import functools
+import itertools
+
+from typing import Union, Dict, List, Set, Tuple, Callable, Iterator
+
+from .common import Pathlib, GamelistEntry, path, partial_path
+from .cache import BuildCache
+from .journal import RunJournal
+from .config import (create_tempconfig, fill_tempconfigs,
+                     build_compiled_config)
+from .watcher import ScreenshotWatcher
+from .trace import Tracer, file_size
+from .scheduler import (CREATED, CURRENT, CRASH, TIMEOUT, NO_OUTPUT,
+                        MISSING_INPUT, SKIPPED, RetryScheduler,
+                        backoff_delay, find_missing_input,
+                        write_failure_report)
+from .session import RetroArchSession, SESSION_PORT
+from .display import DisplayPool, lease_display
+from .dedup import deduplicate_screenshots
+from .frames import SCREENSHOT_FORMATS, store_screenshot
+from .staging import StagingArea
+
+# Type of the optional callback to receive progress events of capture().
+Listener = Callable[[dict], None]
+# A single screenshot to take: title of the game, shaderfile and cache key.
+ScreenshotJob = Tuple[str, Pathlib, str]
+
+
+# Build up the base command for RetroArch and whats the identical for all
+# following game related commands.  As this includes the retroarch executable
+# itself, this command needs to be merged at the beginning of main command.
+def build_base_command(
+        tempconfig: Pathlib) -> List[str]:
+
+    command: List[str] = []
+    command.append('retroarch')
+    command.append('--config')
+    command.append(tempconfig.as_posix())
+    command.append('--sram-mode')
+    command.append('noload-nosave')
+    command.append('--max-frames-ss')
+    command.append('--eof-exit')
+
+    return command
+
+
+# Build up the part of the command responsible for the game specific settings
+# from the gamelist.ini file.  As this includes the path to the game ROM
+# itself, this command needs to be merged at the end of main command.
+def build_game_command(
+        game: Dict[str, Union[str, int, Pathlib]]) -> List[str]:
+
+    command: List[str] = []
+    command.append('--max-frames')
+    command.append(str(game['frames']))
+    command.append('--entryslot')
+    command.append(str(game['slot']))
+    command.append('--libretro')
+    command.append(str(game['core']))
+    command.append(str(game['game']))
+
+    return command
+
+
+# Build up the command and file path to the new screenshot to create.
+# RetroArch writes it as png under another name, see build_retroarch_path(),
+# so it only appears under its final name once it is complete.
+def build_screenshot_command(
+        shaderfile, title, settings) -> Tuple[List[str], Pathlib]:
+
+    path = build_screenshot_path(shaderfile,
+                                 settings['shaderdir'],
+                                 settings['outputdir'],
+                                 title,
+                                 settings['games'][title]['sep'],
+                                 '.' + settings['format'])
+    command: List[str] = []
+    command.append('--max-frames-ss-path')
+    command.append(build_retroarch_path(path).as_posix())
+
+    return command, path
+
+
+# Get the file RetroArch saves the screenshot for file in, before it is
+# stored under its final name with store_screenshot().
+def build_retroarch_path(
+        file: Pathlib) -> Pathlib:
+
+    return partial_path(file.with_suffix('.png'))
+
+
+# Format and name the file path to be used as the screenshot to save.  The
+# suffix depends on the format of the screenshots, see SCREENSHOT_FORMATS.
+def build_screenshot_path(
+        shaderfile: Pathlib, shaderdir: Pathlib, outputdir: Pathlib,
+        title: str, sep: str, suffix: str = '.png') -> Pathlib:
+
+    relative = shaderfile.relative_to(shaderdir)
+    renamed = relative.with_suffix(suffix).as_posix().replace('/', sep)
+    path = pathlib.Path(
+            outputdir.as_posix()
+            + '/' + title
+            + '/' + renamed
+    )
+    path.parent.mkdir(parents=True, exist_ok=True)
+
+    return path
+
+
+# Find all files a shader preset depends on: the preset itself, referenced
+# presets, shader passes, textures and files included by the shader sources.
+# Relative paths are resolved from the folder of the file they appear in.
+def collect_shader_files(
+        shaderfile: Pathlib) -> List[Pathlib]:
+
+    reference = re.compile(r'^\s*#(?:reference|include)\s+"([^"]+)"')
+    assignment = re.compile(r'^\s*([\w.-]+)\s*=\s*"?([^"]*)"?\s*$')
+    files: List[Pathlib] = []
+    pending: List[Pathlib] = [shaderfile]
+    while pending:
+        file = pending.pop()
+        if file in files or not file.is_file():
+            continue
+        files.append(file)
+        includes: List[str] = []
+        values: Dict[str, str] = {}
+        with open(file, 'r', errors='replace') as f:
+            for line in f:
+                match = reference.match(line)
+                if match:
+                    includes.append(match.group(1))
+                    continue
+                match = assignment.match(line)
+                if match:
+                    values[match.group(1)] = match.group(2)
+        for key, value in values.items():
+            if re.match(r'^shader\d+$', key):
+                includes.append(value)
+        for texture in values.get('textures', '').split(';'):
+            if texture in values:
+                includes.append(values[texture])
+        for include in includes:
+            pending.append(pathlib.Path(file.parent / include).resolve())
+
+    return files
+
+
+# Find the entryslot save state files of a game in the states folder.  As the
+# name of the core subfolder is unknown, all subfolders are searched.
+def collect_state_files(
+        statefiles: List[Pathlib], game: Pathlib, slot: int) -> List[Pathlib]:
+
+    name = game.stem + '.state' + str(slot) + '.entry'
+
+    return [file for file in statefiles if file.name == name]
+
+
+# Build the cache key of a screenshot, a hash over everything that has an
+# effect on the resulting image.  This includes the content of the core, game,
+# save state, shader files and the temporary config, plus the frame and slot
+# numbers and the window size.
+def build_screenshot_key(
+        cache: BuildCache, game: Dict[str, Union[str, int, Pathlib]],
+        shaderfiles: List[Pathlib], statefiles: List[Pathlib],
+        configdigest: str, window: Union[str, None]) -> str:
+
+    inputs: List[str] = []
+    inputs.append('core=' + cache.file_digest(game['core']))
+    inputs.append('game=' + cache.file_digest(game['game']))
+    for file in statefiles:
+        inputs.append('state=' + cache.file_digest(file))
+    for file in shaderfiles:
+        inputs.append('shader=' + cache.file_digest(file))
+    inputs.append('config=' + configdigest)
+    inputs.append('frames=' + str(game['frames']))
+    inputs.append('slot=' + str(game['slot']))
+    inputs.append('window=' + str(window))
+    key = hashlib.sha256('\n'.join(inputs).encode()).hexdigest()
+
+    return key
+
+
+# Get the outcome of a screenshot job that needs no RetroArch run, as
+# returned by run_screenshot_job(): current if the screenshot is up to date,
+# or missing input.  None if RetroArch has to run.
+def check_screenshot_job(
+        title: str, shaderfile: Pathlib, key: str, screenshot_file: Pathlib,
+        settings) -> Union[Tuple[str, None, str], None]:
+
+    if not settings['force'] and settings['cache'].is_current(screenshot_file,
+                                                              key):
+        return CURRENT, None, ''
+    missing = find_missing_input(settings['games'][title], shaderfile)
+    if missing is not None:
+        return MISSING_INPUT, None, missing
+
+    return None
+
+
+# Build the complete RetroArch command of a screenshot job out of the
+# screenshot command from build_screenshot_command().
+def build_retroarch_command(
+        tempconfig: Pathlib, shaderfile: Pathlib,
+        screenshot_command: List[str],
+        game: Dict[str, Union[str, int, Pathlib]]) -> List[str]:
+
+    command: List[str] = []
+    command.extend(build_base_command(tempconfig))
+    command.append('--set-shader')
+    command.append(shaderfile.as_posix())
+    command.extend(screenshot_command)
+    command.extend(build_game_command(game))
+
+    return command
+
+
+# Get the outcome of a RetroArch run of a screenshot job, as returned by
+# run_screenshot_job().
+def build_screenshot_outcome(
+        created: bool, killed: bool,
+        exitcode: Union[int, None]) -> Tuple[str, Union[int, None], str]:
+
+    if created:
+        return CREATED, exitcode, ''
+    elif killed:
+        return TIMEOUT, exitcode, ''
+    elif exitcode != 0:
+        return CRASH, exitcode, ''
+
+    return NO_OUTPUT, exitcode, ''
+
+
+# Get the game, the screenshot command and the file to store the screenshot
+# in for a job with the screenshot command and file from
+# build_screenshot_command().  With a StagingArea, the inputs of the game are
+# staged and RetroArch writes the screenshot into the staging area.  They are
+# held for the game in this capture stage, see release_staged_games().
+def stage_screenshot_job(
+        title: str, screenshot_command: List[str], screenshot_file: Pathlib,
+        settings) -> Tuple[Dict[str, Union[str, int, Pathlib]], List[str],
+                           Pathlib]:
+
+    staging = settings['staging']
+    if staging is None:
+        return settings['games'][title], screenshot_command, screenshot_file
+
+    game = staging.stage_game(settings['games'][title],
+                              settings['statesdir'],
+                              (settings['outputdir'], title))
+    staged_file = staging.output_path(screenshot_file)
+    command: List[str] = []
+    command.append('--max-frames-ss-path')
+    command.append(build_retroarch_path(staged_file).as_posix())
+
+    return game, command, staged_file
+
+
+# Remember a new screenshot in the cache.  A staged screenshot is handed over
+# to the StagingArea instead, which moves it into place later, see
+# flush_staged_screenshots().
+def record_screenshot(
+        settings, stored_file: Pathlib, screenshot_file: Pathlib,
+        key: str) -> None:
+
+    if settings['staging'] is None:
+        settings['cache'].record(screenshot_file, key)
+    else:
+        settings['staging'].move(stored_file, screenshot_file, key)
+
+
+# Release the staged inputs of the games with all jobs finished, or of all
+# games of the capture stage if all is set.
+def release_staged_games(
+        settings, scheduler: RetryScheduler, all: bool = False) -> None:
+
+    staging = settings['staging']
+    titles = scheduler.finished_titles()
+    if staging is None:
+        return
+    if all:
+        titles = list(settings['games'])
+    for title in titles:
+        staging.release((settings['outputdir'], title))
+
+
+# Move the staged screenshots to their output folder, once a batch is full or
+# if all is set, and remember them in the cache.  Returns True if no
+# screenshot is left in the staging area, which is always the case without
+# one.
+def flush_staged_screenshots(
+        settings, all: bool = False) -> bool:
+
+    staging = settings['staging']
+    if staging is None:
+        return True
+    if not staging.waiting():
+        return True
+    if not all and not staging.full():
+        return False
+    with settings['trace'].span('staging flush') as event:
+        moved = staging.flush()
+        event['files'] = len(moved)
+    for file, key in moved:
+        settings['cache'].record(file, key)
+
+    return True
+
+
+# Run RetroArch once for a single game and shader combination.  An existing
+# screenshot is only replaced if the cache key of its inputs changed.  Returns
+# the outcome of the attempt, see RetryScheduler.finish(), plus the exit code
+# of RetroArch and a message about missing inputs.  A killed RetroArch counts
+# as timeout, a failed exit code as crash and a clean exit without screenshot
+# as no output.  With staging, see stage_screenshot_job().  This is called
+# from the worker threads of capture().
+def run_screenshot_job(
+        title: str, shaderfile: Pathlib, key: str, attempt: int, settings,
+        tempconfigs: queue.Queue,
+        printlock: threading.Lock) -> Tuple[str, Union[int, None], str]:
+
+    if (attempt == 1 and shaderfile == settings['shaders'][0]
+            and not settings['quiet']):
+        with printlock:
+            if settings['verbose']:
+                print()
+            print('Processing [' + title + '] ...')
+
+    screenshot_command, screenshot_file = build_screenshot_command(
+            shaderfile, title, settings)
+    skipped = check_screenshot_job(title, shaderfile, key, screenshot_file,
+                                   settings)
+    if skipped is not None:
+        return skipped
+
+    game, screenshot_command, stored_file = stage_screenshot_job(
+            title, screenshot_command, screenshot_file, settings)
+    tempconfig = tempconfigs.get()
+    try:
+        command = build_retroarch_command(tempconfig,
+                                          shaderfile,
+                                          screenshot_command,
+                                          game)
+        if not settings['quiet'] and settings['verbose']:
+            with printlock:
+                print()
+                print(command)
+
+        pngfile = build_retroarch_path(stored_file)
+        pngfile.unlink(missing_ok=True)
+        with (lease_display(settings['displays']) as env,
+              ScreenshotWatcher(pngfile) as watcher):
+            start = time.time()
+            process = subprocess.Popen(command, env=env)
+            created = watcher.wait(process, settings['timeout'])
+            if created:
+                created = store_screenshot(pngfile, stored_file)
+            pngfile.unlink(missing_ok=True)
+            settings['trace'].record('retroarch',
+                                     start,
+                                     time.time(),
+                                     title=title,
+                                     file=screenshot_file,
+                                     attempt=attempt,
+                                     exit=process.returncode,
+                                     size=file_size(stored_file))
+            if watcher.written_at is not None:
+                settings['trace'].record('screenshot wait',
+                                         start,
+                                         watcher.written_at,
+                                         title=title,
+                                         file=screenshot_file,
+                                         attempt=attempt)
+    finally:
+        tempconfigs.put(tempconfig)
+
+    if created:
+        record_screenshot(settings, stored_file, screenshot_file, key)
+
+    return build_screenshot_outcome(created, watcher.killed,
+                                    process.returncode)
+
+
+# Take the screenshots of all shaders of a single game in session mode, with
+# one RetroArch process for all of them.  Each item of jobs is a screenshot
+# job of the game, see iterate_screenshot_jobs().  Screenshots that are
+# current are skipped and if all of them are, then RetroArch is not even
+# started.  If RetroArch fails, then a new session continues with the
+# remaining shaders after the backoff delay, until all tries are used up or
+# the scheduler marks the game as bad.  The optional report is called with the
+# title and shaderfile of each job after it is done.  Returns the number of
+# created screenshots.  This is called from the worker threads of capture().
+def run_session_job(
+        title: str, jobs: List[ScreenshotJob], statefiles: List[Pathlib],
+        settings, scheduler: RetryScheduler, ports: queue.Queue,
+        printlock: threading.Lock,
+        report: Union[Callable[[str, Pathlib], None], None] = None) -> int:
+
+    if not settings['quiet']:
+        with printlock:
+            if settings['verbose']:
+                print()
+            print('Processing [' + title + '] ...')
+
+    pending: List[Tuple[ScreenshotJob, Pathlib]] = []
+    for job in jobs:
+        _, shaderfile, key = job
+        _, screenshot_file = build_screenshot_command(shaderfile, title,
+                                                      settings)
+        missing = find_missing_input(settings['games'][title], shaderfile)
+        reason = scheduler.bad_reason(title)
+        if not settings['force'] and settings['cache'].is_current(
+                screenshot_file, key):
+            pass
+        elif reason is not None:
+            scheduler.give_up(job, SKIPPED, reason)
+        elif missing is not None:
+            scheduler.finish(job, 1, MISSING_INPUT, None, missing)
+        else:
+            pending.append((job, screenshot_file))
+            continue
+        if report is not None:
+            report(title, shaderfile)
+
+    created_screenshots = 0
+    attempt = 0
+    outcome = SKIPPED
+    trace: Tracer = settings['trace']
+    port = ports.get()
+    try:
+        with lease_display(settings['displays']) as env:
+            while (pending and attempt < settings['tries']
+                   and scheduler.bad_reason(title) is None):
+                if attempt > 0:
+                    time.sleep(backoff_delay(attempt))
+                attempt += 1
+                start = time.time()
+                with RetroArchSession(settings['games'][title],
+                                      statefiles,
+                                      settings['statesdir'],
+                                      settings['configcontent'],
+                                      settings['outputdir'],
+                                      port,
+                                      settings['timeout'],
+                                      env) as session:
+                    if not settings['quiet'] and settings['verbose']:
+                        with printlock:
+                            print()
+                            print(session.command)
+                    with trace.span('session start',
+                                    title=title,
+                                    attempt=attempt) as event:
+                        started = session.start()
+                        event['ok'] = started
+                    while started and pending:
+                        job, screenshot_file = pending[0]
+                        with trace.span('session shot',
+                                        title=title,
+                                        file=screenshot_file,
+                                        attempt=attempt) as event:
+                            shot = session.shoot(job[1], screenshot_file)
+                            event['ok'] = shot
+                            event['size'] = file_size(screenshot_file)
+                        if not shot:
+                            break
+                        settings['cache'].record(screenshot_file, job[2])
+                        scheduler.finish(job, attempt, CREATED)
+                        created_screenshots += 1
+                        pending.pop(0)
+                        if report is not None:
+                            report(title, job[1])
+                    if pending:
+                        outcome, exitcode = session.failure()
+                        scheduler.fail_attempt(pending[0][0], attempt, outcome,
+                                               exitcode)
+                exitcode = None
+                if session.process is not None:
+                    exitcode = session.process.returncode
+                trace.record('retroarch',
+                             start,
+                             time.time(),
+                             title=title,
+                             attempt=attempt,
+                             exit=exitcode)
+    finally:
+        ports.put(port)
+
+    for job, _ in pending:
+        scheduler.give_up(job, outcome, scheduler.bad_reason(title) or '')
+        if report is not None:
+            report(title, job[1])
+
+    return created_screenshots
+
+
+# Report the events of a finished job to the listener of capture().  A
+# "screenshot" event names the file of each existing screenshot, no matter if
+# it was created now or before.  The "game" event follows after the last job of
+# a game is done, including failed and skipped ones.  The listener is never
+# called twice at the same time.  See build_job_report().
+def report_job_events(
+        title: str, shaderfile: Pathlib, settings, remaining: Dict[str, int],
+        listener: Listener, listenerlock: threading.Lock) -> None:
+
+    _, screenshot_file = build_screenshot_command(shaderfile, title, settings)
+    with listenerlock:
+        if screenshot_file.exists():
+            listener({'event': 'screenshot',
+                      'title': title,
+                      'file': screenshot_file})
+        remaining[title] -= 1
+        if remaining[title] == 0:
+            listener({'event': 'game', 'title': title})
+
+
+# Create a dictionary of settings for capture().  The games and shaders are
+# read once with games_from_gamelist() and shaders_from_shaderlist(), so they
+# can be shared between multiple runs.  The optional plan is an open JobPlan
+# to take the jobs from, trace a Tracer to record the timing of RetroArch
+# and the screenshot files in, journal a RunJournal to resume an interrupted
+# run from, displays a DisplayPool to run RetroArch headless on and staging
+# a StagingArea to run RetroArch from memory, which session mode does not
+# support.  All other arguments have the same meaning and defaults as the
+# options of the screenshot.py commandline.  The values can have any type, so
+# due to the complexity no type checking is done.
+def build_capture_settings(
+        games: GamelistEntry,
+        shaders: List[Pathlib],
+        config: str = '~/.config/retroarch/retroarch.cfg',
+        appendconfig: Union[List[str], None] = None,
+        shaderdir: str = '~/.config/retroarch/shaders/shaders_slang/',
+        outputdir: str = 'screenshots/',
+        statesdir: str = 'states/',
+        window: Union[str, None] = None,
+        tries: int = 5,
+        timeout: float = 60.0,
+        jobs: int = 1,
+        compileconfig: bool = True,
+        session: bool = False,
+        port: int = SESSION_PORT,
+        plan=None,
+        trace: Union[Tracer, None] = None,
+        journal: Union[RunJournal, None] = None,
+        displays: Union[DisplayPool, None] = None,
+        staging: Union[StagingArea, None] = None,
+        dedup: bool = False,
+        format: str = 'png',
+        force: bool = False,
+        verbose: bool = False,
+        quiet: bool = False):
+
+    settings = {}
+    settings['config'] = path(config)
+    if appendconfig:
+        settings['appendconfig'] = list(reversed([path(file) for
+                                                  file in appendconfig]))
+    else:
+        settings['appendconfig'] = ['append.cfg']
+    settings['games'] = games
+    settings['shaders'] = shaders
+    settings['shaderdir'] = path(shaderdir)
+    settings['outputdir'] = path(outputdir)
+    settings['statesdir'] = path(statesdir)
+    settings['window'] = window
+    settings['tries'] = tries
+    settings['timeout'] = timeout
+    if jobs < 1:
+        raise ValueError('--jobs accepts only 1 or higher: ' + str(jobs))
+    settings['jobs'] = jobs
+    settings['force'] = force
+    settings['verbose'] = verbose
+    settings['quiet'] = quiet
+    settings['compileconfig'] = compileconfig
+    settings['session'] = session
+    settings['port'] = port
+    settings['plan'] = plan
+    settings['trace'] = trace or Tracer()
+    settings['displays'] = displays
+    if staging is not None and session:
+        raise ValueError('--stage is not supported with --session')
+    settings['staging'] = staging
+    settings['dedup'] = dedup
+    if format not in SCREENSHOT_FORMATS:
+        raise ValueError('--format accepts only '
+                         + ', '.join(SCREENSHOT_FORMATS) + ': ' + str(format))
+    settings['format'] = format
+    settings['configcontent'] = build_compiled_config(
+            settings['config'],
+            settings['appendconfig'],
+            settings['window'],
+            settings['statesdir'])
+    settings['tempconfigs'] = []
+    if not compileconfig:
+        settings['tempconfigs'] = [create_tempconfig(settings)
+                                   for _ in range(settings['jobs'])]
+    settings['cache'] = BuildCache(settings['outputdir'], journal)
+
+    return settings
+
+
+# Expand the game and shader matrix of settings into single screenshot jobs.
+# Each job is the title, shaderfile and cache key of one screenshot, in order
+# of the games and shaders.  The keys are only built when the job is taken,
+# so the first jobs can start while later inputs are still hashed.
+def iterate_screenshot_jobs(
+        settings) -> Iterator[ScreenshotJob]:
+
+    cache = settings['cache']
+    configdigest = hashlib.sha256(
+            settings['configcontent'].encode()).hexdigest()
+    shaderfiles: Dict[Pathlib, List[Pathlib]] = {}
+    statefiles = list(settings['statesdir'].rglob('*.entry'))
+    for title in settings['games']:
+        game = settings['games'][title]
+        gamestates = collect_state_files(statefiles,
+                                         game['game'],
+                                         game['slot'])
+        for shaderfile in settings['shaders']:
+            if shaderfile not in shaderfiles:
+                shaderfiles[shaderfile] = collect_shader_files(shaderfile)
+            key = build_screenshot_key(cache,
+                                       game,
+                                       shaderfiles[shaderfile],
+                                       gamestates,
+                                       configdigest,
+                                       settings['window'])
+            yield title, shaderfile, key
+
+
+# Get the screenshot jobs of settings, from the compiled job plan if there is
+# one, see JobPlan.screenshot_jobs().
+def take_screenshot_jobs(
+        settings) -> Iterator[ScreenshotJob]:
+
+    if settings['plan'] is not None:
+        return settings['plan'].screenshot_jobs(settings)
+
+    return iterate_screenshot_jobs(settings)
+
+
+# Wait until less than limit futures are running and add up the results of
+# the finished ones.  Returns the still running futures and the sum.
+def drain_futures(
+        futures: Set[concurrent.futures.Future],
+        limit: int) -> Tuple[Set[concurrent.futures.Future], int]:
+
+    result = 0
+    while len(futures) >= limit:
+        done, futures = concurrent.futures.wait(
+                futures, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            result += future.result()
+
+    return futures, result
+
+
+# Get the function to report the events of finished jobs to the listener of
+# capture(), or None without a listener.  It is called with the title and
+# shaderfile of the job.
+def build_job_report(
+        settings, listener: Union[Listener, None]
+        ) -> Union[Callable[[str, Pathlib], None], None]:
+
+    if listener is None:
+        return None
+    remaining = {title: len(settings['shaders'])
+                 for title in settings['games']}
+
+    return functools.partial(report_job_events,
+                             settings=settings,
+                             remaining=remaining,
+                             listener=listener,
+                             listenerlock=threading.Lock())
+
+
+# Save the failure report of the scheduler and tell about it.
+def finish_failure_report(
+        settings, scheduler: RetryScheduler) -> None:
+
+    report = scheduler.report()
+    file = write_failure_report(settings['outputdir'], report)
+    if report['failures'] and not settings['quiet']:
+        print()
+        print(str(len(report['failures'])) + ' screenshot(s) failed, see '
+              + file.as_posix())
+
+
+# The dedup stage after capture, see deduplicate_screenshots().  The
+# screenshots of each game are given in the order of the shaderlist.
+def dedup_capture(
+        settings) -> int:
+
+    files: Dict[str, List[Pathlib]] = {}
+    for title, game in settings['games'].items():
+        files[title] = [build_screenshot_path(shaderfile,
+                                              settings['shaderdir'],
+                                              settings['outputdir'],
+                                              title,
+                                              game['sep'],
+                                              '.' + settings['format'])
+                        for shaderfile in settings['shaders']]
+    linked = deduplicate_screenshots(settings, files)
+    settings['cache'].save()
+    if not settings['quiet']:
+        print()
+        print(str(linked) + " duplicate screenshot(s) linked.")
+
+    return linked
+
+
+# Take a screenshot of every game with every shader, as set up in settings
+# from build_capture_settings().  Only missing or outdated screenshots are
+# created.  The optional listener is called with the events of each finished
+# screenshot and game, see report_job_events().  The jobs are streamed to the
+# worker threads, with only a few of them waiting at any time.  A failed job is
+# tried again later by the RetryScheduler, and the failures are saved in a
+# report in the output folder.  Staged screenshots are moved into place in
+# batches and only reported to the listener afterwards.  With dedup set,
+# duplicate screenshots are hardlinked at the end, see dedup_capture().
+# Returns the number of created screenshots.
+def capture(
+        settings, listener: Union[Listener, None] = None) -> int:
+
+    if settings['session']:
+        return capture_sessions(settings, listener)
+
+    tempconfigs = fill_tempconfigs(settings)
+    printlock = threading.Lock()
+    report = build_job_report(settings, listener)
+    scheduler = RetryScheduler(take_screenshot_jobs(settings),
+                               settings['games'],
+                               settings['tries'])
+
+    created_screenshots = 0
+    finished_jobs: List[ScreenshotJob] = []
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings['jobs']) as executor:
+            running: Dict[concurrent.futures.Future,
+                          Tuple[ScreenshotJob, int]] = {}
+            while True:
+                while len(running) < settings['jobs'] * 2:
+                    item, skipped = scheduler.take()
+                    if report is not None:
+                        for title, shaderfile, _ in skipped:
+                            report(title, shaderfile)
+                    if item is None:
+                        break
+                    (title, shaderfile, key), attempt = item
+                    future = executor.submit(run_screenshot_job,
+                                             title,
+                                             shaderfile,
+                                             key,
+                                             attempt,
+                                             settings,
+                                             tempconfigs,
+                                             printlock)
+                    running[future] = item
+                wait = scheduler.wait_time()
+                if not running:
+                    if wait is None:
+                        break
+                    time.sleep(wait)
+                    continue
+                finished, _ = concurrent.futures.wait(
+                        running,
+                        timeout=wait or None,
+                        return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in finished:
+                    job, attempt = running.pop(future)
+                    outcome, exitcode, message = future.result()
+                    if outcome == CREATED:
+                        created_screenshots += 1
+                    if scheduler.finish(job, attempt, outcome, exitcode,
+                                        message):
+                        finished_jobs.append(job)
+                release_staged_games(settings, scheduler)
+                if flush_staged_screenshots(settings, not running):
+                    if report is not None:
+                        for title, shaderfile, _ in finished_jobs:
+                            report(title, shaderfile)
+                    finished_jobs = []
+    finally:
+        release_staged_games(settings, scheduler, True)
+        flush_staged_screenshots(settings, True)
+        settings['cache'].save()
+        finish_failure_report(settings, scheduler)
+
+    if not settings['quiet']:
+        print()
+        print(str(created_screenshots) + " screenshot(s) created.")
+    if settings['dedup']:
+        dedup_capture(settings)
+
+    return created_screenshots
+
+
+# The session mode of capture(): one job per game instead of one per game and
+# shader, each with its own RetroArch process and network command port.
+def capture_sessions(
+        settings, listener: Union[Listener, None] = None) -> int:
+
+    ports: queue.Queue = queue.Queue()
+    for offset in range(settings['jobs']):
+        ports.put(settings['port'] + offset)
+    printlock = threading.Lock()
+    report = build_job_report(settings, listener)
+    scheduler = RetryScheduler(iter([]), settings['games'], settings['tries'])
+    statefiles = list(settings['statesdir'].rglob('*.entry'))
+
+    created_screenshots = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(
+                max_workers=settings['jobs']) as executor:
+            futures: Set[concurrent.futures.Future] = set()
+            for title, jobs in itertools.groupby(
+                    take_screenshot_jobs(settings), lambda job: job[0]):
+                game = settings['games'][title]
+                gamestates = collect_state_files(statefiles,
+                                                 game['game'],
+                                                 game['slot'])
+                futures, created = drain_futures(futures,
+                                                 settings['jobs'] * 2)
+                created_screenshots += created
+                futures.add(executor.submit(run_session_job,
+                                            title,
+                                            list(jobs),
+                                            gamestates,
+                                            settings,
+                                            scheduler,
+                                            ports,
+                                            printlock,
+                                            report))
+            _, created = drain_futures(futures, 1)
+            created_screenshots += created
+    finally:
+        settings['cache'].save()
+        finish_failure_report(settings, scheduler)
+
+    if not settings['quiet']:
+        print()
+        print(str(created_screenshots) + " screenshot(s) created.")
+    if settings['dedup']:
+        dedup_capture(settings)
+
+    return created_screenshots
@@ -0,0 +1,227 @@
+# Session mode: a single RetroArch process per game, remote controlled over
+# its network command interface to take the screenshot of every shader.
+
+import time
+import shutil
+import socket
+import pathlib
+import tempfile
+import subprocess
+
+from typing import Union, Dict, List, Tuple
+
+from .common import Pathlib
+from .watcher import ScreenshotWatcher, POLL_INTERVAL, EXIT_GRACE
+from .scheduler import CRASH, TIMEOUT, NO_OUTPUT
+from .frames import store_screenshot
+
+# Default UDP port of the RetroArch network commands.  Parallel sessions use
+# the following port numbers.
+SESSION_PORT = 55355
+# Seconds to wait for an answer of RetroArch to a single command.
+REPLY_TIMEOUT = 1.0
+
+
+# Settings on top of the compiled configuration for a session.  RetroArch
+# listens for commands on port, saves screenshots with a fixed name into
+# screenshotdir and finds the save state of the game in statesdir.
+def build_sessionconfig(
+        port: int, screenshotdir: Pathlib, statesdir: Pathlib,
+        slot: int) -> List[str]:
+
+    config: List[str] = []
+    config.append('network_cmd_enable = "true"')
+    config.append(f'network_cmd_port = "{port}"')
+    config.append('screenshot_directory = "'
+                  + screenshotdir.as_posix() + '"')
+    config.append('auto_screenshot_filename = "false"')
+    config.append('savestate_directory = "' + statesdir.as_posix() + '"')
+    config.append(f'state_slot = "{slot}"')
+    config.append('savestate_auto_load = "false"')
+    config.append('pause_nonactive = "false"')
+
+    return config
+
+
+# A running RetroArch with the game loaded, which is controlled by sending
+# plain text commands as UDP packets to localhost, such as "SET_SHADER",
+# "LOAD_STATE", "FRAMEADVANCE" and "SCREENSHOT".  All files of the session are
+# kept in a temporary folder inside the output folder, so finished screenshots
+# can be moved into place without copying.  The entry save state of the game
+# is copied there as the regular save state of the slot, so "LOAD_STATE"
+# resets the game for every shader.  RetroArch is started with the
+# environment env, or the one of this process if None.
+class RetroArchSession:
+
+    def __init__(
+            self, game, statefiles: List[Pathlib], statesdir: Pathlib,
+            configcontent: str, outputdir: Pathlib, port: int,
+            timeout: float, env: Union[Dict[str, str], None] = None):
+
+        self.game = game
+        self.env = env
+        self.port = port
+        self.timeout = timeout
+        self.process: Union[subprocess.Popen, None] = None
+        self.socket: Union[socket.socket, None] = None
+        outputdir.mkdir(parents=True, exist_ok=True)
+        self.folder = pathlib.Path(tempfile.mkdtemp(prefix='.session-',
+                                                    dir=outputdir))
+        self.screenshotdir = pathlib.Path(self.folder / 'screenshots')
+        self.screenshotdir.mkdir()
+        self.statesdir = pathlib.Path(self.folder / 'states')
+        self.statesdir.mkdir()
+        for file in statefiles:
+            relative = file.relative_to(statesdir.expanduser().resolve())
+            target = pathlib.Path(self.statesdir / relative.parent
+                                  / file.name.removesuffix('.entry'))
+            target.parent.mkdir(parents=True, exist_ok=True)
+            shutil.copyfile(file, target)
+        self.config = pathlib.Path(self.folder / 'session.cfg')
+        with open(self.config, 'w') as f:
+            for line in build_sessionconfig(port, self.screenshotdir,
+                                            self.statesdir, game['slot']):
+                f.write(line + '\n')
+            f.write(configcontent)
+        self.screenshot = pathlib.Path(self.screenshotdir
+                                       / (game['game'].stem + '.png'))
+        self.command: List[str] = []
+        self.command.append('retroarch')
+        self.command.append('--config')
+        self.command.append(self.config.as_posix())
+        self.command.append('--sram-mode')
+        self.command.append('noload-nosave')
+        self.command.append('--libretro')
+        self.command.append(str(game['core']))
+        self.command.append(str(game['game']))
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    # Start RetroArch with the game and wait until it answers to commands.
+    # The game is paused right away, so frames are only advanced on request.
+    # Returns False if RetroArch did not come up within the timeout.
+    def start(self) -> bool:
+
+        self.process = subprocess.Popen(self.command, env=self.env)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.connect(('127.0.0.1', self.port))
+
+        deadline = time.monotonic() + self.timeout
+        while time.monotonic() < deadline and self.process.poll() is None:
+            status = self.status()
+            if status == 'PAUSED':
+                return True
+            if status == 'PLAYING':
+                self.send('PAUSE_TOGGLE')
+                continue
+            time.sleep(POLL_INTERVAL)
+
+        return False
+
+    # Classify why the last start or shot failed, as outcome of the
+    # scheduler: "crash" if RetroArch quit with an error, "no output" if it
+    # quit without one, or "timeout" if it still runs but stopped to answer
+    # or to save screenshots.  Also returns the exit code, if it quit.
+    def failure(self) -> Tuple[str, Union[int, None]]:
+
+        if self.process is None or self.process.poll() is None:
+            return TIMEOUT, None
+        if self.process.returncode != 0:
+            return CRASH, self.process.returncode
+
+        return NO_OUTPUT, self.process.returncode
+
+    # Quit RetroArch, or kill it if it does not quit in time.
+    def close(self) -> None:
+
+        if self.process is not None and self.process.poll() is None:
+            self.send('QUIT')
+            try:
+                self.process.wait(timeout=EXIT_GRACE)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        if self.socket is not None:
+            self.socket.close()
+            self.socket = None
+
+    # Send a single command without waiting for an answer.
+    def send(
+            self, command: str) -> None:
+
+        if self.socket is None:
+            return
+        try:
+            self.socket.send(command.encode())
+        except OSError:
+            pass
+
+    # Send a command that RetroArch answers and return the answer, or None if
+    # nothing came back in time.
+    def request(
+            self, command: str) -> Union[str, None]:
+
+        if self.socket is None:
+            return None
+        self.send(command)
+        self.socket.settimeout(REPLY_TIMEOUT)
+        try:
+            while True:
+                reply = self.socket.recv(4096).decode(errors='replace')
+                if reply.startswith(command.split()[0]):
+                    return reply.strip()
+        except OSError:
+            return None
+
+    # State of the running content: "PAUSED", "PLAYING", "CONTENTLESS" or None
+    # if RetroArch does not answer.
+    def status(self) -> Union[str, None]:
+
+        reply = self.request('GET_STATUS')
+        if reply is None:
+            return None
+        words = reply.split()
+
+        return words[1] if len(words) > 1 else None
+
+    # Send a command and wait until RetroArch has handled it.  Commands are
+    # processed once per frame, so the answer to the following status request
+    # proves that the frame with the command is done.  This keeps a series of
+    # "FRAMEADVANCE" commands from being merged into one frame.
+    def execute(
+            self, command: str) -> bool:
+
+        self.send(command)
+
+        return self.status() is not None
+
+    # Take the screenshot of a single shader: load the shader, reset the game
+    # with the save state, advance the frames and save the screenshot.  It is
+    # stored as outfile once completely written, see store_screenshot().
+    # Returns False on failure, after which the session should be restarted.
+    def shoot(
+            self, shaderfile: Pathlib, outfile: Pathlib) -> bool:
+
+        if self.process is None or self.process.poll() is not None:
+            return False
+        self.screenshot.unlink(missing_ok=True)
+        with ScreenshotWatcher(self.screenshot) as watcher:
+            commands: List[str] = []
+            commands.append('SET_SHADER ' + shaderfile.as_posix())
+            commands.append('LOAD_STATE')
+            commands.extend(['FRAMEADVANCE'] * int(self.game['frames']))
+            commands.append('SCREENSHOT')
+            for command in commands:
+                if not self.execute(command):
+                    return False
+            if not watcher.wait_written(self.process, self.timeout):
+                return False
+
+        return store_screenshot(self.screenshot, outfile)
@@ -0,0 +1,284 @@
+# Staging of the RetroArch inputs and screenshots in a folder in memory, for
+# slow disks such as network shares.
+
+import os
+import atexit
+import shutil
+import pathlib
+import hashlib
+import tempfile
+import threading
+
+from typing import Union, Dict, List, Tuple, Set, Hashable
+
+from .common import Pathlib, partial_path, finish_partial
+
+# The ioctl to reflink files is Linux only.  Without it, files are copied.
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+# Folder in memory (tmpfs) on Linux, where the staging area is created by
+# default.  If it is missing, the temporary folder of the system is used.
+STAGING_ROOT = '/dev/shm'
+# Bytes of staged screenshots collected before all of them are moved to their
+# output folders at once.
+STAGING_BATCH = 64 * 1024 * 1024
+# Inputs larger than this are not staged and read from where they are, so a
+# CD image does not fill up the memory.
+STAGING_LIMIT = 256 * 1024 * 1024
+# Bytes of all staged inputs together.  Once reached, further cores and games
+# are read from where they are, until staged inputs are released.
+STAGING_CAPACITY = 1024 * 1024 * 1024
+# Request code of the FICLONE ioctl, see "man 2 ioctl_ficlone".
+FICLONE = 0x40049409
+
+
+# Copy source to target, as a reflink sharing the data if the file system
+# supports it, such as Btrfs and XFS.  Otherwise the data is copied.
+def copy_or_reflink(
+        source: Pathlib, target: Pathlib) -> None:
+
+    if fcntl is not None:
+        with open(source, 'rb') as infile, open(target, 'wb') as outfile:
+            try:
+                fcntl.ioctl(outfile.fileno(), FICLONE, infile.fileno())
+                return
+            except OSError:
+                pass
+    shutil.copyfile(source, target)
+
+
+# Move a file to target, which appears there in one step.  If both are on
+# different file systems, the file is copied under the partial name of target
+# first and then renamed.  Returns True on success.
+def move_file(
+        source: Pathlib, target: Pathlib) -> bool:
+
+    try:
+        os.replace(source, target)
+        return True
+    except FileNotFoundError:
+        return False
+    except OSError:
+        pass
+    copy_or_reflink(source, partial_path(target))
+    if not finish_partial(target):
+        return False
+    source.unlink()
+
+    return True
+
+
+# A temporary folder in memory, which RetroArch reads its inputs from and
+# writes the screenshots to, instead of the disk.  The core, game and entry
+# save states of a game are copied in with stage_game() when it is first
+# needed and reused from there for all of its shaders, until every holder of
+# them called release().  Inputs larger than the limit stay on disk, and so
+# do cores and games once the staged inputs add up to capacity.  The save
+# states are always staged, under the same relative path in statesdir, which
+# the staged config from write_config() points to.
+# Screenshots are stored under output_path() and handed over with move().
+# Once batch bytes of them are collected, flush() moves all to their final
+# place at once.  The folder is deleted with close(), or at the latest when
+# the script ends, together with any screenshot not moved yet.  Safe to use
+# from multiple threads.
+class StagingArea:
+
+    def __init__(
+            self, root: Union[Pathlib, None] = None,
+            batch: int = STAGING_BATCH, limit: int = STAGING_LIMIT,
+            capacity: int = STAGING_CAPACITY):
+
+        if root is None and os.access(STAGING_ROOT, os.W_OK):
+            root = pathlib.Path(STAGING_ROOT)
+        self.folder = pathlib.Path(tempfile.mkdtemp(prefix='snapscreen-',
+                                                    dir=root))
+        atexit.register(self.close)
+        self.statesdir = pathlib.Path(self.folder / 'states')
+        self.statesdir.mkdir()
+        self.batch = batch
+        self.limit = limit
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.inputs: Dict[Pathlib, Pathlib] = {}
+        self.sizes: Dict[Pathlib, int] = {}
+        self.holders: Dict[Hashable, Set[Pathlib]] = {}
+        self.used = 0
+        self.count = 0
+        self.statefiles: Dict[Pathlib, List[Pathlib]] = {}
+        self.pending: List[Tuple[Pathlib, Pathlib, str]] = []
+        self.size = 0
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    # Remember the staged copy of an input file with its size for holder.
+    # The lock must be held.
+    def add_input(
+            self, file: Pathlib, staged: Pathlib, size: int,
+            holder: Hashable) -> None:
+
+        self.inputs[file] = staged
+        self.sizes[file] = size
+        self.used += size
+        self.holders.setdefault(holder, set()).add(file)
+
+    # Get the staged copy of an input file for holder, which is made on the
+    # first call.  The copy keeps the name of the file, as RetroArch finds the
+    # save states of a game by its name.  A missing or too large file, or one
+    # which does not fit into the capacity left, is not staged and returned
+    # as it is.  The lock must be held.
+    def stage_file(
+            self, file: Pathlib, holder: Hashable) -> Pathlib:
+
+        if file in self.inputs:
+            self.holders.setdefault(holder, set()).add(file)
+            return self.inputs[file]
+        try:
+            size = file.stat().st_size
+        except FileNotFoundError:
+            return file
+        if size > self.limit or self.used + size > self.capacity:
+            return file
+        folder = pathlib.Path(self.folder / 'inputs' / str(self.count))
+        self.count += 1
+        folder.mkdir(parents=True)
+        staged = pathlib.Path(folder / file.name)
+        copy_or_reflink(file, staged)
+        self.add_input(file, staged, size, holder)
+
+        return staged
+
+    # Get the entry save state files in the original statesdir, which is
+    # searched only once.  The lock must be held.
+    def find_statefiles(
+            self, statesdir: Pathlib) -> List[Pathlib]:
+
+        if statesdir not in self.statefiles:
+            self.statefiles[statesdir] = list(statesdir.rglob('*.entry'))
+
+        return self.statefiles[statesdir]
+
+    # Stage the inputs of a game from the gamelist for holder and get a copy
+    # of the game with the core and game pointing to the staged files.  Its
+    # entry save states of the original statesdir are copied into the staged
+    # statesdir.  The holder names the user of the inputs, such as a game in
+    # one capture stage, see release().
+    def stage_game(
+            self, game: Dict[str, Union[str, int, Pathlib]],
+            statesdir: Pathlib,
+            holder: Hashable) -> Dict[str, Union[str, int, Pathlib]]:
+
+        name = game['game'].stem + '.state' + str(game['slot']) + '.entry'
+        with self.lock:
+            staged = dict(game)
+            staged['core'] = self.stage_file(game['core'], holder)
+            staged['game'] = self.stage_file(game['game'], holder)
+            for file in self.find_statefiles(statesdir):
+                if file.name != name:
+                    continue
+                if file in self.inputs:
+                    self.holders.setdefault(holder, set()).add(file)
+                    continue
+                target = pathlib.Path(self.statesdir
+                                      / file.relative_to(statesdir))
+                target.parent.mkdir(parents=True, exist_ok=True)
+                copy_or_reflink(file, target)
+                self.add_input(file, target, target.stat().st_size, holder)
+
+        return staged
+
+    # Delete the staged inputs of holder, which no other holder uses, so the
+    # memory is free for the next games.  Returns the number of freed bytes.
+    def release(
+            self, holder: Hashable) -> int:
+
+        freed = 0
+        with self.lock:
+            files = self.holders.pop(holder, set())
+            for file in files:
+                if any(file in other for other in self.holders.values()):
+                    continue
+                staged = self.inputs.pop(file)
+                size = self.sizes.pop(file)
+                staged.unlink(missing_ok=True)
+                if not staged.is_relative_to(self.statesdir):
+                    shutil.rmtree(staged.parent, ignore_errors=True)
+                self.used -= size
+                freed += size
+
+        return freed
+
+    # Write the RetroArch config with content into the staging area, named
+    # after the hash of its content like write_compiled_config().
+    def write_config(
+            self, content: str) -> Pathlib:
+
+        digest = hashlib.sha256(content.encode()).hexdigest()
+        config = pathlib.Path(self.folder / ('config-' + digest[:32] + '.cfg'))
+        with self.lock:
+            if not config.exists():
+                with open(partial_path(config), 'w') as f:
+                    f.write(content)
+                finish_partial(config)
+
+        return config
+
+    # Get the file in the staging area to store an output file in at first.
+    def output_path(
+            self, file: Pathlib) -> Pathlib:
+
+        digest = hashlib.sha1(file.as_posix().encode()).hexdigest()[:16]
+        folder = pathlib.Path(self.folder / 'outputs' / digest)
+        folder.mkdir(parents=True, exist_ok=True)
+
+        return pathlib.Path(folder / file.name)
+
+    # Hand over a staged output file, which is moved to file with the next
+    # flush().  The key is given back by flush() to record it in the cache.
+    def move(
+            self, staged: Pathlib, file: Pathlib, key: str) -> None:
+
+        size = staged.stat().st_size
+        with self.lock:
+            self.pending.append((staged, file, key))
+            self.size += size
+
+    # True if enough outputs are collected to be moved, see flush().
+    def full(self) -> bool:
+
+        with self.lock:
+            return self.size >= self.batch
+
+    # Number of outputs waiting to be moved.
+    def waiting(self) -> int:
+
+        with self.lock:
+            return len(self.pending)
+
+    # Move all staged outputs to their final place.  Returns each moved file
+    # together with its key.
+    def flush(self) -> List[Tuple[Pathlib, str]]:
+
+        with self.lock:
+            pending = self.pending
+            self.pending = []
+            self.size = 0
+        moved: List[Tuple[Pathlib, str]] = []
+        for staged, file, key in pending:
+            if move_file(staged, file):
+                moved.append((file, key))
+
+        return moved
+
+    # Delete the staging area with everything in it.
+    def close(self) -> None:
+
+        shutil.rmtree(self.folder, ignore_errors=True)
@@ -0,0 +1,135 @@
+# Timing of every external program and every wait for a file, written as json
+# lines for later analysis and summed up per stage at the end.
+
+import json
+import math
+import time
+import threading
+import contextlib
+
+from typing import Union, Dict, List, Iterator
+
+from .common import Pathlib
+
+
+# Get the value at percent of the sorted list of values, with the nearest
+# rank method.
+def percentile(
+        values: List[float], percent: float) -> float:
+
+    rank = max(1, math.ceil(len(values) * percent / 100))
+
+    return values[rank - 1]
+
+
+# Size of a file in bytes, or None if it does not exist.
+def file_size(
+        file: Pathlib) -> Union[int, None]:
+
+    try:
+        return file.stat().st_size
+    except FileNotFoundError:
+        return None
+
+
+# Collects timed events of a run.  Each event belongs to a stage, such as
+# "retroarch" or "convert", and has its start and end as unix timestamps plus
+# any additional fields, like the exit code, the number of the attempt or the
+# size of the output file.  With a file every event is written to it as a
+# json line, right when it ends.  Without a file the Tracer does nothing, so
+# the code does not need to check if tracing is on.  Events can be recorded
+# from any thread.
+class Tracer:
+
+    def __init__(
+            self, file: Union[Pathlib, None] = None):
+
+        self.lock = threading.Lock()
+        self.durations: Dict[str, List[float]] = {}
+        self.output = None
+        if file is not None:
+            file.parent.mkdir(parents=True, exist_ok=True)
+            self.output = open(file, 'w', encoding='utf-8')
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        self.close()
+
+    # True if events are recorded at all.
+    def enabled(self) -> bool:
+
+        return self.output is not None
+
+    # Add an event of stage, which ran from start to end.
+    def record(
+            self, stage: str, start: float, end: float, **fields) -> None:
+
+        if self.output is None:
+            return
+        event = {'stage': stage,
+                 'start': round(start, 6),
+                 'end': round(end, 6),
+                 'duration': round(end - start, 6)}
+        event.update(fields)
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self.lock:
+            self.durations.setdefault(stage, []).append(end - start)
+            self.output.write(line + '\n')
+            self.output.flush()
+
+    # Time the code in the with block as event of stage.  The fields are
+    # yielded as a dictionary, so the block can add results to the event.
+    @contextlib.contextmanager
+    def span(
+            self, stage: str, **fields) -> Iterator[dict]:
+
+        start = time.time()
+        try:
+            yield fields
+        finally:
+            self.record(stage, start, time.time(), **fields)
+
+    # Get the number, total, p50, p95 and maximum of the durations of each
+    # stage, in seconds.
+    def summary(self) -> Dict[str, Dict[str, float]]:
+
+        summary: Dict[str, Dict[str, float]] = {}
+        with self.lock:
+            for stage, durations in self.durations.items():
+                values = sorted(durations)
+                summary[stage] = {'count': len(values),
+                                  'total': round(sum(values), 6),
+                                  'p50': round(percentile(values, 50), 6),
+                                  'p95': round(percentile(values, 95), 6),
+                                  'max': round(values[-1], 6)}
+
+        return summary
+
+    # Print the summary as a table.
+    def print_summary(self) -> None:
+
+        summary = self.summary()
+        if not summary:
+            return
+        print()
+        print(f'{"stage":<16} {"count":>7} {"total s":>9} {"p50 s":>8}'
+              f' {"p95 s":>8} {"max s":>8}')
+        for stage, values in summary.items():
+            print(f'{stage:<16} {values["count"]:>7} {values["total"]:>9.3f}'
+                  f' {values["p50"]:>8.3f} {values["p95"]:>8.3f}'
+                  f' {values["max"]:>8.3f}')
+
+    # Write the summary as last line and close the file.
+    def close(self) -> None:
+
+        if self.output is None:
+            return
+        line = json.dumps({'summary': self.summary()})
+        with self.lock:
+            self.output.write(line + '\n')
+            self.output.close()
+            self.output = None
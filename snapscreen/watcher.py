@@ -0,0 +1,217 @@
+# Detection of finished screenshot files written by RetroArch.
+
+import os
+import time
+import asyncio
+import subprocess
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from typing import Union, Tuple
+
+from .common import Pathlib
+
+# Flags from the Linux inotify interface, see "man 7 inotify".
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+INOTIFY_EVENT = struct.Struct('iIII')
+
+# Seconds between checks of the process and screenshot file while waiting.
+POLL_INTERVAL = 0.05
+# Seconds RetroArch gets to quit after the screenshot is completely written,
+# before it is killed.
+EXIT_GRACE = 5.0
+
+
+# Load the C library to access the inotify functions.  Returns None if this is
+# not available, such as on non Linux systems.
+def load_libc() -> Union[ctypes.CDLL, None]:
+
+    name = ctypes.util.find_library('c')
+    if not name:
+        return None
+    try:
+        libc = ctypes.CDLL(name, use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+    except (OSError, AttributeError):
+        return None
+
+    return libc
+
+
+libc = load_libc()
+
+
+# Get a snapshot of file size and modification time to detect changes.  None
+# if the file does not exist.
+def file_signature(
+        file: Pathlib) -> Union[Tuple[int, int], None]:
+
+    try:
+        stat = file.stat()
+    except FileNotFoundError:
+        return None
+
+    return (stat.st_size, stat.st_mtime_ns)
+
+
+# Watches the folder of the screenshot file for the moment RetroArch finished
+# writing it.  If possible the kernel is asked through inotify to report when
+# the file is closed after writing.  Otherwise the file is polled until its
+# size stops changing.  Must be created before starting RetroArch, so no event
+# is missed.  A previous version of the file from an earlier run (with option
+# --force) does not count as new screenshot.
+class ScreenshotWatcher:
+
+    def __init__(
+            self, file: Pathlib):
+
+        self.file = file
+        self.before = file_signature(file)
+        self.written_at: Union[float, None] = None
+        self.killed = False
+        self.last = self.before
+        self.fd = -1
+        if libc is not None:
+            self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+            if self.fd >= 0:
+                wd = libc.inotify_add_watch(self.fd,
+                                            os.fsencode(file.parent),
+                                            IN_CLOSE_WRITE | IN_MOVED_TO)
+                if wd < 0:
+                    os.close(self.fd)
+                    self.fd = -1
+
+    def __enter__(self):
+
+        return self
+
+    def __exit__(self, *exc):
+
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    # True if the screenshot file was replaced by a new one.
+    def changed(self) -> bool:
+
+        signature = file_signature(self.file)
+
+        return signature is not None and signature != self.before
+
+    # Wait up to interval seconds and report if the screenshot was completely
+    # written in the meantime.
+    def written(
+            self, interval: float) -> bool:
+
+        if self.fd < 0:
+            time.sleep(interval)
+            signature = file_signature(self.file)
+            stable = signature == self.last
+            self.last = signature
+            return stable and self.changed()
+
+        ready, _, _ = select.select([self.fd], [], [], interval)
+        if not ready:
+            return False
+        data = os.read(self.fd, 65536)
+        name = os.fsencode(self.file.name)
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = INOTIFY_EVENT.unpack_from(data, offset)
+            offset += INOTIFY_EVENT.size
+            eventname = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if eventname == name and mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+                return True
+
+        return False
+
+    # Wait for the running RetroArch process until the screenshot is written
+    # and the process quits.  If the screenshot is not done after timeout
+    # seconds, or the process does not quit after writing it, then RetroArch
+    # is killed and killed is set.  Returns True if a new screenshot was
+    # created.  The time it was seen completely written is kept in
+    # written_at.
+    def wait(
+            self, process: subprocess.Popen, timeout: float) -> bool:
+
+        deadline = time.monotonic() + timeout
+        written = False
+        while process.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.written(min(remaining, POLL_INTERVAL)):
+                written = True
+                self.written_at = time.time()
+                try:
+                    process.wait(timeout=min(remaining, EXIT_GRACE))
+                except subprocess.TimeoutExpired:
+                    pass
+                break
+        if process.poll() is None:
+            process.kill()
+            process.wait()
+            self.killed = True
+            return written and self.changed()
+
+        return self.changed()
+
+    # The same as wait(), for a process started with
+    # asyncio.create_subprocess_exec().  The event loop goes on with other
+    # work in the meantime.
+    async def wait_async(
+            self, process: asyncio.subprocess.Process,
+            timeout: float) -> bool:
+
+        deadline = time.monotonic() + timeout
+        written = False
+        while process.returncode is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            if self.written(0):
+                written = True
+                self.written_at = time.time()
+                try:
+                    await asyncio.wait_for(process.wait(),
+                                           min(remaining, EXIT_GRACE))
+                except asyncio.TimeoutError:
+                    pass
+                break
+            try:
+                await asyncio.wait_for(process.wait(),
+                                       min(remaining, POLL_INTERVAL))
+            except asyncio.TimeoutError:
+                pass
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+            self.killed = True
+            return written and self.changed()
+
+        return self.changed()
+
+    # Wait for the screenshot of a RetroArch process that keeps running after
+    # it, as in session mode.  Returns True as soon as a new screenshot is
+    # completely written, or False if the process quits or timeout seconds
+    # are over.  The process is not killed.
+    def wait_written(
+            self, process: subprocess.Popen, timeout: float) -> bool:
+
+        deadline = time.monotonic() + timeout
+        while process.poll() is None:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            if self.written(min(remaining, POLL_INTERVAL)) and self.changed():
+                self.written_at = time.time()
+                return True
+
+        return self.changed()
@@ -0,0 +1,47 @@
+# Shared fixtures of the tests.  The scripts run against a generated matrix of
+# fake games and shaders from "bench/run.py", with the fake programs in
+# "bench/bin" in place of RetroArch and ImageMagick.
+
+import os
+import sys
+import importlib.util
+
+import pytest
+
+TESTDIR = os.path.dirname(os.path.abspath(__file__))
+REPODIR = os.path.dirname(TESTDIR)
+BENCHDIR = os.path.join(REPODIR, 'bench')
+
+sys.path.insert(0, REPODIR)
+
+
+def load_bench():
+
+    spec = importlib.util.spec_from_file_location(
+            'bench_run', os.path.join(BENCHDIR, 'run.py'))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    return module
+
+
+# A folder with 2 games and 3 shaders, see generate_matrix() of the bench.
+@pytest.fixture
+def matrix(tmp_path):
+
+    load_bench().generate_matrix(str(tmp_path), 2, 3)
+
+    return tmp_path
+
+
+# The environment to run the scripts in the matrix folder with.
+@pytest.fixture
+def matrix_env(matrix):
+
+    env = dict(os.environ)
+    env['HOME'] = str(matrix / 'home')
+    env['XDG_CACHE_HOME'] = str(matrix / 'cache')
+    env['PATH'] = os.path.join(BENCHDIR, 'bin') + os.pathsep + env['PATH']
+    env['FAKE_RETROARCH_DELAY'] = '0'
+
+    return env
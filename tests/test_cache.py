@@ -0,0 +1,29 @@
+# Outputs the build cache counts as current.
+
+from snapscreen.cache import BuildCache
+
+
+def test_output_without_recorded_key_is_stale(tmp_path):
+
+    outfile = tmp_path / 'Game' / 'shader.png'
+    outfile.parent.mkdir()
+    outfile.write_bytes(b'png')
+    cache = BuildCache(tmp_path)
+
+    assert not cache.is_current(outfile, 'key')
+    assert not cache.is_current(outfile, 'key')
+    assert cache.recorded_key(outfile) is None
+    cache.record(outfile, 'key')
+    assert cache.is_current(outfile, 'key')
+    assert not cache.is_current(outfile, 'other')
+
+
+def test_recorded_key_needs_the_output(tmp_path):
+
+    outfile = tmp_path / 'shader.png'
+    cache = BuildCache(tmp_path)
+    cache.record(outfile, 'key')
+    cache.save()
+
+    assert BuildCache(tmp_path).recorded_key(outfile) == 'key'
+    assert not BuildCache(tmp_path).is_current(outfile, 'key')
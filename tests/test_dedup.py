@@ -0,0 +1,44 @@
+# Duplicate screenshots in the crop stage.
+
+import os
+
+import pytest
+
+import snapscreen
+from snapscreen.dedup import Image
+
+pytestmark = pytest.mark.skipif(Image is None, reason='needs Pillow')
+
+
+def write_screenshot(file, color, level: int) -> None:
+
+    file.parent.mkdir(parents=True, exist_ok=True)
+    Image.new('RGB', (320, 240), color).save(file, compress_level=level)
+
+
+def test_crops_of_duplicate_pixels_are_linked(matrix):
+
+    folder = matrix / 'screenshots' / 'Game 0'
+    write_screenshot(folder / 'shader0.png', (10, 20, 30), 1)
+    write_screenshot(folder / 'shader1.png', (10, 20, 30), 9)
+    write_screenshot(folder / 'shader2.png', (40, 50, 60), 1)
+    assert ((folder / 'shader0.png').read_bytes()
+            != (folder / 'shader1.png').read_bytes())
+    games = snapscreen.games_from_gamelist(matrix / 'gamelist.ini')
+    games = {'Game 0': games['Game 0']}
+    settings = snapscreen.build_crop_settings(
+            games,
+            inputdir=(matrix / 'screenshots').as_posix(),
+            outputdir=(matrix / 'crops').as_posix(),
+            backend='pillow',
+            dedup=True,
+            quiet=True)
+
+    created, collages, _ = snapscreen.crop(settings)
+
+    crops = matrix / 'crops' / 'Game 0'
+    first, second, other = sorted(crops.glob('*.png'))
+    assert created == 3 and collages == 1
+    assert os.path.samefile(first, second)
+    assert not os.path.samefile(first, other)
+    assert snapscreen.crop(settings)[:2] == (0, 0)
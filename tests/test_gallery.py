@@ -0,0 +1,31 @@
+# Links of the gallery pages to the full size images.
+
+import re
+import pathlib
+
+from snapscreen.gallery import build_thumbnail_html, build_thumbnail_name
+
+
+def build_href(file: str) -> str:
+
+    outputdir = pathlib.Path('gallery')
+    image = {'file': pathlib.Path(file),
+             'name': build_thumbnail_name('screenshots',
+                                          pathlib.Path('screenshots'),
+                                          pathlib.Path(file))}
+    html = build_thumbnail_html({'outputdir': outputdir}, image,
+                                outputdir / 'games', 'label')
+
+    return re.search('href="([^"]*)"', html).group(1)
+
+
+def test_web_image_links_to_its_file():
+
+    assert (build_href('screenshots/4k/Game/shader.png')
+            == '../../screenshots/4k/Game/shader.png')
+
+
+def test_ppm_screenshot_links_to_its_largest_thumbnail():
+
+    assert (build_href('screenshots/4k/Game/shader.ppm')
+            == '../thumbs/640/screenshots/4k/Game/shader.ppm.jpg')
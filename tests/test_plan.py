@@ -0,0 +1,114 @@
+# The compiled job plan: streaming, invalidation and checks of cached entries.
+
+import os
+
+import pytest
+
+import snapscreen
+from snapscreen import plan as planmodule
+from snapscreen.screenshots import iterate_screenshot_jobs
+
+
+@pytest.fixture
+def plan(matrix, matrix_env, monkeypatch):
+
+    for name in ['HOME', 'XDG_CACHE_HOME']:
+        monkeypatch.setenv(name, matrix_env[name])
+    monkeypatch.chdir(matrix)
+    with snapscreen.JobPlan(matrix / 'plan.db') as plan:
+        yield plan
+
+
+def load(plan, matrix):
+
+    return plan.load(matrix / 'gamelist.ini', matrix / 'shaderlist.txt')
+
+
+def build_settings(plan, matrix):
+
+    games, shaders = load(plan, matrix)
+
+    return snapscreen.build_capture_settings(
+            games, shaders, outputdir=(matrix / 'screenshots').as_posix(),
+            plan=plan, quiet=True)
+
+
+def count_rows(plan, table: str) -> int:
+
+    return plan.db.execute('SELECT COUNT(*) FROM ' + table).fetchone()[0]
+
+
+def test_jobs_are_written_while_they_are_streamed(plan, matrix):
+
+    settings = build_settings(plan, matrix)
+    expected = list(iterate_screenshot_jobs(settings))
+    jobs = plan.screenshot_jobs(settings)
+
+    first = next(jobs)
+    assert first == expected[0]
+    assert count_rows(plan, 'stages') == 0
+    assert [first] + list(jobs) == expected
+    assert count_rows(plan, 'stages') == 1
+    assert count_rows(plan, 'jobs') == len(expected) == 6
+
+
+def test_complete_jobs_come_from_the_table(plan, matrix, monkeypatch):
+
+    settings = build_settings(plan, matrix)
+    expected = list(plan.screenshot_jobs(settings))
+
+    def fail(settings):
+        raise AssertionError('jobs expanded again')
+
+    monkeypatch.setattr(planmodule, 'iterate_screenshot_jobs', fail)
+    assert list(plan.screenshot_jobs(settings)) == expected
+
+
+def test_interrupted_expansion_starts_over(plan, matrix):
+
+    settings = build_settings(plan, matrix)
+    jobs = plan.screenshot_jobs(settings)
+    next(jobs)
+    jobs.close()
+
+    assert count_rows(plan, 'stages') == 0
+    assert len(list(plan.screenshot_jobs(settings))) == 6
+    assert count_rows(plan, 'jobs') == 6
+
+
+@pytest.mark.parametrize('name', ['gamelist.ini', 'shaderlist.txt'])
+def test_touched_list_invalidates_the_plan(plan, matrix, name):
+
+    settings = build_settings(plan, matrix)
+    list(plan.screenshot_jobs(settings))
+    assert count_rows(plan, 'jobs') == 6
+    load(plan, matrix)
+    assert count_rows(plan, 'jobs') == 6
+
+    stat = (matrix / name).stat()
+    os.utime(matrix / name, ns=(stat.st_atime_ns,
+                                stat.st_mtime_ns + 1_000_000_000))
+    load(plan, matrix)
+    assert count_rows(plan, 'jobs') == 0
+    assert count_rows(plan, 'stages') == 0
+
+
+def test_changed_input_invalidates_the_jobs(plan, matrix):
+
+    settings = build_settings(plan, matrix)
+    before = list(plan.screenshot_jobs(settings))
+    (matrix / 'roms' / 'game1.smc').write_text('changed game 1\n')
+
+    with snapscreen.JobPlan(matrix / 'plan.db') as again:
+        jobs = list(again.screenshot_jobs(build_settings(again, matrix)))
+    assert [job[2] for job in jobs[:3]] == [job[2] for job in before[:3]]
+    assert all(new[2] != old[2] for new, old in zip(jobs[3:], before[3:]))
+
+
+def test_missing_game_of_cached_gamelist_raises(plan, matrix):
+
+    load(plan, matrix)
+    (matrix / 'roms' / 'game1.smc').unlink()
+
+    with pytest.raises(FileNotFoundError):
+        load(plan, matrix)
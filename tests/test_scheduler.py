@@ -0,0 +1,173 @@
+# Retries, bad games and bad cores of the RetryScheduler.
+
+import pathlib
+
+import pytest
+
+from snapscreen import scheduler
+from snapscreen.scheduler import (RetryScheduler, CREATED, CRASH, TIMEOUT,
+                                  SKIPPED, BAD_GAME_FAILURES)
+
+SHADERS = [pathlib.Path(f'shader{number}.slangp') for number in range(6)]
+
+
+# A clock for the scheduler, which only moves when told to.
+class Clock:
+
+    def __init__(self):
+
+        self.now = 1000.0
+
+    def __call__(self) -> float:
+
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+
+    clock = Clock()
+    monkeypatch.setattr(scheduler.time, 'monotonic', clock)
+
+    return clock
+
+
+def build_games(*titles: str, core: str = 'core.so') -> dict:
+
+    return {title: {'core': pathlib.Path(core),
+                    'game': pathlib.Path(title + '.smc')}
+            for title in titles}
+
+
+def build_jobs(games: dict, shaders: int = 3) -> list:
+
+    return [(title, shaderfile, 'key')
+            for title in games for shaderfile in SHADERS[:shaders]]
+
+
+def take_all(retry: RetryScheduler) -> list:
+
+    taken = []
+    while True:
+        item, _ = retry.take()
+        if item is None:
+            return taken
+        taken.append(item)
+
+
+def test_retries_come_in_order_of_their_delay(clock):
+
+    games = build_games('A')
+    jobs = build_jobs(games, 2)
+    retry = RetryScheduler(iter(jobs), games, 5)
+    first, second = take_all(retry)
+    # The first job already failed twice and waits 4 seconds, the second one
+    # fails for the first time and waits only 1 second.
+    assert not retry.finish(first[0], 3, CRASH)
+    assert not retry.finish(second[0], 1, CRASH)
+
+    assert retry.wait_time() == pytest.approx(1.0)
+    clock.now += 1.0
+    assert retry.take() == ((second[0], 2), [])
+    assert retry.take() == (None, [])
+    assert retry.wait_time() == pytest.approx(3.0)
+    clock.now += 3.0
+    assert retry.take() == ((first[0], 4), [])
+    assert retry.finish(first[0], 4, CREATED)
+    assert retry.finish(second[0], 2, CREATED)
+    assert retry.wait_time() is None
+    assert retry.report()['failures'] == []
+
+
+def test_failed_job_is_given_up_after_all_tries(clock):
+
+    games = build_games('A')
+    jobs = build_jobs(games, 1)
+    retry = RetryScheduler(iter(jobs), games, 2)
+    (job, attempt), = take_all(retry)
+    assert not retry.finish(job, attempt, TIMEOUT)
+    clock.now += 60.0
+    (job, attempt), = take_all(retry)
+
+    assert attempt == 2
+    assert retry.finish(job, attempt, TIMEOUT, -9)
+    failure, = retry.report()['failures']
+    assert failure['kind'] == TIMEOUT
+    assert [entry['attempt'] for entry in failure['attempts']] == [1, 2]
+    assert retry.finished_titles() == ['A']
+
+
+def test_first_attempts_at_the_same_time_do_not_make_a_bad_game(clock):
+
+    games = build_games('A', 'B')
+    jobs = build_jobs(games, BAD_GAME_FAILURES)
+    retry = RetryScheduler(iter(jobs), games, 3)
+    running = [retry.take()[0] for _ in range(BAD_GAME_FAILURES)]
+    for job, attempt in running:
+        assert not retry.finish(job, attempt, TIMEOUT)
+    clock.now += 60.0
+
+    assert retry.report()['bad_games'] == {}
+    retries = [item for item in take_all(retry) if item[0][0] == 'A']
+    assert [attempt for _, attempt in retries] == [2] * BAD_GAME_FAILURES
+
+
+def test_game_is_bad_after_shaders_are_given_up_the_same_way(clock):
+
+    games = build_games('A')
+    jobs = build_jobs(games, BAD_GAME_FAILURES + 2)
+    retry = RetryScheduler(iter(jobs), games, 1)
+    for _ in range(BAD_GAME_FAILURES):
+        (job, attempt), skipped = retry.take()
+        assert skipped == []
+        assert retry.finish(job, attempt, CRASH, 1)
+
+    assert retry.report()['bad_games'] == {'A': CRASH}
+    item, skipped = retry.take()
+    assert item is None
+    assert skipped == jobs[BAD_GAME_FAILURES:]
+    assert retry.report()['counts'] == {CRASH: BAD_GAME_FAILURES, SKIPPED: 2}
+
+
+def test_created_screenshot_resets_the_streak(clock):
+
+    games = build_games('A')
+    jobs = build_jobs(games, BAD_GAME_FAILURES + 1)
+    retry = RetryScheduler(iter(jobs), games, 1)
+    outcomes = [CRASH] * (BAD_GAME_FAILURES - 1) + [CREATED, CRASH]
+    for (job, attempt), outcome in zip(take_all(retry), outcomes):
+        retry.finish(job, attempt, outcome)
+
+    assert retry.report()['bad_games'] == {}
+
+
+def test_other_failure_kind_resets_the_streak(clock):
+
+    games = build_games('A')
+    jobs = build_jobs(games, BAD_GAME_FAILURES + 1)
+    retry = RetryScheduler(iter(jobs), games, 1)
+    outcomes = [CRASH] * (BAD_GAME_FAILURES - 1) + [TIMEOUT]
+    for (job, attempt), outcome in zip(take_all(retry), outcomes):
+        retry.finish(job, attempt, outcome)
+
+    assert retry.report()['bad_games'] == {}
+
+
+def test_core_is_bad_after_two_bad_games(clock):
+
+    games = build_games('A', 'B', 'C')
+    games.update(build_games('D', core='other.so'))
+    jobs = build_jobs(games, BAD_GAME_FAILURES)
+    retry = RetryScheduler(iter(jobs), games, 1)
+    for title in ['A', 'B']:
+        for _ in range(BAD_GAME_FAILURES):
+            (job, attempt), _ = retry.take()
+            assert job[0] == title
+            retry.finish(job, attempt, CRASH)
+
+    assert retry.report()['bad_cores'] == {'core.so': CRASH}
+    taken = take_all(retry)
+    assert [job[0] for job, _ in taken] == ['D'] * BAD_GAME_FAILURES
+    skipped = [entry['title'] for entry in retry.report()['failures']
+               if entry['kind'] == SKIPPED]
+    assert skipped == ['C'] * BAD_GAME_FAILURES
@@ -0,0 +1,70 @@
+# Session mode of screenshot.py against the fake RetroArch, which serves the
+# network commands over UDP.
+
+import os
+import sys
+import json
+import socket
+import hashlib
+import subprocess
+
+from conftest import REPODIR
+
+
+def free_port() -> int:
+
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def run_screenshot(matrix, env, *options: str) -> None:
+
+    command = [sys.executable, os.path.join(REPODIR, 'screenshot.py'),
+               '--window', '320x240', '--timeout', '10', '--quiet']
+    subprocess.run(command + list(options), cwd=matrix, env=env, check=True,
+                   timeout=60)
+
+
+def digests(folder) -> dict:
+
+    return {file.relative_to(folder).as_posix():
+            hashlib.sha256(file.read_bytes()).hexdigest()
+            for file in folder.rglob('*.png')}
+
+
+def test_session_takes_one_screenshot_per_shader(matrix, matrix_env):
+
+    run_screenshot(matrix, matrix_env, '--session', '--jobs', '2',
+                   '--port', str(free_port()),
+                   '--outputdir', 'screenshots/session')
+    run_screenshot(matrix, matrix_env, '--outputdir', 'screenshots/single')
+
+    session = digests(matrix / 'screenshots' / 'session')
+    assert sorted(session) == [title + '/' + name
+                               for title in ['Game 0', 'Game 1']
+                               for name in ['shader0.png', 'shader1.png',
+                                            'sub／shader2.png']]
+    # Every shader was set before its screenshot, and each screenshot was
+    # taken after the same frames as a RetroArch run of its own.
+    assert len(set(session.values())) == len(session)
+    assert session == digests(matrix / 'screenshots' / 'single')
+    report = json.loads((matrix / 'screenshots' / 'session'
+                         / '.snapscreen-failures.json').read_text())
+    assert report['failures'] == []
+    assert not list((matrix / 'screenshots' / 'session').glob('.session-*'))
+
+
+def test_session_keeps_current_screenshots(matrix, matrix_env):
+
+    port = str(free_port())
+    run_screenshot(matrix, matrix_env, '--session', '--port', port,
+                   '--outputdir', 'screenshots')
+    before = {file: file.stat().st_mtime_ns
+              for file in (matrix / 'screenshots').rglob('*.png')}
+    run_screenshot(matrix, matrix_env, '--session', '--port', port,
+                   '--outputdir', 'screenshots')
+
+    assert len(before) == 6
+    assert before == {file: file.stat().st_mtime_ns
+                      for file in (matrix / 'screenshots').rglob('*.png')}